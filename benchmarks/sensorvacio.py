@@ -0,0 +1,214 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from routers.sensorVacio import agregacion
+from utils.agregacion import calcular_delta_prima, get_datos_sin_hueco, valor_offset_func
+from utils.gap_generator import generar_huecos
+
+# Microbenchmarks del pipeline de /datos/sensorvacio sin base de datos, con series sintéticas:
+#   python -m benchmarks.sensorvacio --puntos 10000,100000 --guardar          (guarda la línea base)
+#   python -m benchmarks.sensorvacio --puntos 10000,100000 --comparar         (compara con ella)
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+PUNTOS = [10_000, 100_000, 1_000_000, 10_000_000]
+DELTATS = [60, 300, 900]  # segundos entre muestras: sensores rápidos, de 5 minutos y de 15 (señales filtradas)
+TIPOS = ["timeseries", "barchart"]
+INICIO = datetime(2024, 1, 1)
+
+
+##############################################################################################################
+# Series sintéticas
+##############################################################################################################
+
+
+def serie_sintetica(puntos, deltat, semilla=0):
+    """Filas como las que arma consultar_datos_sensor_by_variable: ciclo diario, ruido y algún valor nulo."""
+    rng = np.random.default_rng(semilla)
+    tiempos = pd.date_range(INICIO, periods=puntos, freq=f"{deltat}s").to_pydatetime()
+    segundos = np.arange(puntos, dtype=np.float64) * deltat
+    valores = 2 + np.sin(2 * np.pi * segundos / 86400) + rng.normal(0, 0.1, puntos)
+    nulos = rng.random(puntos) < 0.001
+    return [{"time": t, "value": None if nulo else v, "equipo": "Sintético"}
+            for t, v, nulo in zip(tiempos, valores.tolist(), nulos.tolist())]
+
+
+def barrido_valor_offset(s_data, s_time, t0, tiempo_final, intervalo):
+    # Recorrido por ventanas con valor_offset_func, como lo hacía la versión anterior de get_datos_sin_hueco
+    offset, ventanas = 0, 0
+    while t0 <= tiempo_final:
+        ventana = valor_offset_func(s_data, s_time, t0, t0 + intervalo, offset)
+        if ventana is not None:
+            offset = ventana["offset"][1]
+        t0 += intervalo
+        ventanas += 1
+    return ventanas
+
+
+##############################################################################################################
+# Medición
+##############################################################################################################
+
+
+def medir(funcion, preparar=None, min_segundos=1.0, max_repeticiones=20):
+    """Tiempos de `funcion` repitiendo hasta sumar `min_segundos` (al menos una vez, como mucho `max_repeticiones`).
+
+    `preparar` se llama antes de cada repetición, fuera del tiempo medido, y su resultado es el argumento.
+    """
+    tiempos = []
+    while not tiempos or (sum(tiempos) < min_segundos and len(tiempos) < max_repeticiones):
+        argumento = preparar() if preparar else None
+        inicio = time.perf_counter()
+        funcion(argumento)
+        tiempos.append(time.perf_counter() - inicio)
+    return tiempos
+
+
+def pico_memoria(funcion, preparar=None):
+    # En una ejecución aparte: tracemalloc ralentiza el código y falsearía los tiempos
+    argumento = preparar() if preparar else None
+    tracemalloc.start()
+    try:
+        funcion(argumento)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def etapas(datos, deltat, tipo, modos):
+    """(etapa, modo) -> (función, preparación) del pipeline de agregacion() para una serie ya leída.
+
+    Solo agregacion() depende del modo; las demás etapas llevan el modo "-".
+    """
+    silencio = io.StringIO()
+
+    def huecos(_):
+        # generar_huecos imprime cada hueco; la semilla fija los huecos entre ejecuciones
+        random.seed(0)
+        with contextlib.redirect_stdout(silencio):
+            return generar_huecos(datos)
+
+    datos_with_gaps, huecos_info = huecos(None)
+    s_data = [dato["value"] for dato in datos_with_gaps]
+    s_time = [int(dato["time"].timestamp() * 1000) for dato in datos_with_gaps]
+    limites = [datos_with_gaps[0]["time"], datos_with_gaps[-1]["time"]]
+    z = calcular_delta_prima(tipo, deltat, limites)
+    t0, tiempo_final = s_time[0], s_time[-1]
+
+    medidas = {
+        ("generar_huecos", "-"): (huecos, None),
+        ("calcular_delta_prima", "-"): (lambda _: calcular_delta_prima(tipo, deltat, limites), None),
+        ("get_datos_sin_hueco", "-"): (lambda _: get_datos_sin_hueco(limites, s_data, s_time, z), None),
+        ("valor_offset_func", "-"): (lambda _: barrido_valor_offset(s_data, s_time, t0, tiempo_final, z * 1000),
+                                     None),
+    }
+    for modo in modos:
+        # agregacion() inserta los huecos en la lista cuando no hay que agrupar: una copia nueva cada vez
+        medidas[("agregacion", modo)] = (
+            lambda copia, modo=modo: agregacion(datos, copia, deltat, huecos_info, "Sintético", tipo, modo),
+            lambda: list(datos_with_gaps)
+        )
+    return medidas
+
+
+def ejecutar(puntos, deltats, tipos, modos, min_segundos, memoria):
+    resultados = []
+    for n in puntos:
+        for deltat in deltats:
+            datos = serie_sintetica(n, deltat)
+            for tipo in tipos:
+                for (etapa, modo), (funcion, preparar) in etapas(datos, deltat, tipo, modos).items():
+                    tiempos = medir(funcion, preparar, min_segundos)
+                    resultado = {
+                        "etapa": etapa, "puntos": n, "deltat": deltat, "tipo": tipo, "modo": modo,
+                        "segundos": min(tiempos), "mediana": statistics.median(tiempos),
+                        "repeticiones": len(tiempos), "puntos_s": n / min(tiempos),
+                        "pico_mb": pico_memoria(funcion, preparar) / 2 ** 20 if memoria else None,
+                    }
+                    resultados.append(resultado)
+                    print(linea(resultado), flush=True)
+            del datos
+    return resultados
+
+
+##############################################################################################################
+# Informe y línea base
+##############################################################################################################
+
+
+def clave(resultado):
+    return resultado["etapa"], resultado["puntos"], resultado["deltat"], resultado["tipo"], resultado["modo"]
+
+
+def linea(resultado, comparacion=""):
+    memoria = f"{resultado['pico_mb']:9.1f} MB" if resultado["pico_mb"] is not None else " " * 12
+    return (f"{resultado['etapa']:<22}{resultado['puntos']:>11,}{resultado['deltat']:>6}s {resultado['tipo']:<11}"
+            f"{resultado['modo']:<5}{resultado['segundos'] * 1000:12.3f} ms{resultado['puntos_s']:16,.0f} pts/s"
+            f"{memoria}{comparacion}")
+
+
+def entorno():
+    return {"python": platform.python_version(), "numpy": np.__version__, "maquina": platform.machine(),
+            "procesador": platform.processor(), "sistema": platform.platform()}
+
+
+def comparar(resultados, ruta, umbral):
+    """Imprime la variación de cada medida frente a la línea base; devuelve las que empeoran más de `umbral`."""
+    base = {clave(r): r for r in json.loads(Path(ruta).read_text())["resultados"]}
+    regresiones = []
+    print(f"\nFrente a {ruta} (tiempo actual / tiempo base):")
+    for resultado in resultados:
+        anterior = base.get(clave(resultado))
+        if anterior is None:
+            continue
+        ratio = resultado["segundos"] / anterior["segundos"]
+        marca = "  REGRESIÓN" if ratio > 1 + umbral else ""
+        print(linea(resultado, f"  x{ratio:.2f}{marca}"))
+        if marca:
+            regresiones.append(resultado)
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de utils/agregacion y del pipeline de sensorvacio.")
+    parser.add_argument("--puntos", type=lambda s: [int(float(p)) for p in s.split(",")], default=PUNTOS,
+                        help="Tamaños de serie separados por comas (por defecto 10k a 10M).")
+    parser.add_argument("--deltat", type=lambda s: [int(d) for d in s.split(",")], default=DELTATS,
+                        help="Segundos entre muestras, separados por comas.")
+    parser.add_argument("--tipos", type=lambda s: s.split(","), default=TIPOS)
+    parser.add_argument("--modos", type=lambda s: s.split(","), default=["avg"],
+                        help="Modos de agregacion(): avg, lttb, m4.")
+    parser.add_argument("--min-segundos", type=float, default=1.0, help="Tiempo mínimo medido por etapa.")
+    parser.add_argument("--sin-memoria", action="store_true", help="No medir el pico de memoria (tracemalloc).")
+    parser.add_argument("--guardar", nargs="?", const=BASELINE, help=f"Guarda los resultados (por defecto {BASELINE}).")
+    parser.add_argument("--comparar", nargs="?", const=BASELINE, help="Compara con una línea base guardada.")
+    parser.add_argument("--umbral", type=float, default=0.2,
+                        help="Empeoramiento relativo que cuenta como regresión al comparar (0.2 = 20%%).")
+    args = parser.parse_args()
+
+    resultados = ejecutar(args.puntos, args.deltat, args.tipos, args.modos, args.min_segundos, not args.sin_memoria)
+
+    # Se compara antes de guardar: con las dos opciones, la línea base nueva sustituye a la anterior
+    regresiones = comparar(resultados, args.comparar, args.umbral) if args.comparar else []
+    if args.guardar:
+        Path(args.guardar).write_text(json.dumps(
+            {"fecha": datetime.now().isoformat(timespec="seconds"), "entorno": entorno(), "resultados": resultados},
+            indent=1))
+        print(f"\nResultados guardados en {args.guardar}")
+    if regresiones:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
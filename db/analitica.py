@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import Boolean, DateTime, Float, Integer, create_engine, select
+from sqlalchemy.dialects.postgresql.base import PGDialect
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from db.connector import Base, engine
+from db.models import Variable, Equipo, Sensor, Senal, SenalSensor, Consigna, SensorDatos, SenalDatos, \
+    ValoresConsigna, SensorRollup, SenalRollup, ConsignaRollup
+
+# Motor de las consultas de agregación pesadas (medias mensuales, máximos y mínimos, heatmap, modos de consigna):
+# mysql: la base de datos principal, con la sesión de la petición
+# duckdb: DuckDB embebido sobre una réplica en Parquet (directorio) o en un fichero .duckdb
+# sqlite: una réplica SQLite, p. ej. para pruebas y benchmarks sin servidor
+ANALITICA_BACKEND = os.getenv("ANALITICA_BACKEND", "mysql")
+ANALITICA_DUCKDB = os.getenv("ANALITICA_DUCKDB", "datos/analitica")
+ANALITICA_SQLITE = os.getenv("ANALITICA_SQLITE", "sqlite+aiosqlite:///datos/analitica.db")
+
+# Tablas que necesitan las consultas analíticas, copiadas a la réplica por `python -m db.analitica exportar`
+TABLAS_REPLICA = [Variable, Equipo, Sensor, Senal, SenalSensor, Consigna, SensorDatos, SenalDatos, ValoresConsigna,
+                  SensorRollup, SenalRollup, ConsignaRollup]
+
+
+class DialectoDuckDB(PGDialect):
+    """El SQL de DuckDB es el de PostgreSQL salvo en lo que se compila aparte para "duckdb" (ver bucket_sql)."""
+    name = "duckdb"
+
+
+class AnaliticaMySQL:
+    nombre = "mysql"
+
+    async def ejecutar(self, db, query):
+        return (await db.execute(query)).fetchall()
+
+
+class AnaliticaSQLite:
+    nombre = "sqlite"
+
+    def __init__(self, url):
+        self.motor = create_async_engine(url)
+
+    async def ejecutar(self, db, query):
+        async with self.motor.connect() as conn:
+            return (await conn.execute(query)).fetchall()
+
+
+class AnaliticaDuckDB:
+    """DuckDB embebido: ejecución vectorizada por columnas, en un hilo para no bloquear el bucle de eventos.
+
+    Con un directorio, cada tabla es una vista sobre sus ficheros Parquet (`tabla.parquet` o `tabla/*.parquet`);
+    con un fichero, se abre en solo lectura.
+    """
+    nombre = "duckdb"
+
+    def __init__(self, ruta):
+        self.ruta = Path(ruta)
+        self._conexion = None
+        self._apertura = threading.Lock()
+        self.dialecto = DialectoDuckDB()
+
+    def _conectar(self):
+        with self._apertura:
+            if self._conexion is None:
+                try:
+                    import duckdb
+                except ImportError:
+                    raise RuntimeError("ANALITICA_BACKEND=duckdb necesita el paquete duckdb")
+                if not self.ruta.is_dir():
+                    self._conexion = duckdb.connect(str(self.ruta), read_only=True)
+                else:
+                    conexion = duckdb.connect()
+                    for modelo in TABLAS_REPLICA:
+                        tabla = modelo.__tablename__
+                        ficheros = self.ruta / f"{tabla}.parquet"
+                        if not ficheros.exists():
+                            ficheros = self.ruta / tabla / "*.parquet"
+                        conexion.execute(f"CREATE VIEW \"{tabla}\" AS SELECT * FROM read_parquet('{ficheros}')")
+                    self._conexion = conexion
+            return self._conexion
+
+    def _ejecutar(self, sql):
+        # Un cursor por consulta: la conexión de DuckDB no se puede usar desde varios hilos a la vez
+        cursor = self._conectar().cursor()
+        try:
+            resultado = cursor.execute(sql)
+            Fila = namedtuple("Fila", [columna[0] for columna in resultado.description], rename=True)
+            return [Fila(*fila) for fila in resultado.fetchall()]
+        finally:
+            cursor.close()
+
+    async def ejecutar(self, db, query):
+        sql = str(query.compile(dialect=self.dialecto, compile_kwargs={"literal_binds": True}))
+        return await asyncio.to_thread(self._ejecutar, sql)
+
+
+def crear_analitica(backend=ANALITICA_BACKEND):
+    if backend == "duckdb":
+        return AnaliticaDuckDB(ANALITICA_DUCKDB)
+    if backend == "sqlite":
+        return AnaliticaSQLite(ANALITICA_SQLITE)
+    if backend == "mysql":
+        return AnaliticaMySQL()
+    raise ValueError(f"ANALITICA_BACKEND no válido: {backend}")
+
+
+analitica = crear_analitica()
+
+
+##############################################################################################################
+# Réplica para DuckDB o SQLite
+##############################################################################################################
+
+
+def esquema_arrow(pa, modelo):
+    # Del modelo y no de cada bloque: un bloque con una columna toda a NULL no debe cambiar el tipo
+    tipos = {Integer: pa.int64(), Float: pa.float64(), DateTime: pa.timestamp("us"), Boolean: pa.bool_()}
+    return pa.schema([(columna.name, next((t for clase, t in tipos.items() if isinstance(columna.type, clase)),
+                                          pa.string()))
+                      for columna in modelo.__table__.columns])
+
+
+def exportar_parquet(conn, modelo, destino, chunk):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    ruta = Path(destino) / f"{modelo.__tablename__}.parquet"
+    esquema = esquema_arrow(pa, modelo)
+    # Se escribe en un temporal y se sustituye de golpe: DuckDB nunca ve un fichero a medias
+    descriptor, temporal = tempfile.mkstemp(dir=destino, prefix=f".{ruta.name}.", suffix=".tmp")
+    os.close(descriptor)
+    filas = 0
+    try:
+        with pq.ParquetWriter(temporal, esquema) as escritor:
+            for bloque in pd.read_sql(select(modelo), conn, chunksize=chunk):
+                escritor.write_table(pa.Table.from_pandas(bloque, schema=esquema, preserve_index=False))
+                filas += len(bloque)
+        os.replace(temporal, ruta)
+    except BaseException:
+        os.unlink(temporal)
+        raise
+    return filas
+
+
+def exportar_sqlite(conn, modelo, motor, chunk):
+    with motor.begin() as destino:
+        destino.execute(modelo.__table__.delete())
+        filas = 0
+        for bloque in pd.read_sql(select(modelo), conn, chunksize=chunk):
+            if bloque.empty:
+                continue
+            destino.execute(modelo.__table__.insert(), bloque.astype(object).where(bloque.notna(), None)
+                            .to_dict("records"))
+            filas += len(bloque)
+    return filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copia las tablas de la base de datos a la réplica analítica.")
+    parser.add_argument("accion", choices=["exportar"])
+    parser.add_argument("--parquet", help="Directorio de la réplica Parquet para DuckDB.")
+    parser.add_argument("--sqlite", help="URL síncrona de la réplica SQLite, p. ej. sqlite:///datos/analitica.db.")
+    parser.add_argument("--chunk", type=int, default=500000, help="Filas leídas por bloque.")
+    args = parser.parse_args()
+    if not args.parquet and not args.sqlite:
+        parser.error("Hay que indicar --parquet o --sqlite")
+
+    motor = None
+    if args.parquet:
+        Path(args.parquet).mkdir(parents=True, exist_ok=True)
+    if args.sqlite:
+        motor = create_engine(args.sqlite)
+        Base.metadata.create_all(motor, tables=[modelo.__table__ for modelo in TABLAS_REPLICA])
+
+    for modelo in TABLAS_REPLICA:
+        inicio = time.monotonic()
+        with engine.connect() as conn:
+            if args.parquet:
+                filas = exportar_parquet(conn, modelo, args.parquet, args.chunk)
+            if motor is not None:
+                filas = exportar_sqlite(conn, modelo, motor, args.chunk)
+        print(f"{modelo.__tablename__}: {filas} filas en {time.monotonic() - inicio:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
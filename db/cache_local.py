@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+
+
+class CacheLocal:
+    """Caché en memoria del proceso (L1) delante de Redis: LRU acotada por bytes y con caducidad por entrada.
+
+    Guarda los valores ya codificados (bytes), así su tamaño es exacto y un acierto no copia nada.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl  # caducidad máxima en L1, aunque en Redis dure más
+        self._entradas = OrderedDict()  # key -> (caduca, valor), de la menos a la más usada
+        self._bytes = 0
+
+    def get(self, key):
+        entrada = self._entradas.get(key)
+        if entrada is None:
+            return None
+        caduca, valor = entrada
+        if caduca <= time.monotonic():
+            self.delete(key)
+            return None
+        self._entradas.move_to_end(key)
+        return valor
+
+    def set(self, key, valor, ttl):
+        self.delete(key)
+        tamano = len(key) + len(valor)
+        if tamano > self.max_bytes or ttl <= 0:
+            return
+        self._entradas[key] = (time.monotonic() + min(ttl, self.ttl), valor)
+        self._bytes += tamano
+        # Se expulsan las menos usadas hasta volver a caber
+        while self._bytes > self.max_bytes:
+            viejo, (_, valor_viejo) = self._entradas.popitem(last=False)
+            self._bytes -= len(viejo) + len(valor_viejo)
+
+    def delete(self, key):
+        entrada = self._entradas.pop(key, None)
+        if entrada is not None:
+            self._bytes -= len(key) + len(entrada[1])
+
+    def clear(self):
+        self._entradas.clear()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    @property
+    def bytes(self):
+        return self._bytes
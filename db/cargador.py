@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import create_engine, func, text
+from sqlalchemy.dialects.mysql import insert
+
+from db import connector
+from db.catalogo import catalogo
+from db.connector import DATABASE_URL, engine
+from db.models import SensorDatos, SenalDatos, ValoresConsigna
+from db.redis_client import invalidar, purgar_historicos
+from db.rollups import ROLLUPS, recalcular
+
+# tipo -> (tabla, columnas del CSV en orden, tipos de las columnas, fichero por defecto)
+# Los tipos coinciden con los de db.rollups para poder recalcular sus rollups al terminar
+TABLAS = {
+    "sensor": (SensorDatos, ["timestamp", "id_equipo", "id_variable", "valor"],
+               {"timestamp": "str", "id_equipo": "int", "id_variable": "int", "valor": "float"},
+               "datos/Sensor_values.csv"),
+    "consigna": (ValoresConsigna, ["timestamp", "id_consigna", "mode", "valor"],
+                 {"timestamp": "str", "id_consigna": "int", "mode": "int", "valor": "float"},
+                 "datos/Setpoint_values.csv"),
+    "senal": (SenalDatos, ["timestamp", "id_señal", "valor"],
+              {"timestamp": "str", "id_señal": "int", "valor": "float"},
+              "datos/Filtered_values.csv"),
+}
+
+
+def sentencia_upsert(tabla, conservar=()):
+    # Idempotente: una fila con la misma clave (id, timestamp) se sobrescribe en lugar de fallar
+    # Las columnas de conservar no se pisan con NULL: COALESCE(VALUES(col), col)
+    sentencia = insert(tabla)
+    actualizar = {c.name: func.coalesce(sentencia.inserted[c.name], c) if c.name in conservar
+                  else sentencia.inserted[c.name]
+                  for c in tabla.__table__.columns if not c.primary_key}
+    return sentencia.on_duplicate_key_update(**actualizar)
+
+
+def leer_csv(ruta, columnas, tipos, chunk):
+    # El CSV se lee por bloques: la memoria no depende del tamaño del fichero
+    return pd.read_csv(ruta, skiprows=1, names=columnas, dtype=tipos, chunksize=chunk)
+
+
+def series_de(bloque, tipo):
+    # Ids de las series del bloque, como las claves de db.rollups.ROLLUPS
+    return set(bloque[list(ROLLUPS[tipo][2])].drop_duplicates().itertuples(index=False, name=None))
+
+
+def cargar_upsert(tipo, ruta, chunk):
+    """Inserta el CSV por bloques con INSERT ... ON DUPLICATE KEY UPDATE de varias filas, un bloque por transacción.
+
+    Devuelve las filas cargadas, el rango de timestamps y las series cargadas.
+    """
+    tabla, columnas, tipos, _ = TABLAS[tipo]
+    sentencia = sentencia_upsert(tabla)
+    filas, desde, hasta, series = 0, None, None, set()
+    inicio = time.monotonic()
+
+    for bloque in leer_csv(ruta, columnas, tipos, chunk):
+        # Los timestamps son ISO 'YYYY-MM-DD HH:MM:SS': el orden de texto es el cronológico
+        desde = min(desde, bloque["timestamp"].min()) if desde else bloque["timestamp"].min()
+        hasta = max(hasta, bloque["timestamp"].max()) if hasta else bloque["timestamp"].max()
+        series |= series_de(bloque, tipo)
+        registros = bloque.astype(object).where(bloque.notna(), None).to_dict("records")
+        with engine.begin() as conn:
+            conn.execute(sentencia, registros)
+
+        filas += len(registros)
+        print(f"{tipo}: {filas} filas ({filas / (time.monotonic() - inicio):,.0f} filas/s)")
+    return filas, desde, hasta, series
+
+
+def cargar_load_data(tipo, ruta, chunk):
+    """Carga el CSV entero con LOAD DATA LOCAL INFILE ... REPLACE, lo más rápido cuando el servidor lo permite."""
+    tabla, columnas, tipos, _ = TABLAS[tipo]
+    # LOAD DATA guarda un campo vacío como 0 en FLOAT/INT: las columnas que admiten NULL pasan por una variable
+    # y un campo vacío se convierte en NULL, como hace cargar_upsert
+    nulables = [c for c in columnas if tabla.__table__.c[c].nullable]
+    campos = ", ".join(f"@{c}" if c in nulables else f"`{c}`" for c in columnas)
+    asignaciones = ", ".join(f"`{c}` = NULLIF(@{c}, '')" for c in nulables)
+    sentencia = text(
+        f"LOAD DATA LOCAL INFILE :ruta REPLACE INTO TABLE `{tabla.__tablename__}` CHARACTER SET utf8mb4 "
+        f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' IGNORE 1 LINES "
+        f"({campos}) SET {asignaciones}"
+    )
+    # local_infile se tiene que pedir al abrir la conexión
+    motor = create_engine(DATABASE_URL, connect_args={"local_infile": True}, pool_size=1)
+    inicio = time.monotonic()
+    with motor.begin() as conn:
+        filas = conn.execute(sentencia, {"ruta": ruta}).rowcount
+    motor.dispose()
+    print(f"{tipo}: {filas} filas ({filas / (time.monotonic() - inicio):,.0f} filas/s)")
+
+    # Rango de fechas para los rollups y series cargadas, leyendo solo esas columnas
+    desde, hasta, series = None, None, set()
+    usadas = ["timestamp", *ROLLUPS[tipo][2]]
+    for bloque in pd.read_csv(ruta, skiprows=1, names=columnas, usecols=usadas, dtype=tipos, chunksize=chunk):
+        desde = min(desde, bloque["timestamp"].min()) if desde else bloque["timestamp"].min()
+        hasta = max(hasta, bloque["timestamp"].max()) if hasta else bloque["timestamp"].max()
+        series |= series_de(bloque, tipo)
+    return filas, desde, hasta, series
+
+
+def cargar(tipo, ruta, metodo, chunk, rollups):
+    inicio = time.monotonic()
+    cargar_tabla = cargar_load_data if metodo == "load-data" else cargar_upsert
+    filas, desde, hasta, series = cargar_tabla(tipo, ruta, chunk)
+    desde = datetime.fromisoformat(desde) if desde else None
+    if rollups and desde:
+        recalcular(tipo, desde, datetime.fromisoformat(hasta))
+    return tipo, filas, time.monotonic() - inicio, desde, series
+
+
+async def avisar_cache(cargadas):
+    """Invalida en la caché de la API las series cargadas ({tipo: (desde, series)}).
+
+    Sube su versión, como la ingesta, y borra sus respuestas históricas desde el inicio de lo cargado, que al no
+    llevar versión seguirían sirviéndose hasta caducar.
+    """
+    async with connector.AsyncSessionLocal() as db:
+        await catalogo.cargar(db)
+    etiquetas_series = catalogo.etiquetas_series()
+    for tipo, (desde, series) in cargadas.items():
+        etiquetas = {e for serie in series for e in etiquetas_series[tipo].get(serie, [])}
+        await invalidar(etiquetas)
+        borradas = await purgar_historicos(etiquetas, desde)
+        print(f"{tipo}: {len(etiquetas)} etiquetas de caché invalidadas, {borradas} entradas históricas borradas")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga masiva de los CSV de la planta en la base de datos.")
+    for tipo, (_, _, _, ruta) in TABLAS.items():
+        parser.add_argument(f"--{tipo}", default=ruta, help=f"CSV de {tipo} (por defecto {ruta}); '-' para omitirlo.")
+    parser.add_argument("--metodo", choices=["upsert", "load-data"], default="upsert",
+                        help="upsert: INSERT de varias filas por bloque; load-data: LOAD DATA LOCAL INFILE.")
+    parser.add_argument("--chunk", type=int, default=50000, help="Filas por bloque (y por transacción).")
+    parser.add_argument("--hilos", type=int, default=len(TABLAS), help="Tablas cargadas en paralelo.")
+    parser.add_argument("--sin-rollups", action="store_true", help="No recalcular los rollups del rango cargado.")
+    parser.add_argument("--sin-cache", action="store_true",
+                        help="No invalidar en la caché de la API (Redis) las series cargadas.")
+    args = parser.parse_args()
+
+    ficheros = {tipo: getattr(args, tipo) for tipo in TABLAS if getattr(args, tipo) != "-"}
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.hilos) as pool:
+        tareas = [pool.submit(cargar, tipo, ruta, args.metodo, args.chunk, not args.sin_rollups)
+                  for tipo, ruta in ficheros.items()]
+        resultados = [tarea.result() for tarea in tareas]
+
+    total = sum(filas for _, filas, _, _, _ in resultados)
+    for tipo, filas, segundos, _, _ in resultados:
+        print(f"{tipo}: {filas} filas en {segundos:.1f} s")
+    print(f"Total: {total} filas en {time.monotonic() - inicio:.1f} s "
+          f"({total / (time.monotonic() - inicio):,.0f} filas/s)")
+
+    cargadas = {tipo: (desde, series) for tipo, _, _, desde, series in resultados if desde}
+    if cargadas and not args.sin_cache:
+        try:
+            asyncio.run(avisar_cache(cargadas))
+        except Exception as e:
+            print(f"No se pudo invalidar la caché ({e}): las respuestas antiguas caducarán solas")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import select
+
+from db import connector
+from db.models import Variable, Equipo, Sensor, Senal, SenalSensor, Consigna
+from db.redis_client import versiones, invalidar, etiquetas_de
+
+logger = logging.getLogger(__name__)
+
+# Se recarga al cambiar la versión de la etiqueta "catalogo" (ver invalidar_catalogo) y, por si acaso, cada
+# CATALOGO_TTL segundos: es lo que tarda en verse un cambio hecho a mano en la base de datos sin avisar
+CATALOGO_TTL = int(os.getenv("CATALOGO_TTL", 60))
+ETIQUETA_CATALOGO = "catalogo"
+
+
+def _por_nombre(filas, campo):
+    # MySQL compara los nombres sin distinguir mayúsculas: el índice también
+    return {getattr(fila, campo).lower(): fila for fila in filas if getattr(fila, campo) is not None}
+
+
+class Catalogo:
+    """Variables, equipos, sensores, señales y consignas en memoria.
+
+    Resuelve los nombres de las peticiones a claves primarias, así las lecturas de datos son recorridos directos
+    por clave primaria sin joins, y da las etiquetas de cada serie (descripción del equipo, símbolo...) una vez
+    por serie en lugar de una por fila.
+    """
+
+    def __init__(self):
+        self.variables = {}  # id -> Variable
+        self.equipos = {}  # id -> Equipo
+        self.sensores = {}  # (id_equipo, id_variable) -> Sensor, con su deltat
+        self.senales = {}  # id -> Senal
+        self.senal_sensores = {}  # id_señal -> [(id_equipo, id_variable)]
+        self.consignas = {}  # id -> Consigna
+        self._variable_por_simbolo = {}
+        self._equipo_por_nombre = {}
+        self._senal_por_nombre = {}
+        self._consigna_por_nombre = {}
+        self.cargado = None
+        self.version = None
+        self._recarga = asyncio.Lock()
+
+    async def cargar(self, db):
+        variables = (await db.execute(select(Variable))).scalars().all()
+        equipos = (await db.execute(select(Equipo))).scalars().all()
+        sensores = (await db.execute(select(Sensor))).scalars().all()
+        senales = (await db.execute(select(Senal))).scalars().all()
+        senal_sensores = (await db.execute(select(SenalSensor))).scalars().all()
+        consignas = (await db.execute(select(Consigna))).scalars().all()
+
+        # Sin awaits entre estas asignaciones: una petición ve el catálogo anterior o el nuevo, nunca una mezcla
+        self.variables = {v.id: v for v in variables}
+        self.equipos = {e.id: e for e in equipos}
+        self.sensores = {(s.id_equipo, s.id_variable): s for s in sensores}
+        self.senales = {s.id: s for s in senales}
+        self.senal_sensores = {}
+        for s in senal_sensores:
+            self.senal_sensores.setdefault(s.id_señal, []).append((s.id_equipo, s.id_variable))
+        self.consignas = {c.id: c for c in consignas}
+        self._variable_por_simbolo = _por_nombre(variables, "simbolo")
+        self._equipo_por_nombre = _por_nombre(equipos, "nombre")
+        self._senal_por_nombre = _por_nombre(senales, "nombre")
+        self._consigna_por_nombre = _por_nombre(consignas, "nombre")
+        self.cargado = time.monotonic()
+
+    async def _version_actual(self):
+        try:
+            return (await versiones([ETIQUETA_CATALOGO]))[0]
+        except Exception:
+            # Sin Redis solo queda recargar por tiempo
+            logger.warning("No se pudo leer la versión del catálogo", exc_info=True)
+            return self.version
+
+    def _al_dia(self, version):
+        return (self.cargado is not None and version == self.version
+                and time.monotonic() - self.cargado < CATALOGO_TTL)
+
+    async def actualizar(self):
+        """Carga el catálogo si no lo está, si ha cambiado su versión o si ha pasado CATALOGO_TTL."""
+        version = await self._version_actual()
+        if self._al_dia(version):
+            return self
+        async with self._recarga:
+            # Con varias peticiones a la vez, solo la primera recarga
+            if not self._al_dia(version):
+                async with connector.AsyncSessionLocal() as db:
+                    await self.cargar(db)
+                self.version = version
+        return self
+
+    def variable(self, simbolo):
+        return self._variable_por_simbolo.get(simbolo.lower())
+
+    def equipo(self, nombre):
+        return self._equipo_por_nombre.get(nombre.lower())
+
+    def sensor(self, simbolo, nombre_equipo):
+        variable, equipo = self.variable(simbolo), self.equipo(nombre_equipo)
+        if variable is None or equipo is None:
+            return None
+        return self.sensores.get((equipo.id, variable.id))
+
+    def _ids(self, indice, nombres):
+        return {indice[nombre].id for nombre in {n.lower() for n in nombres if n} if nombre in indice}
+
+    def sensores_de_variables(self, simbolos):
+        ids = self._ids(self._variable_por_simbolo, simbolos)
+        return [par for par in self.sensores if par[1] in ids]
+
+    def sensores_de_equipos(self, nombres):
+        ids = self._ids(self._equipo_por_nombre, nombres)
+        return [par for par in self.sensores if par[0] in ids]
+
+    def senales_por_nombre(self, nombres):
+        return sorted(self._ids(self._senal_por_nombre, nombres))
+
+    def consignas_por_nombre(self, nombres):
+        return sorted(self._ids(self._consigna_por_nombre, nombres))
+
+    def consignas_de_equipos(self, nombres):
+        ids = self._ids(self._equipo_por_nombre, nombres)
+        return [c.id for c in self.consignas.values() if c.id_equipo in ids]
+
+    def etiquetas_series(self):
+        """tipo de db.rollups -> {ids de la serie: etiquetas de caché que dependen de ella}."""
+        variables, equipos = self.variables, self.equipos
+        return {
+            "sensor": {(e, v): etiquetas_de("sensor_variable", [variables[v].simbolo])
+                       + etiquetas_de("sensor_equipo", [equipos[e].nombre]) for e, v in self.sensores},
+            "senal": {(s.id,): etiquetas_de("senal", [s.nombre]) for s in self.senales.values()},
+            "consigna": {(c.id,): etiquetas_de("consigna_nombre", [c.nombre])
+                         + etiquetas_de("consigna_equipo", [equipos[c.id_equipo].nombre])
+                         for c in self.consignas.values()},
+        }
+
+
+catalogo = Catalogo()
+
+
+async def catalogo_al_dia():
+    """Dependencia de las rutas que leen series: garantiza que el catálogo está cargado y al día."""
+    return await catalogo.actualizar()
+
+
+async def precargar():
+    # Al arrancar; si la base de datos aún no responde, la primera petición lo volverá a intentar
+    try:
+        await catalogo.actualizar()
+    except Exception:
+        logger.exception("No se pudo cargar el catálogo al arrancar")
+
+
+async def invalidar_catalogo():
+    """Avisa a todos los workers de que han cambiado variables, equipos, sensores, señales o consignas.
+
+    Lo llama quien escribe esas tablas (loadtest.sembrar); tras cambiarlas a mano, `python -m db.catalogo`.
+    """
+    await invalidar([ETIQUETA_CATALOGO])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Avisa a los workers de la API de que ha cambiado el catálogo de series (variables, equipos...)."
+    )
+    parser.parse_args()
+    asyncio.run(invalidar_catalogo())
+    print("Catálogo invalidado: cada worker lo recarga en su próxima petición")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.dialects.mysql import insert
+
+from db import connector
+from db.catalogo import catalogo
+from db.connector import Base, engine
+from db.models import SensorDatos, SenalDatos, ValoresConsigna, SensorRollup, SenalRollup, ConsignaRollup, \
+    MigracionEsquema
+from routers.consigna import query_consigna_by_nombres
+from db.rollups import inicio_bucket
+from routers.sensor import query_sensor_by_variables, query_sensor_variable_by_equipo, query_sensor_max_min, \
+    query_promedio_mensual, series_de_descripciones
+from routers.sensorVacio import query_heatmap
+from routers.señal import query_senal_by_nombres
+
+# Tablas de datos particionadas por mes en `timestamp`: las consultas con rango de fechas solo leen esos meses
+PARTICIONADAS = [SensorDatos, SenalDatos, ValoresConsigna]
+# Tablas con índices secundarios, declarados en db.models
+CON_INDICES = [SensorDatos, SenalDatos, ValoresConsigna, SensorRollup, SenalRollup, ConsignaRollup]
+# Meses con partición creada por adelantado; lo que caiga más allá va a pmax, que no se poda
+MESES_ADELANTE = 3
+PMAX = "PARTITION pmax VALUES LESS THAN (MAXVALUE)"
+
+
+##############################################################################################################
+# Particiones mensuales
+##############################################################################################################
+
+
+def primer_dia(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def mes_siguiente(mes):
+    return datetime(mes.year + mes.month // 12, mes.month % 12 + 1, 1)
+
+
+def meses(desde, hasta):
+    mes = primer_dia(desde)
+    while mes <= hasta:
+        yield mes
+        mes = mes_siguiente(mes)
+
+
+def ultimo_mes(meses_adelante):
+    mes = primer_dia(datetime.now())
+    for _ in range(meses_adelante):
+        mes = mes_siguiente(mes)
+    return mes
+
+
+def definicion_particion(mes):
+    return f"PARTITION p{mes:%Y%m} VALUES LESS THAN ('{mes_siguiente(mes):%Y-%m-%d}')"
+
+
+def particiones(conn, tabla):
+    """Meses (primer día) con partición en `tabla`, sin pmax; vacío si la tabla no está particionada."""
+    nombres = conn.execute(text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :tabla AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    ), {"tabla": tabla}).scalars().all()
+    return [datetime.strptime(nombre[1:], "%Y%m") for nombre in nombres if nombre != "pmax"]
+
+
+def particionar_por_mes(conn, meses_adelante=MESES_ADELANTE):
+    """Particiona por RANGE COLUMNS(timestamp) las tablas de datos, un mes por partición.
+
+    Reconstruye cada tabla entera (en tablas grandes, horas): conviene hacerlo en una ventana de mantenimiento.
+    Antes quita las claves foráneas, que MySQL no admite en tablas particionadas.
+    """
+    for modelo in PARTICIONADAS:
+        tabla = modelo.__tablename__
+        if particiones(conn, tabla):
+            continue
+        for clave in inspect(conn).get_foreign_keys(tabla):
+            conn.execute(text(f"ALTER TABLE `{tabla}` DROP FOREIGN KEY `{clave['name']}`"))
+        # Con el índice (timestamp, valor) de la migración anterior, el mínimo no recorre la tabla
+        primero = conn.execute(select(func.min(modelo.timestamp))).scalar() or datetime.now()
+        definiciones = [definicion_particion(mes) for mes in meses(primero, ultimo_mes(meses_adelante))]
+        inicio = time.monotonic()
+        conn.execute(text(f"ALTER TABLE `{tabla}` PARTITION BY RANGE COLUMNS(`timestamp`) "
+                          f"({', '.join([*definiciones, PMAX])})"))
+        print(f"{tabla}: {len(definiciones)} particiones mensuales en {time.monotonic() - inicio:.1f} s")
+
+
+def asegurar_particiones(conn, meses_adelante=MESES_ADELANTE):
+    """Crea las particiones de los próximos `meses_adelante` meses partiendo pmax; pensado para un cron mensual."""
+    for modelo in PARTICIONADAS:
+        tabla = modelo.__tablename__
+        existentes = particiones(conn, tabla)
+        if not existentes:
+            continue
+        nuevas = [definicion_particion(mes)
+                  for mes in meses(mes_siguiente(existentes[-1]), ultimo_mes(meses_adelante))]
+        if nuevas:
+            conn.execute(text(f"ALTER TABLE `{tabla}` REORGANIZE PARTITION pmax INTO ({', '.join([*nuevas, PMAX])})"))
+            print(f"{tabla}: {len(nuevas)} particiones nuevas")
+
+
+##############################################################################################################
+# Migraciones
+##############################################################################################################
+
+
+def crear_indices(conn):
+    for modelo in CON_INDICES:
+        existentes = {indice["name"] for indice in inspect(conn).get_indexes(modelo.__tablename__)}
+        for indice in modelo.__table__.indexes:
+            if indice.name not in existentes:
+                inicio = time.monotonic()
+                indice.create(conn)
+                print(f"{modelo.__tablename__}: índice {indice.name} en {time.monotonic() - inicio:.1f} s")
+
+
+# En orden; las ya aplicadas quedan en esquema_migracion. MySQL confirma cada ALTER TABLE por separado, así
+# que cada migración comprueba lo que ya está hecho y se puede repetir si falla a medias.
+MIGRACIONES = [
+    ("001_indices_cubrientes", crear_indices),
+    ("002_particiones_mensuales", particionar_por_mes),
+]
+
+
+def migrar(meses_adelante=MESES_ADELANTE):
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn, tables=[MigracionEsquema.__table__])
+        aplicadas = set(conn.execute(select(MigracionEsquema.nombre)).scalars())
+
+    for nombre, migracion in MIGRACIONES:
+        if nombre in aplicadas:
+            continue
+        inicio = time.monotonic()
+        with engine.begin() as conn:
+            migracion(conn)
+            conn.execute(insert(MigracionEsquema).values(nombre=nombre, aplicada=datetime.now()))
+        print(f"{nombre}: aplicada en {time.monotonic() - inicio:.1f} s")
+
+    with engine.begin() as conn:
+        asegurar_particiones(conn, meses_adelante)
+
+
+##############################################################################################################
+# Comprobación de los planes de consulta
+##############################################################################################################
+
+
+def consultas_representativas(hasta):
+    """Nombre -> (consulta, si tiene rango de fechas): las formas de consulta de las rutas sobre series reales.
+
+    Usa las mismas funciones que construyen las consultas de las rutas, con las primeras series del catálogo
+    y la última semana con datos.
+    """
+    desde = hasta - timedelta(days=7)
+    # Rollup diario calculado hasta el día de `hasta`, que con lo anterior a `desde` se lee en bruto
+    cobertura = {serie: (inicio_bucket(desde, 86400), inicio_bucket(hasta, 86400)) for serie in catalogo.sensores}
+    consultas = {
+        "sensor_max_min": (query_sensor_max_min(desde, hasta), True),
+        "promedio_mensual": (query_promedio_mensual(series_de_descripciones(["Amonio", "Nitrato"]), cobertura), False),
+    }
+    if catalogo.sensores:
+        id_equipo, id_variable = min(catalogo.sensores)
+        variable, equipo = catalogo.variables[id_variable].simbolo, catalogo.equipos[id_equipo].nombre
+        consultas["sensor_variable"] = (query_sensor_by_variables([variable], desde, hasta), True)
+        consultas["sensor_variable_equipo"] = (query_sensor_variable_by_equipo(variable, equipo, desde, hasta), True)
+        consultas["heatmap"] = (query_heatmap(variable, equipo, hasta.year, cobertura), True)
+    if catalogo.senales:
+        senal = catalogo.senales[min(catalogo.senales)].nombre
+        consultas["senal"] = (query_senal_by_nombres([senal], desde, hasta), True)
+    if catalogo.consignas:
+        consigna = catalogo.consignas[min(catalogo.consignas)].nombre
+        consultas["consigna"] = (query_consigna_by_nombres([consigna], desde, hasta), True)
+    return consultas
+
+
+def problemas_de_planes(conn):
+    """EXPLAIN de las consultas representativas; devuelve los recorridos completos y las particiones sin podar."""
+    vigiladas = {modelo.__tablename__ for modelo in CON_INDICES}
+    n_particiones = {modelo.__tablename__: len(particiones(conn, modelo.__tablename__)) + 1
+                     for modelo in PARTICIONADAS}
+    hasta = conn.execute(select(func.max(SensorDatos.timestamp))).scalar() or datetime.now()
+
+    problemas = []
+    for nombre, (consulta, con_rango) in consultas_representativas(hasta).items():
+        sql = consulta.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+        for fila in conn.exec_driver_sql(f"EXPLAIN {sql}").mappings():
+            tabla = fila["table"]
+            if tabla not in vigiladas:
+                continue
+            # ALL: recorrido de la tabla; index: recorrido de un índice entero
+            if fila["type"] in ("ALL", "index"):
+                problemas.append(f"{nombre}: recorrido completo de {tabla} (type={fila['type']}, key={fila['key']})")
+            leidas = len(fila["partitions"].split(",")) if fila["partitions"] else 0
+            if con_rango and n_particiones.get(tabla, 1) > 2 and leidas >= n_particiones[tabla]:
+                problemas.append(f"{nombre}: lee las {leidas} particiones de {tabla}, sin poda por fecha")
+    return problemas
+
+
+async def comprobar_planes():
+    async with connector.AsyncSessionLocal() as db:
+        await catalogo.cargar(db)
+        conn = await db.connection()
+        return await conn.run_sync(problemas_de_planes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migraciones del esquema y comprobación de los planes de consulta.")
+    parser.add_argument("accion", choices=["migrar", "particiones", "comprobar"],
+                        help="migrar: aplica las migraciones pendientes; particiones: crea las de los próximos "
+                             "meses (cron mensual); comprobar: EXPLAIN de las consultas de las rutas, sale con "
+                             "error si alguna recorre una tabla entera o no poda particiones.")
+    parser.add_argument("--meses-adelante", type=int, default=MESES_ADELANTE)
+    args = parser.parse_args()
+
+    if args.accion == "migrar":
+        migrar(args.meses_adelante)
+    elif args.accion == "particiones":
+        with engine.begin() as conn:
+            asegurar_particiones(conn, args.meses_adelante)
+    else:
+        problemas = asyncio.run(comprobar_planes())
+        for problema in problemas:
+            print(problema)
+        if problemas:
+            sys.exit(1)
+        print("Sin recorridos completos")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 # models.py
 from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, ForeignKeyConstraint, UniqueConstraint, \
-    Boolean
+    Boolean, Index
 from db.connector import Base
 
 
@@ -26,6 +26,8 @@ class Sensor(Base):
     deltat = Column(Integer)
 
 
+# Las tablas de datos están particionadas por mes en `timestamp` (ver db.esquema). MySQL no admite claves foráneas
+# en tablas particionadas: la ingesta valida los ids contra el catálogo.
 class SensorDatos(Base):
     __tablename__ = 'sensor_datos'
     id_equipo = Column(Integer, primary_key=True, nullable=False)
@@ -33,7 +35,8 @@ class SensorDatos(Base):
     timestamp = Column(DateTime, primary_key=True, nullable=False)
     valor = Column(Float)
     __table_args__ = (
-        ForeignKeyConstraint(['id_equipo', 'id_variable'], ['sensor.id_equipo', 'sensor.id_variable']),
+        # Consultas por tiempo de todos los sensores (máximos y mínimos, recálculo de rollups) sin leer las filas
+        Index('ix_sensor_datos_timestamp_valor', 'timestamp', 'valor'),
     )
 
 
@@ -55,9 +58,12 @@ class SenalSensor(Base):
 
 class SenalDatos(Base):
     __tablename__ = 'señal_datos'
-    id_señal = Column(Integer, ForeignKey('señal.id'), primary_key=True, nullable=False)
+    id_señal = Column(Integer, primary_key=True, nullable=False)
     timestamp = Column(DateTime, primary_key=True, nullable=False)
     valor = Column(Float)
+    __table_args__ = (
+        Index('ix_señal_datos_timestamp_valor', 'timestamp', 'valor'),
+    )
 
 
 class Consigna(Base):
@@ -75,10 +81,58 @@ class Consigna(Base):
 
 class ValoresConsigna(Base):
     __tablename__ = 'valores_consigna'
-    id_consigna = Column(Integer, ForeignKey('consigna.id'), primary_key=True, nullable=False)
+    id_consigna = Column(Integer, primary_key=True, nullable=False)
     timestamp = Column(DateTime, primary_key=True, nullable=False)
     valor = Column(Float)
     mode = Column(Integer)
+    __table_args__ = (
+        Index('ix_valores_consigna_timestamp_valor', 'timestamp', 'valor'),
+    )
+
+
+class SensorRollup(Base):
+    __tablename__ = 'sensor_rollup'
+    id_equipo = Column(Integer, primary_key=True, nullable=False)
+    id_variable = Column(Integer, primary_key=True, nullable=False)
+    resolucion = Column(Integer, primary_key=True, nullable=False)  # segundos
+    bucket = Column(DateTime, primary_key=True, nullable=False)
+    cuenta = Column(Integer, nullable=False)
+    suma = Column(Float)
+    minimo = Column(Float)
+    maximo = Column(Float)
+    __table_args__ = (
+        ForeignKeyConstraint(['id_equipo', 'id_variable'], ['sensor.id_equipo', 'sensor.id_variable']),
+        # Medias mensuales de todos los sensores (rollup diario) y marca de agua de db.rollups sin leer las filas
+        Index('ix_sensor_rollup_resolucion_bucket', 'resolucion', 'bucket', 'cuenta', 'suma'),
+    )
+
+
+class SenalRollup(Base):
+    __tablename__ = 'señal_rollup'
+    id_señal = Column(Integer, ForeignKey('señal.id'), primary_key=True, nullable=False)
+    resolucion = Column(Integer, primary_key=True, nullable=False)
+    bucket = Column(DateTime, primary_key=True, nullable=False)
+    cuenta = Column(Integer, nullable=False)
+    suma = Column(Float)
+    minimo = Column(Float)
+    maximo = Column(Float)
+    __table_args__ = (
+        Index('ix_señal_rollup_resolucion_bucket', 'resolucion', 'bucket'),
+    )
+
+
+class ConsignaRollup(Base):
+    __tablename__ = 'consigna_rollup'
+    id_consigna = Column(Integer, ForeignKey('consigna.id'), primary_key=True, nullable=False)
+    resolucion = Column(Integer, primary_key=True, nullable=False)
+    bucket = Column(DateTime, primary_key=True, nullable=False)
+    cuenta = Column(Integer, nullable=False)
+    suma = Column(Float)
+    minimo = Column(Float)
+    maximo = Column(Float)
+    __table_args__ = (
+        Index('ix_consigna_rollup_resolucion_bucket', 'resolucion', 'bucket'),
+    )
 
 
 class HLC(Base):
@@ -108,6 +162,13 @@ class ActuadorDatos(Base):
     id_actuador = Column(Integer, ForeignKey('actuador.id'), primary_key=True, nullable=False)
     timestamp = Column(DateTime, primary_key=True, nullable=False)
 
+
+class MigracionEsquema(Base):
+    __tablename__ = 'esquema_migracion'
+    nombre = Column(String(100), primary_key=True, nullable=False)
+    aplicada = Column(DateTime, nullable=False)
+
+
 class User(Base):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True, index=True)
@@ -1,45 +1,401 @@
-from datetime import datetime
+import asyncio
+import logging
+import os
+import struct
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
 
-import redis
-import json
+import msgpack
+import orjson
+import redis.asyncio as redis
+
+from db import connector
+from db.cache_local import CacheLocal
+
+logger = logging.getLogger(__name__)
+
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", 2))
+
+# Caché L1 en memoria de cada worker: tamaño máximo y segundos que puede ir por detrás de Redis
+CACHE_L1_BYTES = int(os.getenv("CACHE_L1_BYTES", 64 * 1024 * 1024))
+CACHE_L1_TTL = int(os.getenv("CACHE_L1_TTL", 5))
 
 
 class RedisClient:
-    def __init__(self, host='localhost', port=6379, db=0):
-        self.client = redis.StrictRedis(host=host, port=port, db=db)
+    def __init__(self, host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB):
+        # Pool explícito y compartido por todas las peticiones del worker
+        self.pool = redis.ConnectionPool(host=host, port=port, db=db, max_connections=REDIS_MAX_CONNECTIONS,
+                                         socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+        self.client = redis.StrictRedis(connection_pool=self.pool)
 
     def get_client(self):
         return self.client
 
 
-# Inicializa el cliente de Redis
+# Inicializa el cliente de Redis (L2) y la caché local (L1)
 redis_client = RedisClient().get_client()
+cache_local = CacheLocal(CACHE_L1_BYTES, CACHE_L1_TTL)
+
+##############################################################################################################
+# Codec de la caché
+##############################################################################################################
+
+# Backend con el que se escriben los datos: "msgpack" u "orjson". Cada valor lleva un byte inicial con el
+# backend que lo escribió, así que cambiarlo no rompe las entradas ya guardadas.
+CACHE_CODEC = os.getenv("CACHE_CODEC", "msgpack")
+
+EPOCH = datetime(1970, 1, 1)
+_MICROSEGUNDO = timedelta(microseconds=1)
+_EXT_DATETIME = 1
+_MARCA_MSGPACK = b"M"
+_MARCA_ORJSON = b"J"
+
+
+def _a_microsegundos(dt):
+    return (dt - EPOCH) // _MICROSEGUNDO
+
 
+def _desde_microsegundos(us):
+    return EPOCH + timedelta(microseconds=us)
 
-def json_serializer(obj):
+
+def _msgpack_default(obj):
+    # Los timestamps se guardan tipados (int64 de microsegundos) y vuelven como datetime
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, struct.pack(">q", _a_microsegundos(obj)))
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def _msgpack_ext_hook(code, data):
+    if code == _EXT_DATETIME:
+        return _desde_microsegundos(struct.unpack(">q", data)[0])
+    return msgpack.ExtType(code, data)
+
+
+def _orjson_default(obj):
     if isinstance(obj, datetime):
-        return obj.isoformat()
+        return {"$dt": _a_microsegundos(obj)}
+    if isinstance(obj, Decimal):
+        return float(obj)
     raise TypeError(f"Type {type(obj)} not serializable")
 
 
-def json_deserializer(dct):
-    for key, value in dct.items():
-        if isinstance(value, str) and len(value) == 19:
-            try:
-                dct[key] = datetime.fromisoformat(value)
-            except ValueError:
-                pass
-    return dct
+def _orjson_tipos(obj):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "$dt" in obj:
+            return _desde_microsegundos(obj["$dt"])
+        return {k: _orjson_tipos(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_orjson_tipos(v) for v in obj]
+    return obj
+
+
+def encode(data):
+    if CACHE_CODEC == "orjson":
+        return _MARCA_ORJSON + orjson.dumps(data, default=_orjson_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return _MARCA_MSGPACK + msgpack.packb(data, default=_msgpack_default, use_bin_type=True)
+
+
+def decode(cached_data):
+    marca, cuerpo = cached_data[:1], cached_data[1:]
+    if marca == _MARCA_MSGPACK:
+        return msgpack.unpackb(cuerpo, ext_hook=_msgpack_ext_hook, raw=False, strict_map_key=False)
+    if marca == _MARCA_ORJSON:
+        return _orjson_tipos(orjson.loads(cuerpo))
+    # Entrada con un formato anterior: se trata como un fallo de caché
+    return None
+
+
+##############################################################################################################
+# Datos en caché
+##############################################################################################################
+
+
+def _ttl_local(ttl):
+    # TTL -1: la clave no caduca en Redis, en L1 se queda el máximo permitido
+    return CACHE_L1_TTL if ttl == -1 else ttl
+
+
+async def _get(key):
+    valor = cache_local.get(key)
+    if valor is None:
+        # El TTL viaja en la misma ida y vuelta para que L1 no sobreviva a Redis
+        async with redis_client.pipeline(transaction=False) as pipe:
+            valor, ttl = await pipe.get(key).ttl(key).execute()
+        if valor is not None:
+            cache_local.set(key, valor, _ttl_local(ttl))
+    return valor
+
+
+async def _mget(keys):
+    # Los aciertos de L1 no salen del proceso; el resto va en un único MGET
+    valores = [cache_local.get(key) for key in keys]
+    faltan = [i for i, valor in enumerate(valores) if valor is None]
+    if faltan:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.mget([keys[i] for i in faltan])
+            for i in faltan:
+                pipe.ttl(keys[i])
+            leidos, *ttls = await pipe.execute()
+        for i, valor, ttl in zip(faltan, leidos, ttls):
+            if valor is not None:
+                cache_local.set(keys[i], valor, _ttl_local(ttl))
+                valores[i] = valor
+    return valores
+
+
+async def _setex(items, expiration):
+    # Escritura en las dos capas; varias claves van en un solo pipeline
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, valor in items.items():
+            pipe.setex(key, expiration, valor)
+            cache_local.set(key, valor, expiration)
+        await pipe.execute()
+
+
+async def get_cached_response(key):
+    cached_data = await _get(key)
+    return decode(cached_data) if cached_data else None
+
+
+async def set_cached_response(key, data, expiration=30):
+    await _setex({key: encode(data)}, expiration)
+
+
+async def get_cached_responses(keys):
+    # Una sola ida y vuelta (MGET) para varias claves; None en las que no estén
+    if not keys:
+        return []
+    return [decode(c) if c else None for c in await _mget(keys)]
+
+
+async def set_cached_responses(items, expiration=30):
+    if not items:
+        return
+    await _setex({key: encode(data) for key, data in items.items()}, expiration)
+
 
+##############################################################################################################
+# Caducidad según el rango pedido e invalidación por versiones de cada serie
+##############################################################################################################
 
-def get_cached_response(key):
-    cached_data = redis_client.get(key)
-    if cached_data:
-        print(f"Data retrieved from Redis for key: {key}")  # Aviso en consola
-        return json.loads(cached_data, object_hook=json_deserializer)
+# Un rango que termina antes de este margen ya no recibe datos nuevos: se guarda mucho tiempo sin versionar
+CACHE_MARGEN_HISTORICO = timedelta(seconds=int(os.getenv("CACHE_MARGEN_HISTORICO", 2 * 86400)))
+CACHE_TTL_HISTORICO = int(os.getenv("CACHE_TTL_HISTORICO", 7 * 86400))
+# Los rangos que llegan hasta "ahora" se invalidan al subir la versión de sus series en la ingesta;
+# este TTL solo cubre los datos que entren por otro camino
+CACHE_TTL_VIVO = int(os.getenv("CACHE_TTL_VIVO", 300))
+
+
+def etiquetas_de(prefijo, claves):
+    # Una etiqueta por serie: "sensor_variable_nh4", "consigna_nombre_do_sp"... (MySQL no distingue mayúsculas)
+    return [f"{prefijo}_{clave}".lower() for clave in claves]
+
+
+def es_historico(hasta):
+    return hasta is not None and hasta < datetime.now() - CACHE_MARGEN_HISTORICO
+
+
+async def versiones(etiquetas):
+    # Pasan por L1: otro worker ve una invalidación como mucho CACHE_L1_TTL segundos tarde
+    return [int(v) if v else 0 for v in await _mget([f"version_{e}" for e in etiquetas])]
+
+
+async def invalidar(etiquetas):
+    """Sube la versión de las series: las entradas en caché que dependen de ellas dejan de usarse."""
+    claves = [f"version_{e}" for e in dict.fromkeys(etiquetas)]
+    if not claves:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for clave in claves:
+            pipe.incr(clave)
+        await pipe.execute()
+    for clave in claves:
+        cache_local.delete(clave)
+
+
+async def clave_y_ttl(key, expiration, hasta=None, etiquetas=()):
+    """Clave y TTL efectivos: los rangos históricos duran CACHE_TTL_HISTORICO y los vivos llevan en la clave
+    la versión de sus series, así una ingesta los invalida sin esperar al TTL."""
+    if es_historico(hasta):
+        return key, CACHE_TTL_HISTORICO
+    if etiquetas:
+        version = ".".join(str(v) for v in await versiones(etiquetas))
+        return f"{key}_v{version}", CACHE_TTL_VIVO
+    return key, expiration
+
+
+async def indexar_historicos(entradas):
+    """Apunta las claves históricas guardadas ({clave: (hasta, etiquetas)}) en un índice por serie y fin de rango.
+
+    Esas claves no llevan versión, así que subirla no las invalida: el índice permite borrarlas tras cargar datos
+    antiguos, ver purgar_historicos.
+    """
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, (hasta, etiquetas) in entradas.items():
+            for etiqueta in etiquetas:
+                pipe.zadd(f"historico_{etiqueta}", {key: hasta.timestamp()})
+                pipe.expire(f"historico_{etiqueta}", CACHE_TTL_HISTORICO + CACHE_STALE)
+        await pipe.execute()
+
+
+async def purgar_historicos(etiquetas, desde):
+    """Borra las entradas históricas de las series cuyo rango acaba en `desde` o después (las que pueden incluir
+    datos cargados desde `desde`). Devuelve cuántas claves había en caché."""
+    borradas = 0
+    for etiqueta in dict.fromkeys(etiquetas):
+        indice = f"historico_{etiqueta}"
+        claves = [c.decode() for c in await redis_client.zrangebyscore(indice, desde.timestamp(), "+inf")]
+        if not claves:
+            continue
+        borradas += await redis_client.delete(*claves)
+        await redis_client.zrem(indice, *claves)
+        for key in claves:
+            cache_local.delete(key)
+    return borradas
+
+
+##############################################################################################################
+# Cálculo coalescido: una sola computación por clave aunque caduque con muchos usuarios mirando
+##############################################################################################################
+
+# Segundos que un valor ya caducado se sigue sirviendo mientras se recalcula en segundo plano
+CACHE_STALE = int(os.getenv("CACHE_STALE", 300))
+# Cerrojo en Redis entre workers: vida máxima y tiempo que se espera a que otro worker termine
+CACHE_LOCK_TTL = int(os.getenv("CACHE_LOCK_TTL", 30))
+CACHE_LOCK_ESPERA = float(os.getenv("CACHE_LOCK_ESPERA", 5))
+_SONDEO = 0.05
+
+# Cada valor se guarda precedido de una marca y de la marca de tiempo hasta la que está fresco
+_CABECERA = struct.Struct(">cd")
+_MARCA_CACHEADO = b"S"
+
+# Borra el cerrojo solo si sigue siendo nuestro (puede haber caducado y pasado a otro worker)
+_LIBERAR = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Cálculos en curso en este proceso, por clave
+_en_vuelo = {}
+
+
+def una_vez(key, calcular):
+    """Ejecuta `calcular()` una sola vez por clave en este proceso; las llamadas concurrentes esperan al mismo
+    resultado (o a la misma excepción)."""
+    tarea = _en_vuelo.get(key)
+    if tarea is None:
+        tarea = asyncio.ensure_future(calcular())
+        _en_vuelo[key] = tarea
+        tarea.add_done_callback(lambda _: _en_vuelo.pop(key, None))
+    # shield: si se cancela una petición, el cálculo sigue para las demás
+    return asyncio.shield(tarea)
+
+
+async def _tomar_cerrojo(key):
+    token = uuid.uuid4().hex
+    if await redis_client.set(f"lock_{key}", token, nx=True, ex=CACHE_LOCK_TTL):
+        return token
     return None
 
 
-def set_cached_response(key, data, expiration=30):
-    print(f"Data sent to Redis for key: {key}")  # Aviso en consola
-    redis_client.setex(key, expiration, json.dumps(data, default=json_serializer))
+async def _liberar_cerrojo(key, token):
+    await redis_client.eval(_LIBERAR, 1, f"lock_{key}", token)
+
+
+async def _guardar(key, cuerpo, expiration):
+    # Redis la conserva CACHE_STALE segundos más para poder servirla caducada mientras se recalcula
+    valor = _CABECERA.pack(_MARCA_CACHEADO, time.time() + expiration) + cuerpo
+    await _setex({key: valor}, expiration + CACHE_STALE)
+
+
+async def _leer(key):
+    guardado = await _get(key)
+    if guardado is None or guardado[:1] != _MARCA_CACHEADO:
+        return None, None
+    return _CABECERA.unpack_from(guardado)[1], guardado[_CABECERA.size:]
+
+
+async def _calcular_y_guardar(key, calcular, expiration, codificar, indice=None):
+    # El cálculo es compartido por todas las peticiones que esperan la clave (y el refresco sigue tras responder):
+    # abre su propia sesión en lugar de usar la de la petición que lo empezó
+    async with connector.AsyncSessionLocal() as db:
+        valor = await calcular(db)
+    await _guardar(key, codificar(valor), expiration)
+    if indice is not None:
+        await indexar_historicos({key: indice})
+    return valor
+
+
+async def _calcular_con_cerrojo(key, calcular, expiration, codificar, decodificar, indice=None):
+    token = await _tomar_cerrojo(key)
+    if token is None:
+        # Otro worker lo está calculando: se espera a que lo deje en Redis
+        limite = time.monotonic() + CACHE_LOCK_ESPERA
+        while time.monotonic() < limite:
+            await asyncio.sleep(_SONDEO)
+            _, cuerpo = await _leer(key)
+            if cuerpo is not None:
+                return decodificar(cuerpo)
+        # No ha terminado a tiempo: se calcula aquí antes que dejar la petición sin respuesta
+        return await _calcular_y_guardar(key, calcular, expiration, codificar, indice)
+    try:
+        # Puede que otro worker lo haya guardado entre nuestra lectura y el cerrojo
+        _, cuerpo = await _leer(key)
+        if cuerpo is not None:
+            return decodificar(cuerpo)
+        return await _calcular_y_guardar(key, calcular, expiration, codificar, indice)
+    finally:
+        await _liberar_cerrojo(key, token)
+
+
+async def _refrescar(key, calcular, expiration, codificar, indice=None):
+    token = await _tomar_cerrojo(key)
+    if token is None:
+        return  # ya lo está refrescando otro worker
+    try:
+        await _calcular_y_guardar(key, calcular, expiration, codificar, indice)
+    except Exception:
+        logger.exception("Error refrescando la clave %s; se sigue sirviendo el valor anterior", key)
+    finally:
+        await _liberar_cerrojo(key, token)
+
+
+async def _obtener(key, calcular, expiration, codificar, decodificar, hasta, etiquetas):
+    key, expiration = await clave_y_ttl(key, expiration, hasta, etiquetas)
+    indice = (hasta, etiquetas) if es_historico(hasta) and etiquetas else None
+    fresco_hasta, cuerpo = await _leer(key)
+    if cuerpo is not None:
+        if time.time() >= fresco_hasta and key not in _en_vuelo:
+            # Stale-while-revalidate: se responde con el valor anterior y se recalcula en segundo plano
+            una_vez(key, lambda: _refrescar(key, calcular, expiration, codificar, indice))
+        return decodificar(cuerpo)
+    return await una_vez(key, lambda: _calcular_con_cerrojo(key, calcular, expiration, codificar, decodificar,
+                                                          indice))
+
+
+async def cacheado(key, calcular, expiration=30, hasta=None, etiquetas=()):
+    """Devuelve el dato de la clave o lo calcula con `await calcular(db)`, una sola vez entre todos los workers.
+
+    El cálculo se comparte entre peticiones y, pasados `expiration` segundos, se repite en segundo plano mientras
+    se sirve el valor anterior: por eso `calcular` recibe una sesión propia en lugar de usar la de la petición.
+    `hasta` (fin del rango pedido) y `etiquetas` (series de las que depende) deciden la caducidad real,
+    ver `clave_y_ttl`.
+    """
+    return await _obtener(key, calcular, expiration, encode, decode, hasta, etiquetas)
+
+
+async def cacheado_bytes(key, calcular, expiration=30, hasta=None, etiquetas=()):
+    """Como `cacheado`, para respuestas ya serializadas: `calcular(db)` devuelve bytes y se guardan tal cual."""
+    return await _obtener(key, calcular, expiration, bytes, bytes, hasta, etiquetas)
@@ -0,0 +1,228 @@
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, Integer, and_, cast, false, func, literal, literal_column, or_, select, tuple_, \
+    union_all
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from db.connector import engine
+from db.models import SensorDatos, SenalDatos, ValoresConsigna, SensorRollup, SenalRollup, ConsignaRollup
+
+# Resoluciones de los rollups en segundos: 1m, 15m, 1h y 1d
+RESOLUCIONES = [60, 900, 3600, 86400]
+
+EPOCH = datetime(1970, 1, 1)
+
+# tipo -> (tabla de datos, tabla de rollup, columnas que identifican la serie)
+ROLLUPS = {
+    "sensor": (SensorDatos, SensorRollup, ("id_equipo", "id_variable")),
+    "senal": (SenalDatos, SenalRollup, ("id_señal",)),
+    "consigna": (ValoresConsigna, ConsignaRollup, ("id_consigna",)),
+}
+
+
+def inicio_bucket(dt, resolucion):
+    segundos = int((dt - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=segundos - segundos % resolucion)
+
+
+class bucket_sql(FunctionElement):
+    """Inicio del bucket de `resolucion` segundos de una columna DATETIME, el mismo cálculo que inicio_bucket.
+
+    Se compila según el motor (MySQL, SQLite o DuckDB, ver db.analitica), sin conversiones de zona horaria.
+    """
+    type = DateTime()
+    inherit_cache = True
+
+    def __init__(self, columna, resolucion):
+        super().__init__(columna, literal(resolucion, Integer))
+
+
+@compiles(bucket_sql, "mysql")
+def _bucket_mysql(elemento, compilador, **kw):
+    columna, resolucion = elemento.clauses
+    segundos = func.timestampdiff(literal_column("SECOND"), literal(EPOCH), columna)
+    bucket = func.timestampadd(literal_column("SECOND"), segundos.op("DIV")(resolucion) * resolucion, literal(EPOCH))
+    return compilador.process(bucket, **kw)
+
+
+@compiles(bucket_sql, "sqlite")
+def _bucket_sqlite(elemento, compilador, **kw):
+    columna, resolucion = elemento.clauses
+    segundos = cast(func.strftime("%s", columna), Integer)
+    return compilador.process(func.datetime(segundos.op("/")(resolucion) * resolucion, "unixepoch"), **kw)
+
+
+@compiles(bucket_sql, "duckdb")
+def _bucket_duckdb(elemento, compilador, **kw):
+    columna, resolucion = elemento.clauses
+    return (f"time_bucket(to_seconds({compilador.process(resolucion, **kw)}), {compilador.process(columna, **kw)}, "
+            f"TIMESTAMP '{EPOCH:%Y-%m-%d %H:%M:%S}')")
+
+
+def elegir_resolucion(z, inicio, deltat):
+    """Rollup más grueso que responde buckets de `z` segundos empezando en `inicio`, o None si no hay ninguno."""
+    for resolucion in reversed(RESOLUCIONES):
+        if resolucion > deltat and z % resolucion == 0 and inicio == inicio_bucket(inicio, resolucion):
+            return resolucion
+    return None
+
+
+def columnas_serie(tabla, ids, serie):
+    return and_(*[getattr(tabla, c) == valor for c, valor in zip(ids, serie)])
+
+
+def query_cobertura(tipo, resolucion, series=None):
+    """Primer y último bucket de cada serie en el rollup de `resolucion` (por clave primaria si se dan `series`)."""
+    _, rollup, ids = ROLLUPS[tipo]
+    columnas_ids = [getattr(rollup, c) for c in ids]
+    query = (
+        select(*columnas_ids, func.min(rollup.bucket).label("primero"), func.max(rollup.bucket).label("ultimo"))
+        .where(rollup.resolucion == resolucion)
+        .group_by(*columnas_ids)
+    )
+    if series is not None:
+        query = query.where(tuple_(*columnas_ids).in_(series))
+    return query
+
+
+def cobertura_de(filas, tipo):
+    """serie -> (primero, ultimo) a partir de las filas de query_cobertura.
+
+    Los buckets del rollup valen desde `primero` hasta antes de `ultimo`: el último puede estar a medias (la
+    ingesta recalcula los rollups cada cierto tiempo), así que ese y todo lo posterior se leen en bruto, igual
+    que lo anterior a `primero` y las series sin rollup.
+    """
+    ids = ROLLUPS[tipo][2]
+    return {tuple(getattr(f, c) for c in ids): (f.primero, f.ultimo) for f in filas}
+
+
+def query_buckets(tipo, resolucion, series, cobertura, desde=None, hasta=None):
+    """Buckets (ids de la serie, bucket, cuenta, suma) de `series` entre los buckets `desde` y `hasta` incluidos.
+
+    Salen del rollup donde lo cubre según `cobertura` (ver cobertura_de) y del resto se calculan desde los datos
+    en bruto, para que un rollup sin calcular del todo no deje buckets vacíos.
+    """
+    datos, rollup, ids = ROLLUPS[tipo]
+    del_rollup = (
+        select(*[getattr(rollup, c) for c in ids], rollup.bucket.label("bucket"), rollup.cuenta.label("cuenta"),
+               rollup.suma.label("suma"))
+        .where(rollup.resolucion == resolucion)
+        .where(rollup.cuenta > 0)
+        .where(or_(false(), *[and_(columnas_serie(rollup, ids, serie), rollup.bucket < cobertura[serie][1])
+                              for serie in series if serie in cobertura]))
+    )
+    bucket = bucket_sql(datos.timestamp, resolucion)
+    fuera = [
+        and_(columnas_serie(datos, ids, serie),
+             or_(datos.timestamp < cobertura[serie][0], datos.timestamp >= cobertura[serie][1]))
+        if serie in cobertura else columnas_serie(datos, ids, serie)
+        for serie in series
+    ]
+    columnas_ids = [getattr(datos, c) for c in ids]
+    en_bruto = (
+        select(*columnas_ids, bucket.label("bucket"), func.count(datos.valor).label("cuenta"),
+               func.sum(datos.valor).label("suma"))
+        .where(or_(false(), *fuera))
+        .group_by(*columnas_ids, literal_column("bucket"))
+        .having(func.count(datos.valor) > 0)
+    )
+    if desde is not None:
+        del_rollup = del_rollup.where(rollup.bucket >= desde)
+        en_bruto = en_bruto.where(datos.timestamp >= desde)
+    if hasta is not None:
+        del_rollup = del_rollup.where(rollup.bucket <= hasta)
+        en_bruto = en_bruto.where(datos.timestamp < inicio_bucket(hasta, resolucion) + timedelta(seconds=resolucion))
+    return union_all(del_rollup, en_bruto)
+
+
+def sentencias_rollup(tipo, desde, hasta, series=None):
+    """INSERT ... SELECT que recalculan, en cada resolución, los buckets de `tipo` que tocan [desde, hasta].
+
+    Se recalculan los buckets completos a partir de los datos en bruto, así que repetirlas es idempotente
+    (sirve tanto para datos nuevos como para filas reescritas por un upsert). `series` (tuplas con los ids de
+    cada serie, en el orden de ROLLUPS) limita el recálculo a esas series.
+    """
+    datos, rollup, ids = ROLLUPS[tipo]
+    columnas_ids = [getattr(datos, c) for c in ids]
+
+    sentencias = []
+    for resolucion in RESOLUCIONES:
+        seleccion = (
+            select(
+                *columnas_ids,
+                literal(resolucion),
+                bucket_sql(datos.timestamp, resolucion).label("bucket"),
+                func.count(datos.valor),
+                func.sum(datos.valor),
+                func.min(datos.valor),
+                func.max(datos.valor)
+            )
+            .where(datos.timestamp >= inicio_bucket(desde, resolucion))
+            .where(datos.timestamp < inicio_bucket(hasta, resolucion) + timedelta(seconds=resolucion))
+            .group_by(*columnas_ids, literal_column("bucket"))
+        )
+        if series:
+            seleccion = seleccion.where(tuple_(*columnas_ids).in_(series))
+        sentencia = insert(rollup).from_select(
+            [*ids, "resolucion", "bucket", "cuenta", "suma", "minimo", "maximo"], seleccion
+        )
+        sentencia = sentencia.on_duplicate_key_update(
+            cuenta=sentencia.inserted.cuenta,
+            suma=sentencia.inserted.suma,
+            minimo=sentencia.inserted.minimo,
+            maximo=sentencia.inserted.maximo,
+        )
+        sentencias.append(sentencia)
+    return sentencias
+
+
+async def actualizar_rollups(db, tipo, desde, hasta, series=None):
+    for sentencia in sentencias_rollup(tipo, desde, hasta, series):
+        await db.execute(sentencia)
+    await db.commit()
+
+
+def ultimo_bucket(conn, tipo):
+    # Marca de agua: último bucket de la resolución más fina; a partir de ahí hay que recalcular
+    datos, rollup, _ = ROLLUPS[tipo]
+    marca = conn.execute(select(func.max(rollup.bucket)).where(rollup.resolucion == RESOLUCIONES[0])).scalar()
+    return marca or conn.execute(select(func.min(datos.timestamp))).scalar()
+
+
+def recalcular(tipo, desde, hasta, dias=7):
+    """Recalcula los rollups de `tipo` entre `desde` y `hasta`, en una transacción cada `dias` días."""
+    # Ventanas alineadas a días para que ningún bucket quede partido entre dos transacciones
+    inicio = inicio_bucket(desde, RESOLUCIONES[-1])
+    while inicio <= hasta:
+        fin = min(inicio + timedelta(days=dias), hasta)
+        with engine.begin() as conn:
+            for sentencia in sentencias_rollup(tipo, inicio, fin):
+                conn.execute(sentencia)
+        print(f"{tipo}: rollups recalculados hasta {fin}")
+        inicio += timedelta(days=dias)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcula las tablas de rollup a partir de los datos en bruto.")
+    parser.add_argument("--tipo", choices=[*ROLLUPS, "todos"], default="todos")
+    parser.add_argument("--desde", type=datetime.fromisoformat,
+                        help="Por defecto, el último bucket ya calculado (modo incremental).")
+    parser.add_argument("--hasta", type=datetime.fromisoformat, default=datetime.now())
+    parser.add_argument("--dias", type=int, default=7, help="Días recalculados por transacción.")
+    args = parser.parse_args()
+
+    tipos = list(ROLLUPS) if args.tipo == "todos" else [args.tipo]
+    for tipo in tipos:
+        with engine.connect() as conn:
+            desde = args.desde or ultimo_bucket(conn, tipo)
+        if desde is None:
+            print(f"{tipo}: sin datos")
+            continue
+        recalcular(tipo, desde, args.hasta, args.dias)
+
+
+if __name__ == "__main__":
+    main()
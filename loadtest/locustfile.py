@@ -0,0 +1,357 @@
+import logging
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from locust import HttpUser, between, events, task
+from locust.runners import WorkerRunner
+
+from loadtest.ventanas import DESDE, DIAS, Repertorio, algunos, ventana
+
+# Perfil de carga de todas las rutas de la API, un tipo de usuario por router. Sin interfaz y con los umbrales:
+#   python -m loadtest --servidor --usuarios 50 --duracion 5m          (ver loadtest/__main__.py)
+# o directamente con locust desde la raíz del repositorio:
+#   locust -f loadtest/locustfile.py --host http://localhost:8000 --aciertos-cache 0.8 --slo-p95 800
+
+logger = logging.getLogger(__name__)
+
+# Las escrituras invalidan la caché de las series que tocan y falsean la proporción de aciertos: la ingesta
+# solo entra en la mezcla con peso > 0 (locust descarta las clases con peso 0 antes de leer sus opciones)
+PESO_INGESTA = int(os.getenv("CARGA_PESO_INGESTA", 0))
+MAX_POINTS = [None, 300, 1000, 2000]
+FORMATOS = ["json", "json", "json", "ndjson", "csv"]
+
+
+@events.init_command_line_parser.add_listener
+def opciones(parser):
+    parser.add_argument("--aciertos-cache", type=float, default=0.8, include_in_web_ui=True,
+                        help="Proporción de peticiones repetidas, que la API responde desde la caché (0 a 1).")
+    parser.add_argument("--datos-desde", type=datetime.fromisoformat, default=DESDE,
+                        help="Inicio de los datos sembrados; los rangos de fechas caen dentro.")
+    parser.add_argument("--datos-dias", type=int, default=DIAS, help="Días de datos sembrados.")
+    parser.add_argument("--semilla", type=int, default=None, help="Semilla de las peticiones, para repetirlas.")
+    # Umbrales: si al terminar se supera alguno, locust sale con código 1. 0 desactiva el umbral.
+    parser.add_argument("--slo-p50", type=float, default=200, help="Mediana máxima en ms.")
+    parser.add_argument("--slo-p95", type=float, default=1000, help="Percentil 95 máximo en ms.")
+    parser.add_argument("--slo-p99", type=float, default=3000, help="Percentil 99 máximo en ms.")
+    parser.add_argument("--slo-errores", type=float, default=0.01, help="Proporción máxima de peticiones fallidas.")
+    parser.add_argument("--slo-rps", type=float, default=0, help="Peticiones por segundo mínimas.")
+
+
+class Carga:
+    """Estado compartido por los usuarios: las peticiones repetidas, el rango de los datos y los nombres."""
+    repertorio = Repertorio(0.8)
+    inicio, fin = DESDE, DESDE + timedelta(days=DIAS)
+    nombres = None
+
+
+@events.init.add_listener
+def configurar(environment, **_):
+    opciones = environment.parsed_options
+    if opciones is None:
+        return
+    Carga.repertorio = Repertorio(opciones.aciertos_cache, semilla=opciones.semilla)
+    Carga.inicio = opciones.datos_desde
+    Carga.fin = opciones.datos_desde + timedelta(days=opciones.datos_dias)
+
+
+def leer_nombres(cliente):
+    """Variables, equipos, sensores, señales y consignas de la API, leídos una vez por proceso."""
+    variables = {v["id"]: v for v in cliente.get("/variables/", name="/variables/").json()}
+    equipos = {e["id"]: e for e in cliente.get("/equipos/", name="/equipos/").json()}
+    sensores = [s for s in cliente.get("/relaciones/", name="/relaciones/").json()
+                if s["id_variable"] in variables and s["id_equipo"] in equipos]
+    targets = cliente.post("/grafana/search", json={"target": ""}, name="/grafana/search").json()
+    return {
+        "variables": sorted({variables[s["id_variable"]]["simbolo"] for s in sensores}),
+        "equipos": sorted({equipos[s["id_equipo"]]["nombre"] for s in sensores}),
+        "sensores": [(variables[s["id_variable"]]["simbolo"], equipos[s["id_equipo"]]["nombre"]) for s in sensores],
+        "ids_sensores": [(s["id_equipo"], s["id_variable"]) for s in sensores],
+        "senales": [t.partition(":")[2] for t in targets if t.startswith("senal:")],
+        "consignas": [t.partition(":")[2] for t in targets if t.startswith("consigna_nombre:")],
+        "targets": targets,
+    }
+
+
+class UsuarioPlanta(HttpUser):
+    abstract = True
+    wait_time = between(1, 5)
+
+    def on_start(self):
+        if Carga.nombres is None:
+            Carga.nombres = leer_nombres(self.client)
+        self.nombres = Carga.nombres
+
+    def rango(self, rng):
+        desde, hasta = ventana(rng, Carga.inicio, Carga.fin)
+        return {"start_date": desde.isoformat(), "end_date": hasta.isoformat()}
+
+    def serie(self, rng, **parametros):
+        # Parámetros de una lectura de series como las de los paneles: rango, a veces reducida o en otro formato
+        parametros.update(self.rango(rng))
+        max_points = rng.choice(MAX_POINTS)
+        if max_points:
+            parametros["max_points"] = max_points
+        formato = rng.choice(FORMATOS)
+        if formato != "json":
+            parametros["formato"] = formato
+        return parametros
+
+    def get(self, ruta, variante, generar, **kwargs):
+        """GET de `ruta` con los parámetros del repertorio; las estadísticas se agrupan por ruta y variante."""
+        parametros = Carga.repertorio.elegir(f"{ruta} {variante}", generar)
+        return self.client.get(ruta, params=parametros, name=f"{ruta} [{variante}]", **kwargs)
+
+    def post(self, ruta, variante, generar, **kwargs):
+        cuerpo = Carga.repertorio.elegir(f"{ruta} {variante}", generar)
+        return self.client.post(ruta, json=cuerpo, name=f"{ruta} [{variante}]" if variante else ruta, **kwargs)
+
+
+class CatalogoUser(UsuarioPlanta):
+    weight = 1
+
+    @task(1)
+    def raiz(self):
+        self.client.get("/")
+
+    @task(2)
+    def variables(self):
+        self.client.get("/variables/")
+
+    @task(2)
+    def equipos(self):
+        self.client.get("/equipos/")
+
+    @task(1)
+    def relaciones(self):
+        self.client.get("/relaciones/")
+
+
+class GraficosUser(UsuarioPlanta):
+    """Las rutas de main.py: gráficos fijos, máximos y mínimos y medias mensuales."""
+    weight = 1
+
+    @task(1)
+    def grafico1(self):
+        self.get("/datos/grafico1/", "formato", lambda rng: {"formato": rng.choice(FORMATOS)})
+
+    @task(3)
+    def grafico2(self):
+        self.get("/datos/grafico2/", "rango", lambda rng: {
+            **self.rango(rng), "tolerancia": rng.choice([0, 30, 60]),
+            **({"relleno": rng.choice(["anterior", "lineal"])} if rng.random() < 0.3 else {}),
+        })
+
+    @task(2)
+    def maxmin(self):
+        # Sin rango recorre la tabla entera: los paneles siempre lo mandan
+        self.get("/datos/solidos_suspendidos_totales_maxmin/", "rango", self.rango)
+
+    @task(2)
+    def promedio_mes(self):
+        self.client.get("/datos/promedio_valores_mes/")
+
+    @task(2)
+    def promedio_grandes(self):
+        self.client.get("/datos/promedio_valores_grandes_mes/")
+
+
+class SensorUser(UsuarioPlanta):
+    weight = 3
+
+    @task(3)
+    def variable(self):
+        self.get("/datos/sensor/", "variable",
+                 lambda rng: self.serie(rng, variable=rng.choice(self.nombres["variables"])))
+
+    @task(2)
+    def equipo(self):
+        self.get("/datos/sensor/", "equipo", lambda rng: self.serie(rng, equipo=rng.choice(self.nombres["equipos"])))
+
+    @task(2)
+    def variables(self):
+        self.get("/datos/sensor/", "variables",
+                 lambda rng: self.serie(rng, variables=",".join(algunos(rng, self.nombres["variables"]))))
+
+    @task(1)
+    def equipos(self):
+        self.get("/datos/sensor/", "equipos",
+                 lambda rng: self.serie(rng, equipos=",".join(algunos(rng, self.nombres["equipos"]))))
+
+    @task(3)
+    def variable_equipo(self):
+        def generar(rng):
+            variable, equipo = rng.choice(self.nombres["sensores"])
+            return self.serie(rng, variable=variable, equipo=equipo)
+        self.get("/datos/sensor/", "variable y equipo", generar)
+
+
+class SenalUser(UsuarioPlanta):
+    weight = 1
+
+    @task(3)
+    def nombre(self):
+        if self.nombres["senales"]:
+            self.get("/datos/senal/", "nombre", lambda rng: self.serie(rng, nombre=rng.choice(self.nombres["senales"])))
+
+    @task(1)
+    def nombres_senal(self):
+        if self.nombres["senales"]:
+            self.get("/datos/senal/", "nombres",
+                     lambda rng: self.serie(rng, nombres=",".join(algunos(rng, self.nombres["senales"]))))
+
+
+class ConsignaUser(UsuarioPlanta):
+    weight = 2
+
+    def on_start(self):
+        super().on_start()
+        if not self.nombres["consignas"]:
+            logger.warning("Sin consignas en el catálogo: ConsignaUser no hace peticiones")
+
+    @task(3)
+    def nombre(self):
+        if self.nombres["consignas"]:
+            self.get("/datos/consigna/", "nombre",
+                     lambda rng: self.serie(rng, nombre=rng.choice(self.nombres["consignas"])))
+
+    @task(1)
+    def equipo(self):
+        self.get("/datos/consigna/", "equipo",
+                 lambda rng: self.serie(rng, equipo=rng.choice(self.nombres["equipos"])))
+
+    @task(1)
+    def nombres_consigna(self):
+        if self.nombres["consignas"]:
+            self.get("/datos/consigna/", "nombres",
+                     lambda rng: self.serie(rng, nombres=",".join(algunos(rng, self.nombres["consignas"]))))
+
+    @task(1)
+    def equipos(self):
+        self.get("/datos/consigna/", "equipos",
+                 lambda rng: self.serie(rng, equipos=",".join(algunos(rng, self.nombres["equipos"]))))
+
+    @task(2)
+    def porcentaje(self):
+        if self.nombres["consignas"]:
+            self.get("/datos/consigna/porcentaje", "nombre",
+                     lambda rng: {"nombre": rng.choice(self.nombres["consignas"]), **self.rango(rng)})
+
+    @task(2)
+    def avg_modo(self):
+        if self.nombres["consignas"]:
+            self.get("/datos/consigna/avg_modo", "nombre",
+                     lambda rng: {"nombre": rng.choice(self.nombres["consignas"]), **self.rango(rng)})
+
+
+class SensorVacioUser(UsuarioPlanta):
+    weight = 2
+
+    @task(3)
+    def serie_con_huecos(self):
+        def generar(rng):
+            variable, equipo = rng.choice(self.nombres["sensores"])
+            return {"variable": variable, "equipo": equipo, **self.rango(rng),
+                    "tipo": rng.choice(["timeseries", "barchart"]), "mode": rng.choice(["avg", "avg", "lttb", "m4"])}
+        with self.get("/datos/sensorvacio/", "variable y equipo", generar, catch_response=True) as respuesta:
+            # 404: rango sin datos suficientes, una respuesta válida
+            if respuesta.status_code == 404:
+                respuesta.success()
+
+    @task(1)
+    def heatmap(self):
+        def generar(rng):
+            variable, equipo = rng.choice(self.nombres["sensores"])
+            return {"variable": variable, "equipo": equipo, "year": rng.randint(Carga.inicio.year, Carga.fin.year)}
+        self.get("/datos/sensorvacio/heatmap", "variable y equipo", generar)
+
+
+class GrafanaUser(UsuarioPlanta):
+    """El datasource JSON de Grafana: cada refresco de un panel es una llamada a /query con todas sus series."""
+    weight = 3
+
+    def rango_grafana(self, rng):
+        # Grafana manda el rango en UTC; la API lo pasa a la hora local de los datos
+        desde, hasta = ventana(rng, Carga.inicio, Carga.fin)
+        return {"from": desde.astimezone(timezone.utc).isoformat(), "to": hasta.astimezone(timezone.utc).isoformat()}
+
+    @task(1)
+    def conexion(self):
+        self.client.get("/grafana/")
+
+    @task(1)
+    def search(self):
+        self.post("/grafana/search", "", lambda rng: {"target": rng.choice(["", "sensor", "senal", "consigna"])})
+
+    @task(6)
+    def query(self):
+        self.post("/grafana/query", "panel", lambda rng: {
+            "range": self.rango_grafana(rng),
+            "maxDataPoints": rng.choice([300, 1000, 2000]),
+            "intervalMs": rng.choice([15000, 60000, 300000]),
+            "targets": [{"target": t, "refId": chr(ord("A") + i), "type": rng.choice(["timeserie"] * 4 + ["table"])}
+                        for i, t in enumerate(algunos(rng, self.nombres["targets"]))],
+        })
+
+    @task(1)
+    def annotations(self):
+        if self.nombres["consignas"]:
+            self.post("/grafana/annotations", "", lambda rng: {
+                "range": self.rango_grafana(rng),
+                "annotation": {"name": "modos", "query": ",".join(algunos(rng, self.nombres["consignas"], 2))},
+            })
+
+
+class IngestUser(UsuarioPlanta):
+    """Lotes de lecturas de sensores de ahora mismo, en el formato por columnas."""
+    weight = PESO_INGESTA
+    wait_time = between(0.5, 2)
+
+    @task
+    def lote(self):
+        ids = self.nombres["ids_sensores"]
+        if not ids:
+            return
+        ahora = datetime.now().replace(microsecond=0)
+        sensores = [random.choice(ids) for _ in range(random.randint(1, 200))]
+        self.client.post("/ingest", name="/ingest", json={"sensor": {
+            "id_equipo": [e for e, _ in sensores],
+            "id_variable": [v for _, v in sensores],
+            "timestamp": [(ahora - timedelta(seconds=i)).isoformat() for i in range(len(sensores))],
+            "valor": [random.uniform(0, 10) for _ in sensores],
+        }})
+
+
+##############################################################################################################
+# Umbrales (SLO)
+##############################################################################################################
+
+
+def incumplidos(total, opciones):
+    """Umbrales de `opciones` que no cumplen las estadísticas agregadas de todas las peticiones."""
+    if not total.num_requests:
+        return ["no se ha completado ninguna petición"]
+    fallos = []
+    for percentil, limite in ((0.5, opciones.slo_p50), (0.95, opciones.slo_p95), (0.99, opciones.slo_p99)):
+        valor = total.get_response_time_percentile(percentil)
+        if limite and valor > limite:
+            fallos.append(f"p{percentil * 100:g} = {valor:.0f} ms > {limite:g} ms")
+    if total.fail_ratio > opciones.slo_errores:
+        fallos.append(f"errores = {total.fail_ratio:.2%} > {opciones.slo_errores:.2%}")
+    if opciones.slo_rps and total.total_rps < opciones.slo_rps:
+        fallos.append(f"rps = {total.total_rps:.1f} < {opciones.slo_rps:g}")
+    return fallos
+
+
+@events.quitting.add_listener
+def comprobar_slo(environment, **_):
+    # En modo distribuido solo el master tiene las estadísticas de todos los workers
+    if environment.parsed_options is None or isinstance(environment.runner, WorkerRunner):
+        return
+    fallos = incumplidos(environment.stats.total, environment.parsed_options)
+    for fallo in fallos:
+        logger.error("SLO incumplido: %s", fallo)
+    if fallos:
+        environment.process_exit_code = 1
+    else:
+        logger.info("SLO cumplidos")
@@ -0,0 +1,55 @@
+import random
+from datetime import datetime, timedelta
+
+# Datos que siembra loadtest.sembrar: DIAS días desde DESDE
+DESDE = datetime(2024, 1, 1)
+DIAS = 90
+
+# Duración de los rangos de fechas que piden los paneles -> peso: sobre todo la última hora, el día o la semana
+DURACIONES = {
+    timedelta(hours=1): 3,
+    timedelta(hours=6): 3,
+    timedelta(days=1): 4,
+    timedelta(days=7): 3,
+    timedelta(days=30): 2,
+    timedelta(days=90): 1,
+}
+# Peticiones distintas por endpoint que se repiten cuando toca un acierto de caché
+REPETIDAS = 20
+
+
+def ventana(rng, inicio, fin):
+    """Rango (desde, hasta) dentro de [inicio, fin], al segundo y con el final cerca de los datos más recientes."""
+    duracion = min(rng.choices(list(DURACIONES), weights=list(DURACIONES.values()))[0], fin - inicio)
+    holgura = (fin - inicio - duracion).total_seconds()
+    # El cubo concentra los finales en la parte reciente, como un panel con "últimas N horas"
+    hasta = fin - timedelta(seconds=int(holgura * rng.random() ** 3))
+    return hasta - duracion, hasta
+
+
+def algunos(rng, nombres, maximo=4):
+    return rng.sample(nombres, rng.randint(1, min(maximo, len(nombres))))
+
+
+class Repertorio:
+    """Decide si cada petición debe acertar en la caché de la API o no.
+
+    Con probabilidad `aciertos` se repite una de las `repetidas` peticiones fijas del endpoint, que tras la
+    primera vez está en caché; si no, se genera una nueva con un rango de fechas al segundo que no se repite.
+    """
+
+    def __init__(self, aciertos, repetidas=REPETIDAS, semilla=None):
+        self.aciertos = aciertos
+        self.repetidas = repetidas
+        self.fijas = {}  # endpoint -> {índice: petición}
+        self.rng = random.Random(semilla)
+
+    def elegir(self, nombre, generar):
+        """Parámetros o cuerpo de la petición de `nombre`; `generar(rng)` crea uno nuevo al azar."""
+        if self.rng.random() >= self.aciertos:
+            return generar(self.rng)
+        fijas = self.fijas.setdefault(nombre, {})
+        indice = self.rng.randrange(self.repetidas)
+        if indice not in fijas:
+            fijas[indice] = generar(self.rng)
+        return fijas[indice]
@@ -1,14 +1,25 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy import select, func, literal, extract, or_, and_
-from sqlalchemy.orm import Session
+from typing import Optional
+
+from fastapi import FastAPI, Depends, HTTPException, Request, Query
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.middleware.cors import CORSMiddleware
 
-from db.models import Variable, Equipo, Sensor, SensorDatos, SenalDatos, Senal, ValoresConsigna, Consigna
-from db.connector import get_db
-from routers import consigna, sensor, señal, sensorVacio
-from utils.security import RateLimitMiddleware
+from db.analitica import analitica
+from db.catalogo import Catalogo, catalogo, catalogo_al_dia, precargar
+from db.connector import get_async_db
+from routers import consigna, sensor, señal, sensorVacio, ingest, grafana
+from routers.consigna import query_consigna_by_nombres
+from routers.sensor import query_sensor_by_equipos, query_sensor_variable_by_equipo, query_sensor_max_min, \
+    consultar_promedio_mensual
+from routers.señal import query_senal_by_nombres
+from utils.alineacion import combinar, RELLENOS
+from utils.formatos import negociar_formato, responder_serie, responder_stream, FORMATOS_STREAMING
+from utils.security import RateLimitMiddleware, RATE_LIMIT_PER_IP, RATE_LIMIT_PER_PATH
+from utils.series import columnas_desde_filas, consultar_columnas, Rotulos, FechaLocal
 
 app = FastAPI()
+# El catálogo de series se carga al arrancar; las rutas que lo usan lo mantienen al día
+app.add_event_handler("startup", precargar)
 
 # Configuración de CORS
 app.add_middleware(
@@ -20,12 +31,15 @@ app.add_middleware(
 )
 
 
-app.add_middleware(RateLimitMiddleware, max_requests_per_minute=100, max_requests_total=100, path_limit=100)
+app.add_middleware(RateLimitMiddleware, max_requests_per_minute=RATE_LIMIT_PER_IP, max_requests_total=100,
+                   path_limit=RATE_LIMIT_PER_PATH)
 
 app.include_router(consigna.router)
 app.include_router(sensor.router)
 app.include_router(señal.router)
 app.include_router(sensorVacio.router)
+app.include_router(ingest.router)
+app.include_router(grafana.router)
 
 '''
 # CORS configuration
@@ -47,27 +61,24 @@ app.include_router(señal.router, dependencies=[Depends(get_current_user)])
 '''
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"HolaMundo": "Bienvenido a mi API"}
 
 
+# Las tablas de catálogo se sirven desde memoria
 @app.get("/variables/")
-def read_variables(db: Session = Depends(get_db)):
-    query = select(Variable).order_by(Variable.id)
-    variables = db.execute(query).scalars().all()
-    return variables
+async def read_variables(cat: Catalogo = Depends(catalogo_al_dia)):
+    return [cat.variables[id] for id in sorted(cat.variables)]
 
 
 @app.get("/equipos/")
-def read_equipos(db: Session = Depends(get_db)):
-    equipos = db.execute(select(Equipo)).scalars().all()
-    return equipos
+async def read_equipos(cat: Catalogo = Depends(catalogo_al_dia)):
+    return list(cat.equipos.values())
 
 
 @app.get("/relaciones/")
-def read_relaciones(db: Session = Depends(get_db)):
-    relaciones = db.execute(select(Sensor)).scalars().all()
-    return relaciones
+async def read_relaciones(cat: Catalogo = Depends(catalogo_al_dia)):
+    return list(cat.sensores.values())
 
 
 ##############################################################################################################
@@ -76,31 +87,11 @@ def read_relaciones(db: Session = Depends(get_db)):
 
 
 @app.get("/datos/solidos_suspendidos_totales_maxmin/")
-def read_solidos_suspendidos_totales_max_min(db: Session = Depends(get_db)):
+async def read_solidos_suspendidos_totales_max_min(start_date: Optional[FechaLocal] = None,
+                                                   end_date: Optional[FechaLocal] = None,
+                                                   db: AsyncSession = Depends(get_async_db)):
     try:
-        # Subconsulta para obtener min y max valores por timestamp
-        min_max_subquery = (
-            select(
-                SensorDatos.timestamp,
-                func.min(SensorDatos.valor).label('min_valor'),
-                func.max(SensorDatos.valor).label('max_valor')
-            )
-            .group_by(SensorDatos.timestamp)
-            .subquery()
-        )
-
-        # Consulta principal uniendo con la subconsulta para obtener los valores originales
-        query = (
-            select(
-                SensorDatos.timestamp,
-                SensorDatos.valor,
-                min_max_subquery.c.min_valor,
-                min_max_subquery.c.max_valor
-            )
-            .join(min_max_subquery, min_max_subquery.c.timestamp == SensorDatos.timestamp)
-        )
-
-        resultados = db.execute(query).fetchall()
+        resultados = await analitica.ejecutar(db, query_sensor_max_min(start_date, end_date))
         datos = [
             {"timestamp": r.timestamp, "valor": r.valor, "min_valor": r.min_valor, "max_valor": r.max_valor}
             for r in resultados
@@ -111,24 +102,12 @@ def read_solidos_suspendidos_totales_max_min(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error al completar la consulta: {str(e)}")
 
 
-@app.get("/datos/promedio_valores_mes/")
-def read_promedio_valores_mes(db: Session = Depends(get_db)):
+@app.get("/datos/promedio_valores_mes/", dependencies=[Depends(catalogo_al_dia)])
+async def read_promedio_valores_mes(db: AsyncSession = Depends(get_async_db)):
     try:
-        query = (
-            select(
-                Variable.descripcion.label('metric'),
-                func.avg(SensorDatos.valor).label('average_value'),
-                func.concat(Equipo.nombre, literal(', ('), Variable.u_medida, literal(')')).label('equipo'),
-                extract('year', SensorDatos.timestamp).label('year'),
-                extract('month', SensorDatos.timestamp).label('month')
-            )
-            .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-            .join(Variable, Sensor.id_variable == Variable.id)
-            .join(Equipo, Sensor.id_equipo == Equipo.id)
-            .where(Variable.descripcion.in_(['Amonio', 'Nitrato', 'Oxígeno Disuelto', 'Sólidos Suspendidos Totales']))
-            .group_by(Equipo.nombre, Variable.u_medida, Variable.descripcion, 'year', 'month')
+        resultados = await consultar_promedio_mensual(
+            db, ['Amonio', 'Nitrato', 'Oxígeno Disuelto', 'Sólidos Suspendidos Totales']
         )
-        resultados = db.execute(query).fetchall()
         datos = [
             {"metric": r.metric, "average_value": r.average_value, "equipo": r.equipo, "year": r.year, "month": r.month}
             for r in resultados]
@@ -137,24 +116,10 @@ def read_promedio_valores_mes(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error al completar la query: {str(e)}")
 
 
-@app.get("/datos/promedio_valores_grandes_mes/")
-def read_promedio_valores_grandes(db: Session = Depends(get_db)):
+@app.get("/datos/promedio_valores_grandes_mes/", dependencies=[Depends(catalogo_al_dia)])
+async def read_promedio_valores_grandes(db: AsyncSession = Depends(get_async_db)):
     try:
-        query = (
-            select(
-                Variable.descripcion.label('metric'),
-                func.avg(SensorDatos.valor).label('average_value'),
-                func.concat(Equipo.nombre, literal(', ('), Variable.u_medida, literal(')')).label('equipo'),
-                extract('year', SensorDatos.timestamp).label('year'),
-                extract('month', SensorDatos.timestamp).label('month')
-            )
-            .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-            .join(Variable, Sensor.id_variable == Variable.id)
-            .join(Equipo, Sensor.id_equipo == Equipo.id)
-            .where(Variable.descripcion.in_(['Caudal de aire', 'Caudal de agua', 'Temperatura']))
-            .group_by(Equipo.nombre, Variable.u_medida, Variable.descripcion, 'year', 'month')
-        )
-        resultados = db.execute(query).fetchall()
+        resultados = await consultar_promedio_mensual(db, ['Caudal de aire', 'Caudal de agua', 'Temperatura'])
         datos = [
             {"metric": r.metric, "average_value": r.average_value, "equipo": r.equipo, "year": r.year, "month": r.month}
             for r in resultados]
@@ -163,100 +128,49 @@ def read_promedio_valores_grandes(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error al completar la query: {str(e)}")
 
 
-@app.get("/datos/grafico1/")
-def read_grafico1(db: Session = Depends(get_db)):
+ROTULOS_GRAFICO1 = Rotulos(("variable",), lambda id_equipo, id_variable: (catalogo.variables[id_variable].simbolo,))
+
+
+@app.get("/datos/grafico1/", dependencies=[Depends(catalogo_al_dia)])
+async def read_grafico1(request: Request, formato: Optional[str] = None, db: AsyncSession = Depends(get_async_db)):
+    formato = negociar_formato(request, formato)
     try:
-        query = (
-            select(
-                SensorDatos.timestamp.label('time'),
-                SensorDatos.valor.label('value'),
-                Variable.simbolo.label('variable')
-            )
-            .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-            .join(Variable, Sensor.id_variable == Variable.id)
-            .join(Equipo, Sensor.id_equipo == Equipo.id)
-            .where(or_(Equipo.nombre == 'AER.COMB', Equipo.nombre == 'AER.DO'))
-            .order_by(SensorDatos.timestamp.asc())
-        )
-        resultados = db.execute(query).fetchall()
-        datos = [{"time": r.time, "value": r.value, "variable": r.variable} for r in resultados]
-        return datos
+        query = query_sensor_by_equipos(['AER.COMB', 'AER.DO'])
+        if formato in FORMATOS_STREAMING:
+            return responder_stream(query, formato, rotulos=ROTULOS_GRAFICO1)
+        datos = columnas_desde_filas(await db.execute(query), rotulos=ROTULOS_GRAFICO1)
+        return responder_serie(datos, formato)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al completar la query: {str(e)}")
 
 
-@app.get("/datos/grafico2/")
-def read_grafico2(db: Session = Depends(get_db)):
+# Series del gráfico 2; NH4 y DO son obligatorias, como en el JOIN interno de la consulta original
+SERIES_GRAFICO2 = {
+    "NH4_Value": lambda desde, hasta: query_sensor_variable_by_equipo("NH4", "AER.COMB", desde, hasta),
+    "DO_Value": lambda desde, hasta: query_sensor_variable_by_equipo("DO", "AER.DO", desde, hasta),
+    "NNH4_FILT": lambda desde, hasta: query_senal_by_nombres(["NNH4_FILT"], desde, hasta),
+    "DO_SP": lambda desde, hasta: query_consigna_by_nombres(["DO_SP"], desde, hasta),
+}
+
+
+@app.get("/datos/grafico2/", dependencies=[Depends(catalogo_al_dia)])
+async def read_grafico2(request: Request, start_date: Optional[FechaLocal] = None,
+                        end_date: Optional[FechaLocal] = None, tolerancia: int = Query(30, ge=0),
+                        relleno: Optional[str] = None, formato: Optional[str] = None):
+    """Las cuatro series del gráfico alineadas sobre los instantes de NH4.
+
+    Cada serie se lee una sola vez (en paralelo) y se une en memoria con la muestra más cercana a menos de
+    `tolerancia` segundos, así un desfase pequeño entre sensores no hace perder filas. `relleno` (anterior o
+    lineal) completa los huecos de las series opcionales.
+    """
+    formato = negociar_formato(request, formato)
+    if relleno is not None and relleno not in RELLENOS:
+        raise HTTPException(status_code=400, detail=f"Relleno no válido, debe ser uno de {', '.join(RELLENOS)}")
     try:
-        subquery_senal = (
-            select(
-                SenalDatos.timestamp.label('time'),
-                SenalDatos.valor.label('NNH4_FILT'),
-            )
-            .join(Senal, SenalDatos.id_señal == Senal.id)
-            .where(Senal.nombre.__eq__('NNH4_FILT'))
-            .subquery()
-        )
-
-        subquery_setpoint = (
-            select(
-                ValoresConsigna.timestamp.label('time'),
-                ValoresConsigna.valor.label('DO_SP'),
-            )
-            .join(Consigna, ValoresConsigna.id_consigna == Consigna.id)
-            .where(Consigna.nombre.__eq__('DO_SP'))
-            .subquery()
-        )
-
-        nh4_query = (
-            select(
-                SensorDatos.timestamp.label('time'),
-                SensorDatos.valor.label('NH4_Value'),
-            )
-            .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-            .join(Variable, Sensor.id_variable == Variable.id)
-            .join(Equipo, Sensor.id_equipo == Equipo.id)
-            .where(and_(Equipo.nombre == 'AER.COMB', Variable.simbolo == 'NH4'))
-            .subquery()
-        )
-
-        do_query = (
-            select(
-                SensorDatos.timestamp.label('time'),
-                SensorDatos.valor.label('DO_Value'),
-            )
-            .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-            .join(Variable, Sensor.id_variable == Variable.id)
-            .join(Equipo, Sensor.id_equipo == Equipo.id)
-            .where(and_(Equipo.nombre == 'AER.DO', Variable.simbolo == 'DO'))
-            .subquery()
-        )
-
-        query = (
-            select(
-                nh4_query.c.time,
-                nh4_query.c.NH4_Value,
-                do_query.c.DO_Value,
-                subquery_senal.c.NNH4_FILT,
-                subquery_setpoint.c.DO_SP,
-            )
-            .join(do_query, nh4_query.c.time == do_query.c.time)
-            .join(subquery_senal, nh4_query.c.time == subquery_senal.c.time, isouter=True)
-            .join(subquery_setpoint, nh4_query.c.time == subquery_setpoint.c.time, isouter=True)
-            .order_by(nh4_query.c.time.asc())
-        )
-
-        resultados = db.execute(query).fetchall()
-        datos = [
-            {
-                "time": r.time,
-                "NH4_Value": r.NH4_Value,
-                "DO_Value": r.DO_Value,
-                "NNH4_FILT": r.NNH4_FILT,
-                "DO_SP": r.DO_SP
-            }
-            for r in resultados
-        ]
-        return datos
+        series = await consultar_columnas({nombre: consulta(start_date, end_date)
+                                           for nombre, consulta in SERIES_GRAFICO2.items()})
+        datos = combinar(series, base="NH4_Value", tolerancia=tolerancia, relleno=relleno,
+                         requeridas=("NH4_Value", "DO_Value"))
+        return responder_serie(datos, formato)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al completar la query: {str(e)}")
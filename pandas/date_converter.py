@@ -1,49 +1,83 @@
-import pandas as pd
-
-# Lee el archivo CSV
-df = pd.read_csv('../datos/Sensor_values.csv')
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-# Convierte la columna de fecha a datetime
-df['timestamp'] = pd.to_datetime(df['timestamp'])
+import pandas as pd
 
-# Elimina las filas con fechas en 2024
-df = df[df['timestamp'].dt.year != 2024]
+DATOS = Path(__file__).resolve().parent.parent / "datos"
+FICHEROS = [DATOS / "Sensor_values.csv", DATOS / "Setpoint_values.csv", DATOS / "Filtered_values.csv"]
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
 
-# Actualiza las fechas en 2023 a 2024
-df.loc[df['timestamp'].dt.year == 2023, 'timestamp'] = df['timestamp'].apply(
-    lambda x: x.replace(year=2024)
-)
 
-# Guarda el DataFrame modificado en un nuevo archivo CSV
-df.to_csv('../datos/Sensor_values.csv', index=False)
+def rebasar_bloque(df, columna, origen, destino, conservar_destino=False):
+    """Pasa las fechas del año `origen` al año `destino` (29 de febrero -> 28 si el destino no es bisiesto).
 
-df = pd.read_csv('../datos/Setpoint_values.csv')
-# Convierte la columna de fecha a datetime
-df['timestamp'] = pd.to_datetime(df['timestamp'])
+    Salvo `conservar_destino`, las filas que ya estaban en el año destino se eliminan, como hacía el script
+    original, para que no se dupliquen con las desplazadas.
+    """
+    fechas = pd.to_datetime(df[columna], format="ISO8601")
+    if not conservar_destino:
+        df, fechas = df[fechas.dt.year != destino], fechas[fechas.dt.year != destino]
+    en_origen = fechas.dt.year == origen
+    # Desplazamiento vectorizado de toda la columna, sin recorrer las filas
+    fechas = fechas.where(~en_origen, fechas + pd.DateOffset(years=destino - origen))
+    return df.assign(**{columna: fechas})
 
-# Elimina las filas con fechas en 2024
-df = df[df['timestamp'].dt.year != 2024]
 
-# Actualiza las fechas en 2023 a 2024
-df.loc[df['timestamp'].dt.year == 2023, 'timestamp'] = df['timestamp'].apply(
-    lambda x: x.replace(year=2024)
-)
+def rebasar_fichero(ruta, origen, destino, columna="timestamp", chunk=500000, salida=None, conservar_destino=False):
+    """Rebasa un CSV por bloques y lo escribe de forma atómica (fichero temporal + os.replace)."""
+    ruta = Path(ruta)
+    salida = Path(salida) if salida else ruta
+    inicio = time.monotonic()
+    filas = 0
 
-# Guarda el DataFrame modificado en un nuevo archivo CSV
-df.to_csv('../datos/Setpoint_values.csv', index=False)
+    # El temporal va en el mismo directorio para que os.replace no cruce sistemas de ficheros
+    descriptor, temporal = tempfile.mkstemp(dir=salida.parent, prefix=f".{salida.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w", newline="") as destino_csv:
+            # Solo se interpreta la columna de fechas: el resto se copia tal cual, como texto
+            for i, bloque in enumerate(pd.read_csv(ruta, chunksize=chunk, dtype=str, keep_default_na=False)):
+                bloque = rebasar_bloque(bloque, columna, origen, destino, conservar_destino)
+                bloque.to_csv(destino_csv, index=False, header=i == 0, date_format=FORMATO_FECHA)
+                filas += len(bloque)
+        shutil.copymode(ruta, temporal)  # mkstemp crea el fichero con permisos 0600
+        os.replace(temporal, salida)
+    except BaseException:
+        os.unlink(temporal)
+        raise
+    return str(salida), filas, time.monotonic() - inicio
 
 
-df = pd.read_csv('../datos/Filtered_values.csv')
-# Convierte la columna de fecha a datetime
-df['timestamp'] = pd.to_datetime(df['timestamp'])
+def main():
+    parser = argparse.ArgumentParser(description="Cambia el año de los timestamps de los CSV exportados.")
+    parser.add_argument("ficheros", nargs="*", default=[str(f) for f in FICHEROS],
+                        help="CSV a rebasar (por defecto los tres de datos/).")
+    parser.add_argument("--origen", type=int, required=True, help="Año de las fechas a desplazar.")
+    parser.add_argument("--destino", type=int, required=True, help="Año al que se desplazan.")
+    parser.add_argument("--columna", default="timestamp")
+    parser.add_argument("--chunk", type=int, default=500000, help="Filas leídas por bloque.")
+    parser.add_argument("--procesos", type=int, default=None, help="Ficheros procesados en paralelo.")
+    parser.add_argument("--salida", help="Directorio de salida; por defecto se sobrescriben los ficheros.")
+    parser.add_argument("--conservar-destino", action="store_true",
+                        help="No eliminar las filas que ya están en el año destino.")
+    args = parser.parse_args()
+    if args.salida:
+        Path(args.salida).mkdir(parents=True, exist_ok=True)
 
-# Elimina las filas con fechas en 2024
-df = df[df['timestamp'].dt.year != 2024]
+    with ProcessPoolExecutor(max_workers=args.procesos) as pool:
+        tareas = [
+            pool.submit(rebasar_fichero, ruta, args.origen, args.destino, args.columna, args.chunk,
+                        Path(args.salida) / Path(ruta).name if args.salida else None, args.conservar_destino)
+            for ruta in args.ficheros
+        ]
+        for tarea in tareas:
+            salida, filas, segundos = tarea.result()
+            print(f"{salida}: {filas} filas en {segundos:.1f} s")
 
-# Actualiza las fechas en 2023 a 2024
-df.loc[df['timestamp'].dt.year == 2023, 'timestamp'] = df['timestamp'].apply(
-    lambda x: x.replace(year=2024)
-)
 
-# Guarda el DataFrame modificado en un nuevo archivo CSV
-df.to_csv('../datos/Filtered_values.csv', index=False)
+if __name__ == "__main__":
+    main()
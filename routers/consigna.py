@@ -1,34 +1,32 @@
 from typing import Optional
-from fastapi import Depends, HTTPException, APIRouter, status
-from sqlalchemy.orm import Session
+from fastapi import Depends, HTTPException, APIRouter, status, Query, Request
 from sqlalchemy import select, func
-from db.connector import get_db
+from db.analitica import analitica
+from db.catalogo import catalogo, catalogo_al_dia
 from db.models import *
-from db.redis_client import set_cached_response, get_cached_response
-from datetime import datetime
+from db.redis_client import cacheado, etiquetas_de
+from utils.agregacion import reducir_serie
+from utils.formatos import negociar_formato, responder_cacheado
+from utils.series import leer_series, Rotulos, FechaLocal
 
 router = APIRouter(
     prefix="/datos/consigna",
     tags=["consigna"],
     responses={status.HTTP_404_NOT_FOUND: {"message": "No encontrado"}},
+    dependencies=[Depends(catalogo_al_dia)],
 )
 
 
-def read_datos_consigna_by_nombre(db, consigna, start_date=None, end_date=None):
-    cache_key = f"datos_consigna_{consigna}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
-
+def query_consigna_datos(consignas, start_date=None, end_date=None):
+    """Lectura directa por clave primaria (id_consigna, timestamp) de las `consignas`, sin joins."""
     query = (
         select(
-            Consigna.nombre.label('consigna'),
-            ValoresConsigna.valor.label('value'),
             ValoresConsigna.timestamp.label('time'),
-            ValoresConsigna.mode.label('mode')
+            ValoresConsigna.valor.label('value'),
+            ValoresConsigna.mode.label('mode'),
+            ValoresConsigna.id_consigna
         )
-        .join(Consigna, ValoresConsigna.id_consigna == Consigna.id)
-        .where(Consigna.nombre == consigna)
+        .where(ValoresConsigna.id_consigna.in_(consignas))
         .order_by(ValoresConsigna.timestamp.asc())
     )
 
@@ -36,99 +34,129 @@ def read_datos_consigna_by_nombre(db, consigna, start_date=None, end_date=None):
         query = query.where(ValoresConsigna.timestamp >= start_date)
     if end_date:
         query = query.where(ValoresConsigna.timestamp <= end_date)
+    return query
 
-    resultados = db.execute(query).fetchall()
-    datos = [{"time": r.time, "value": r.value, "mode": r.mode, "consigna": r.consigna} for r in resultados]
 
-    set_cached_response(cache_key, datos)
-    return datos
+def query_consigna_by_nombres(nombres, start_date=None, end_date=None):
+    return query_consigna_datos(catalogo.consignas_por_nombre(nombres), start_date, end_date)
 
 
-def read_datos_consigna_by_equipo(db, equipo, start_date=None, end_date=None):
-    cache_key = f"datos_consigna_{equipo}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
+def query_consigna_by_equipos(equipos, start_date=None, end_date=None):
+    return query_consigna_datos(catalogo.consignas_de_equipos(equipos), start_date, end_date)
 
-    query = (
-        select(
-            Consigna.nombre.label('consigna'),
-            ValoresConsigna.valor.label('value'),
-            ValoresConsigna.timestamp.label('time'),
-            ValoresConsigna.mode.label('mode')
-        )
-        .join(Consigna, ValoresConsigna.id_consigna == Consigna.id)
-        .join(Equipo, Consigna.id_equipo == Equipo.id)
-        .where(Equipo.nombre == equipo)
-        .order_by(ValoresConsigna.timestamp.asc())
+
+ROTULOS_CONSIGNA_BY_NOMBRES = Rotulos(
+    ("consigna", "clave"),
+    lambda id_consigna: (catalogo.consignas[id_consigna].nombre, catalogo.consignas[id_consigna].nombre)
+)
+ROTULOS_CONSIGNA_BY_EQUIPOS = Rotulos(
+    ("consigna", "clave"),
+    lambda id_consigna: (catalogo.consignas[id_consigna].nombre,
+                         catalogo.equipos[catalogo.consignas[id_consigna].id_equipo].nombre)
+)
+
+
+async def read_series_consigna_by_nombres(db, nombre_list, start_date=None, end_date=None, max_points=None,
+                                          interval=None):
+    return await leer_series(
+        db, nombre_list, "consigna_nombre", query_consigna_by_nombres, start_date, end_date,
+        lambda datos: reducir_serie(datos, ("consigna",), max_points, interval, ultimos=("mode",)),
+        ROTULOS_CONSIGNA_BY_NOMBRES
     )
 
-    if start_date:
-        query = query.where(ValoresConsigna.timestamp >= start_date)
-    if end_date:
-        query = query.where(ValoresConsigna.timestamp <= end_date)
 
-    resultados = db.execute(query).fetchall()
-    datos = [{"time": r.time, "value": r.value, "mode": r.mode, "consigna":  r.consigna} for r in resultados]
+async def read_series_consigna_by_equipos(db, equipo_list, start_date=None, end_date=None, max_points=None,
+                                          interval=None):
+    return await leer_series(
+        db, equipo_list, "consigna_equipo", query_consigna_by_equipos, start_date, end_date,
+        lambda datos: reducir_serie(datos, ("consigna",), max_points, interval, ultimos=("mode",)),
+        ROTULOS_CONSIGNA_BY_EQUIPOS
+    )
 
-    set_cached_response(cache_key, datos)
-    return datos
 
+async def read_datos_consigna_by_nombre(db, consigna, start_date=None, end_date=None, max_points=None, interval=None):
+    datos = await read_series_consigna_by_nombres(db, [consigna], start_date, end_date, max_points, interval)
+    return datos[consigna]
 
-def read_consigna_multiple_by_nombre(db, nombres, start_date=None, end_date=None):
-    consigna_list = nombres.split(',')
-    all_data = {}
-    for consigna in consigna_list:
-        data = read_datos_consigna_by_nombre(db, consigna, start_date, end_date)
-        all_data[consigna] = data
-    return all_data
 
+async def read_datos_consigna_by_equipo(db, equipo, start_date=None, end_date=None, max_points=None, interval=None):
+    datos = await read_series_consigna_by_equipos(db, [equipo], start_date, end_date, max_points, interval)
+    return datos[equipo]
 
-def read_consigna_multiple_by_equipo(db, equipos, start_date=None, end_date=None):
-    equipo_list = equipos.split(',')
-    all_data = {}
-    for equipo in equipo_list:
-        data = read_datos_consigna_by_equipo(db, equipo, start_date, end_date)
-        all_data[equipo] = data
-    return all_data
+
+async def read_consigna_multiple_by_nombre(db, nombres, start_date=None, end_date=None, max_points=None,
+                                           interval=None):
+    return await read_series_consigna_by_nombres(db, nombres.split(','), start_date, end_date, max_points, interval)
+
+
+async def read_consigna_multiple_by_equipo(db, equipos, start_date=None, end_date=None, max_points=None,
+                                           interval=None):
+    return await read_series_consigna_by_equipos(db, equipos.split(','), start_date, end_date, max_points, interval)
 
 
 @router.get("/")
-def datos_condicionales_consigna(
+async def datos_condicionales_consigna(
+        request: Request,
         nombre: Optional[str] = None,
         nombres: Optional[str] = None,
         equipo: Optional[str] = None,
         equipos: Optional[str] = None,
-        start_date: Optional[datetime] = None,
-        end_date: Optional[datetime] = None,
-        db: Session = Depends(get_db)
+        start_date: Optional[FechaLocal] = None,
+        end_date: Optional[FechaLocal] = None,
+        max_points: Optional[int] = Query(None, ge=1),
+        interval: Optional[int] = Query(None, ge=1),
+        formato: Optional[str] = None
 ):
+    formato = negociar_formato(request, formato)
+    # Sin reducción la respuesta es la consulta en bruto, que en NDJSON/CSV se emite en streaming
+    reducir = max_points or interval
     if nombre and not equipo and not nombres and not equipos:
-        return read_datos_consigna_by_nombre(db, nombre, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_datos_consigna_by_nombre(sesion, nombre, start_date, end_date, max_points, interval),
+            hasta=end_date, etiquetas=etiquetas_de("consigna_nombre", [nombre]),
+            consulta=None if reducir else query_consigna_by_nombres([nombre], start_date, end_date),
+            rotulos=ROTULOS_CONSIGNA_BY_NOMBRES
+        )
     elif equipo and not nombre and not nombres and not equipos:
-        return read_datos_consigna_by_equipo(db, equipo, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_datos_consigna_by_equipo(sesion, equipo, start_date, end_date, max_points, interval),
+            hasta=end_date, etiquetas=etiquetas_de("consigna_equipo", [equipo]),
+            consulta=None if reducir else query_consigna_by_equipos([equipo], start_date, end_date),
+            rotulos=ROTULOS_CONSIGNA_BY_EQUIPOS
+        )
     elif nombres and not equipo and not nombre and not equipos:
-        return read_consigna_multiple_by_nombre(db, nombres, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_consigna_multiple_by_nombre(sesion, nombres, start_date, end_date,
+                                                            max_points, interval),
+            multiple=True,
+            hasta=end_date, etiquetas=etiquetas_de("consigna_nombre", nombres.split(',')),
+            consulta=None if reducir else query_consigna_by_nombres(nombres.split(','), start_date, end_date),
+            rotulos=ROTULOS_CONSIGNA_BY_NOMBRES
+        )
     elif equipos and not equipo and not nombre and not nombres:
-        return read_consigna_multiple_by_equipo(db, equipos, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_consigna_multiple_by_equipo(sesion, equipos, start_date, end_date,
+                                                            max_points, interval),
+            multiple=True,
+            hasta=end_date, etiquetas=etiquetas_de("consigna_equipo", equipos.split(',')),
+            consulta=None if reducir else query_consigna_by_equipos(equipos.split(','), start_date, end_date),
+            rotulos=ROTULOS_CONSIGNA_BY_EQUIPOS
+        )
     else:
         raise HTTPException(status_code=400, detail="Debe proporcionar los datos de forma correcta.")
 
 
-@router.get("/porcentaje")
-def porcentaje_mode(db: Session = Depends(get_db), nombre=None, start_date=None, end_date=None):
-    cache_key = f"porcentaje_{nombre}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
-
+async def calcular_porcentaje_mode(db, nombre, start_date=None, end_date=None):
     base_query = (
         select(
             func.count(ValoresConsigna.id_consigna).label('count'),
             ValoresConsigna.mode
         )
-        .join(Consigna, ValoresConsigna.id_consigna == Consigna.id)
-        .where(Consigna.nombre == nombre)
+        .where(ValoresConsigna.id_consigna.in_(catalogo.consignas_por_nombre([nombre])))
         .group_by(ValoresConsigna.mode)
     )
 
@@ -137,7 +165,7 @@ def porcentaje_mode(db: Session = Depends(get_db), nombre=None, start_date=None,
     if end_date:
         base_query = base_query.where(ValoresConsigna.timestamp <= end_date)
 
-    resultados = db.execute(base_query).fetchall()
+    resultados = await analitica.ejecutar(db, base_query)
 
     total_count = sum(r.count for r in resultados)
     count_mode_1 = sum(r.count for r in resultados if r.mode == 1)
@@ -151,27 +179,24 @@ def porcentaje_mode(db: Session = Depends(get_db), nombre=None, start_date=None,
         "Automatico": f"{percentage_mode_1:.2f}%",
         "Manual": f"{percentage_mode_0:.2f}%"
     }
-
-    set_cached_response(cache_key, datos)
     return datos
 
 
-@router.get("/avg_modo")
-def get_avg_modo(db: Session = Depends(get_db), nombre: str = None, start_date: str = None, end_date: str = None):
-    cache_key = f"avg_modo_{nombre}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
+@router.get("/porcentaje")
+async def porcentaje_mode(nombre=None, start_date: Optional[FechaLocal] = None, end_date: Optional[FechaLocal] = None):
+    cache_key = f"porcentaje_{nombre}_{start_date}_{end_date}"
+    return await cacheado(cache_key, lambda sesion: calcular_porcentaje_mode(sesion, nombre, start_date, end_date),
+                          hasta=end_date, etiquetas=etiquetas_de("consigna_nombre", [nombre]))
+
 
+async def calcular_avg_modo(db, nombre, start_date=None, end_date=None):
     base_query = (
         select(
             func.avg(ValoresConsigna.valor).label('avg'),
-            Consigna.nombre.label('consigna'),
             ValoresConsigna.mode.label('mode')
         )
-        .join(Consigna, ValoresConsigna.id_consigna == Consigna.id)
-        .where(Consigna.nombre == nombre)
-        .group_by(Consigna.nombre, ValoresConsigna.mode)
+        .where(ValoresConsigna.id_consigna.in_(catalogo.consignas_por_nombre([nombre])))
+        .group_by(ValoresConsigna.mode)
     )
 
     if start_date:
@@ -179,7 +204,7 @@ def get_avg_modo(db: Session = Depends(get_db), nombre: str = None, start_date:
     if end_date:
         base_query = base_query.where(ValoresConsigna.timestamp <= end_date)
 
-    resultados = db.execute(base_query).fetchall()
+    resultados = await analitica.ejecutar(db, base_query)
 
     # Crear un diccionario para verificar modos presentes
     modos_presentes = {r.mode: r for r in resultados}
@@ -199,6 +224,12 @@ def get_avg_modo(db: Session = Depends(get_db), nombre: str = None, start_date:
             "consigna": nombre,
             "mode": mode_str
         })
-
-    set_cached_response(cache_key, datos)
     return datos
+
+
+@router.get("/avg_modo")
+async def get_avg_modo(nombre: str = None, start_date: Optional[FechaLocal] = None,
+                       end_date: Optional[FechaLocal] = None):
+    cache_key = f"avg_modo_{nombre}_{start_date}_{end_date}"
+    return await cacheado(cache_key, lambda sesion: calcular_avg_modo(sesion, nombre, start_date, end_date),
+                          hasta=end_date, etiquetas=etiquetas_de("consigna_nombre", [nombre]))
@@ -0,0 +1,186 @@
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import Depends, HTTPException, APIRouter, status
+from pydantic import BaseModel, Field
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import connector
+from db.catalogo import Catalogo, catalogo_al_dia
+from db.connector import get_async_db
+from routers.consigna import read_series_consigna_by_nombres, read_series_consigna_by_equipos
+from routers.sensor import read_series_sensor_by_variables, read_series_sensor_by_equipos
+from routers.señal import read_series_senal_by_nombres
+from utils.formatos import responder_json
+from utils.series import hora_local
+
+# API del datasource SimpleJSON / JSON de Grafana: un panel pide todas sus series en una sola llamada a /query
+router = APIRouter(
+    prefix="/grafana",
+    tags=["grafana"],
+    responses={status.HTTP_404_NOT_FOUND: {"message": "No encontrado"}},
+    dependencies=[Depends(catalogo_al_dia)],
+)
+
+# Los targets son "tipo:clave", p. ej. "sensor_variable:NH4" o "senal:NNH4_FILT".
+# tipo -> (lectura de varias series, campos que separan cada serie en varias líneas del panel)
+TIPOS = {
+    "sensor_variable": (read_series_sensor_by_variables, ("equipo",)),
+    "sensor_equipo": (read_series_sensor_by_equipos, ("variable",)),
+    "senal": (read_series_senal_by_nombres, ()),
+    "consigna_nombre": (read_series_consigna_by_nombres, ()),
+    "consigna_equipo": (read_series_consigna_by_equipos, ("consigna",)),
+}
+MODOS = {0: "MANUAL", 1: "AUTO"}
+
+
+class Rango(BaseModel):
+    desde: datetime = Field(alias="from")
+    hasta: datetime = Field(alias="to")
+
+
+class Target(BaseModel):
+    target: str = ""
+    refId: Optional[str] = None
+    type: str = "timeserie"
+    hide: bool = False
+
+
+class PeticionQuery(BaseModel):
+    range: Rango
+    intervalMs: Optional[int] = None
+    maxDataPoints: Optional[int] = None
+    targets: List[Target]
+
+
+class PeticionSearch(BaseModel):
+    target: str = ""
+
+
+class PeticionAnotaciones(BaseModel):
+    range: Rango
+    annotation: dict
+
+
+def partir_target(target):
+    tipo, _, clave = target.partition(":")
+    if tipo not in TIPOS or not clave:
+        raise HTTPException(status_code=400,
+                            detail=f"Target no válido: '{target}', debe ser tipo:clave con tipo en {', '.join(TIPOS)}")
+    return tipo, clave
+
+
+def lineas(columnas, campos):
+    """Índices de las filas de cada línea del panel, una por combinación de valores de `campos`."""
+    if not campos:
+        return {(): range(len(columnas["time"]))}
+    grupos = {}
+    for i, etiquetas in enumerate(zip(*(columnas[c] for c in campos))):
+        grupos.setdefault(etiquetas, []).append(i)
+    return grupos
+
+
+def a_milisegundos(tiempos):
+    return [int(t.timestamp() * 1000) for t in tiempos]
+
+
+def respuesta_timeserie(clave, columnas, campos):
+    respuesta = []
+    for etiquetas, indices in lineas(columnas, campos).items():
+        tiempos = a_milisegundos([columnas["time"][i] for i in indices])
+        valores = [columnas["value"][i] for i in indices]
+        respuesta.append({"target": " - ".join((clave, *map(str, etiquetas))),
+                          "datapoints": list(zip(valores, tiempos))})
+    return respuesta
+
+
+def respuesta_tabla(columnas, campos):
+    return [{
+        "type": "table",
+        "columns": [{"text": "Time", "type": "time"}, {"text": "Value", "type": "number"},
+                    *({"text": campo, "type": "string"} for campo in campos)],
+        "rows": list(zip(a_milisegundos(columnas["time"]), columnas["value"], *(columnas[c] for c in campos))),
+    }]
+
+
+async def leer_tipo(tipo, claves, desde, hasta, max_points, interval):
+    # Cada tipo con su propia sesión: las consultas van en paralelo, cada una con una conexión del pool
+    async with connector.AsyncSessionLocal() as db:
+        return tipo, await TIPOS[tipo][0](db, claves, desde, hasta, max_points, interval)
+
+
+@router.get("/")
+async def probar_conexion():
+    # Grafana llama a la raíz al guardar el datasource
+    return {"status": "ok"}
+
+
+def targets_del_catalogo(cat):
+    variables = sorted(v.simbolo for v in cat.variables.values() if v.simbolo)
+    equipos = sorted(e.nombre for e in cat.equipos.values() if e.nombre)
+    senales = sorted(s.nombre for s in cat.senales.values() if s.nombre)
+    consignas = sorted(c.nombre for c in cat.consignas.values() if c.nombre)
+    return ([f"sensor_variable:{v}" for v in variables] + [f"sensor_equipo:{e}" for e in equipos]
+            + [f"senal:{s}" for s in senales] + [f"consigna_nombre:{c}" for c in consignas]
+            + [f"consigna_equipo:{e}" for e in equipos])
+
+
+@router.post("/search")
+async def search(peticion: PeticionSearch, cat: Catalogo = Depends(catalogo_al_dia)):
+    return [t for t in targets_del_catalogo(cat) if peticion.target.lower() in t.lower()]
+
+
+@router.post("/query")
+async def query(peticion: PeticionQuery):
+    """Todas las series de un panel en una llamada.
+
+    Los targets del mismo tipo se leen con una única consulta y los distintos tipos en paralelo. Con
+    `maxDataPoints` el ancho de los buckets lo elige calcular_delta_prima, así la respuesta trae como mucho
+    los puntos que caben en el panel; si solo llega `intervalMs` se agrupa con ese intervalo.
+    """
+    targets = [(t, *partir_target(t.target)) for t in peticion.targets if not t.hide and t.target]
+    desde, hasta = hora_local(peticion.range.desde), hora_local(peticion.range.hasta)
+    max_points = peticion.maxDataPoints
+    interval = None if max_points or not peticion.intervalMs else max(peticion.intervalMs // 1000, 1)
+
+    por_tipo = {}
+    for _, tipo, clave in targets:
+        por_tipo.setdefault(tipo, []).append(clave)
+    leidas = dict(await asyncio.gather(*(leer_tipo(tipo, claves, desde, hasta, max_points, interval)
+                                         for tipo, claves in por_tipo.items())))
+
+    respuesta = []
+    for target, tipo, clave in targets:
+        columnas, campos = leidas[tipo][clave], TIPOS[tipo][1]
+        if target.type == "table":
+            respuesta.extend(respuesta_tabla(columnas, campos))
+        else:
+            respuesta.extend(respuesta_timeserie(clave, columnas, campos))
+    return responder_json(respuesta)
+
+
+@router.post("/annotations")
+async def annotations(peticion: PeticionAnotaciones, db: AsyncSession = Depends(get_async_db)):
+    """Cambios de modo (AUTO/MANUAL) de las consignas de `annotation.query`, separadas por comas."""
+    nombres = [n.strip() for n in peticion.annotation.get("query", "").split(",") if n.strip()]
+    if not nombres:
+        return []
+    series = await read_series_consigna_by_nombres(db, nombres, hora_local(peticion.range.desde),
+                                                   hora_local(peticion.range.hasta))
+
+    anotaciones = []
+    for nombre, columnas in series.items():
+        anterior = None
+        for t, modo in zip(columnas["time"], columnas["mode"]):
+            if anterior is not None and modo != anterior:
+                anotaciones.append({
+                    "annotation": peticion.annotation,
+                    "time": int(t.timestamp() * 1000),
+                    "title": f"{nombre}: {MODOS.get(modo, modo)}",
+                    "text": f"Cambio de {MODOS.get(anterior, anterior)} a {MODOS.get(modo, modo)}",
+                    "tags": ["consigna", nombre],
+                })
+            anterior = modo
+    anotaciones.sort(key=lambda a: a["time"])
+    return responder_json(anotaciones)
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import List, Optional, Union
+
+from fastapi import APIRouter, HTTPException, status
+from pydantic import BaseModel
+from sqlalchemy.exc import InterfaceError, OperationalError, StatementError
+
+from db import connector
+from db.catalogo import catalogo as catalogo_series
+from db.cargador import TABLAS, sentencia_upsert
+from db.redis_client import invalidar
+from db.rollups import ROLLUPS, actualizar_rollups
+from utils.series import hora_local
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/ingest",
+    tags=["ingest"],
+    responses={status.HTTP_404_NOT_FOUND: {"message": "No encontrado"}},
+)
+
+# Se escribe al juntar INGESTA_LOTE lecturas o cada INGESTA_INTERVALO segundos, lo que llegue antes
+INGESTA_LOTE = int(os.getenv("INGESTA_LOTE", 5000))
+INGESTA_INTERVALO = float(os.getenv("INGESTA_INTERVALO", 1))
+# Con INGESTA_CAPACIDAD lecturas pendientes las peticiones esperan hasta INGESTA_ESPERA segundos y después 503
+INGESTA_CAPACIDAD = int(os.getenv("INGESTA_CAPACIDAD", 100000))
+INGESTA_ESPERA = float(os.getenv("INGESTA_ESPERA", 5))
+# Los rollups de lo escrito se recalculan como mucho cada INGESTA_ROLLUP_INTERVALO segundos
+INGESTA_ROLLUP_INTERVALO = float(os.getenv("INGESTA_ROLLUP_INTERVALO", 60))
+
+
+##############################################################################################################
+# Formato de los lotes: una lista de lecturas o, más compacto, una lista por columna
+##############################################################################################################
+
+
+class LecturaSensor(BaseModel):
+    id_equipo: int
+    id_variable: int
+    timestamp: datetime
+    valor: Optional[float] = None
+
+
+class LecturaSenal(BaseModel):
+    id_señal: int
+    timestamp: datetime
+    valor: Optional[float] = None
+
+
+class LecturaConsigna(BaseModel):
+    id_consigna: int
+    timestamp: datetime
+    valor: Optional[float] = None
+    mode: Optional[int] = None
+
+
+class ColumnasSensor(BaseModel):
+    id_equipo: List[int]
+    id_variable: List[int]
+    timestamp: List[datetime]
+    valor: List[Optional[float]]
+
+
+class ColumnasSenal(BaseModel):
+    id_señal: List[int]
+    timestamp: List[datetime]
+    valor: List[Optional[float]]
+
+
+class ColumnasConsigna(BaseModel):
+    id_consigna: List[int]
+    timestamp: List[datetime]
+    valor: List[Optional[float]]
+    mode: Optional[List[Optional[int]]] = None
+
+
+class Lote(BaseModel):
+    sensor: Union[List[LecturaSensor], ColumnasSensor] = []
+    senal: Union[List[LecturaSenal], ColumnasSenal] = []
+    consigna: Union[List[LecturaConsigna], ColumnasConsigna] = []
+
+
+def filas_lote(lecturas):
+    if isinstance(lecturas, list):
+        filas = [lectura.model_dump() for lectura in lecturas]
+    else:
+        columnas = {campo: valores for campo, valores in lecturas.model_dump().items() if valores is not None}
+        if len({len(valores) for valores in columnas.values()}) > 1:
+            raise HTTPException(status_code=422, detail="Las columnas del lote deben tener la misma longitud.")
+        # Las columnas que faltan van a None como en las lecturas por filas: todas las filas de un mismo
+        # executemany tienen que traer las mismas claves
+        vacia = dict.fromkeys(type(lecturas).model_fields)
+        filas = [{**vacia, **dict(zip(columnas, fila))} for fila in zip(*columnas.values())]
+    for fila in filas:
+        fila["timestamp"] = hora_local(fila["timestamp"])
+    return filas
+
+
+##############################################################################################################
+# Catálogo de series válidas, con las etiquetas de caché que invalida cada una
+##############################################################################################################
+
+_series = {"cargado": None, "series": {}}
+
+
+async def catalogo():
+    """tipo -> {ids de la serie: etiquetas de caché}, derivado del catálogo en memoria cada vez que se recarga."""
+    await catalogo_series.actualizar()
+    if _series["cargado"] != catalogo_series.cargado:
+        _series["series"] = catalogo_series.etiquetas_series()
+        _series["cargado"] = catalogo_series.cargado
+    return _series["series"]
+
+
+def ids_serie(tipo, fila):
+    return tuple(fila[columna] for columna in ROLLUPS[tipo][2])
+
+
+async def validar(lote):
+    series = await catalogo()
+    desconocidas = {tipo: sorted({ids_serie(tipo, fila) for fila in filas} - series[tipo].keys())
+                    for tipo, filas in lote.items()}
+    desconocidas = {tipo: ids for tipo, ids in desconocidas.items() if ids}
+    if desconocidas:
+        raise HTTPException(status_code=422, detail={"series_desconocidas": desconocidas})
+
+
+##############################################################################################################
+# Buffer en memoria con volcado por tamaño o por tiempo
+##############################################################################################################
+
+# Una lectura sin mode no borra el mode ya guardado de ese instante
+CONSERVAR = {"consigna": ("mode",)}
+
+
+def descartable(error):
+    # Errores del propio lote (datos, parámetros): fallan igual al reintentar. Los de conexión, bloqueos o
+    # timeouts (OperationalError, InterfaceError, Redis...) sí se reintentan
+    return isinstance(error, StatementError) and not isinstance(error, (OperationalError, InterfaceError))
+
+
+class BufferIngesta:
+    """Lecturas pendientes de escribir, por tipo.
+
+    Un único volcador las escribe con INSERT ... ON DUPLICATE KEY UPDATE de varias filas, una transacción por
+    tipo, e invalida la caché de las series afectadas. Si el buffer está lleno las peticiones esperan a que
+    se vacíe (contrapresión) y, si no lo hace a tiempo, reciben un 503.
+    """
+
+    def __init__(self):
+        self.filas = {tipo: [] for tipo in TABLAS}
+        self.pendientes = 0  # incluye las que se están escribiendo
+        self.cambio = asyncio.Condition()
+        self.volcador = None
+        self.rollups = {}  # tipo -> [desde, hasta, series] pendientes de recalcular
+        self.etiquetas = set()
+        self.ultimo_rollup = time.monotonic()
+
+    async def añadir(self, lote):
+        n = sum(len(filas) for filas in lote.values())
+        if n > INGESTA_CAPACIDAD:
+            raise HTTPException(status_code=413, detail=f"Un lote no puede tener más de {INGESTA_CAPACIDAD} lecturas.")
+        if self.volcador is None or self.volcador.done():
+            self.volcador = asyncio.create_task(self._bucle())
+
+        async with self.cambio:
+            try:
+                await asyncio.wait_for(self.cambio.wait_for(lambda: self.pendientes + n <= INGESTA_CAPACIDAD),
+                                       INGESTA_ESPERA)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=503, detail="Buffer de ingesta lleno, reintentar más tarde.",
+                                    headers={"Retry-After": "1"})
+            for tipo, filas in lote.items():
+                self.filas[tipo].extend(filas)
+            self.pendientes += n
+            if self.pendientes >= INGESTA_LOTE:
+                self.cambio.notify_all()
+            return self.pendientes
+
+    async def _bucle(self):
+        while True:
+            async with self.cambio:
+                try:
+                    await asyncio.wait_for(self.cambio.wait_for(lambda: self.pendientes >= INGESTA_LOTE),
+                                           INGESTA_INTERVALO)
+                except asyncio.TimeoutError:
+                    pass
+            if not await self.volcar():
+                await asyncio.sleep(INGESTA_INTERVALO)
+
+    async def volcar(self, forzar_rollups=False):
+        """Escribe todo lo pendiente; devuelve False si la escritura ha fallado y las lecturas siguen en el buffer."""
+        async with self.cambio:
+            lote, self.filas = self.filas, {tipo: [] for tipo in TABLAS}
+        n = sum(len(filas) for filas in lote.values())
+
+        if n:
+            fallidas = {}
+            for tipo, filas in lote.items():
+                if not filas:
+                    continue
+                try:
+                    await self._escribir(tipo, filas)
+                except Exception as error:
+                    if descartable(error):
+                        # Reintentarlo fallaría igual y dejaría el buffer bloqueado con 503 para siempre
+                        logger.exception("Error no recuperable escribiendo %s lecturas de %s; se descartan",
+                                         len(filas), tipo)
+                    else:
+                        # Se reintenta en el siguiente volcado (el upsert es idempotente); mientras, el buffer se llena
+                        logger.exception("Error escribiendo %s lecturas de %s; se reintentará", len(filas), tipo)
+                        fallidas[tipo] = filas
+            async with self.cambio:
+                for tipo, filas in fallidas.items():
+                    self.filas[tipo][:0] = filas
+                self.pendientes -= n - sum(len(filas) for filas in fallidas.values())
+                self.cambio.notify_all()
+            if fallidas:
+                return False
+
+        if self.rollups and (forzar_rollups or time.monotonic() - self.ultimo_rollup >= INGESTA_ROLLUP_INTERVALO):
+            await self._recalcular_rollups()
+        return True
+
+    async def _escribir(self, tipo, filas):
+        async with connector.AsyncSessionLocal() as db:
+            await db.execute(sentencia_upsert(TABLAS[tipo][0], CONSERVAR.get(tipo, ())), filas)
+            await db.commit()
+
+        series = {ids_serie(tipo, fila) for fila in filas}
+        desde = min(fila["timestamp"] for fila in filas)
+        hasta = max(fila["timestamp"] for fila in filas)
+        pendiente = self.rollups.setdefault(tipo, [desde, hasta, set()])
+        pendiente[0], pendiente[1] = min(pendiente[0], desde), max(pendiente[1], hasta)
+        pendiente[2] |= series
+
+        catalogo_tipo = (await catalogo())[tipo]
+        etiquetas = {etiqueta for serie in series for etiqueta in catalogo_tipo.get(serie, [])}
+        self.etiquetas |= etiquetas
+        await invalidar(etiquetas)
+
+    async def _recalcular_rollups(self):
+        pendientes, self.rollups = self.rollups, {}
+        etiquetas, self.etiquetas = self.etiquetas, set()
+        self.ultimo_rollup = time.monotonic()
+        try:
+            async with connector.AsyncSessionLocal() as db:
+                for tipo, (desde, hasta, series) in pendientes.items():
+                    await actualizar_rollups(db, tipo, desde, hasta, sorted(series))
+            # Las respuestas calculadas desde los rollups antiguos dejan de valer
+            await invalidar(etiquetas)
+        except Exception:
+            # `python -m db.rollups` recalcula desde la marca de agua si esto no llega a hacerse
+            logger.exception("Error recalculando los rollups de la ingesta")
+
+    async def cerrar(self):
+        if self.volcador is not None:
+            self.volcador.cancel()
+        await self.volcar(forzar_rollups=True)
+
+
+buffer = BufferIngesta()
+router.add_event_handler("shutdown", buffer.cerrar)
+
+
+@router.post("", status_code=status.HTTP_202_ACCEPTED)
+async def ingest(lote: Lote):
+    filas = {tipo: filas_lote(getattr(lote, tipo)) for tipo in TABLAS}
+    filas = {tipo: f for tipo, f in filas.items() if f}
+    if not filas:
+        raise HTTPException(status_code=400, detail="El lote no contiene lecturas.")
+    await validar(filas)
+    pendientes = await buffer.añadir(filas)
+    return {"aceptadas": sum(len(f) for f in filas.values()), "pendientes": pendientes}
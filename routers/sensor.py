@@ -1,35 +1,34 @@
+import asyncio
 from typing import Optional
-from fastapi import Depends, HTTPException, APIRouter, status
-from sqlalchemy.orm import Session
-from sqlalchemy import select
-from db.connector import get_db
+from fastapi import Depends, HTTPException, APIRouter, status, Query, Request
+from sqlalchemy import select, tuple_, func, literal, extract
+from db.analitica import analitica
+from db.catalogo import catalogo, catalogo_al_dia
 from db.models import *
-from db.redis_client import set_cached_response, get_cached_response
-from datetime import datetime
+from db.redis_client import cacheado, etiquetas_de
+from db.rollups import cobertura_de, query_buckets, query_cobertura
+from utils.agregacion import reducir_serie
+from utils.formatos import negociar_formato, responder_cacheado
+from utils.series import leer_series, columnas_desde_filas, Rotulos, FechaLocal
 
 router = APIRouter(
     prefix="/datos/sensor",
     tags=["sensor"],
     responses={status.HTTP_404_NOT_FOUND: {"message": "No encontrado"}},
+    dependencies=[Depends(catalogo_al_dia)],
 )
 
 
-def read_datos_sensor_by_variable(db, variable, start_date=None, end_date=None):
-    cache_key = f"datos_sensor_{variable}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
-
+def query_sensor_datos(sensores, start_date=None, end_date=None):
+    """Lectura directa por clave primaria (id_equipo, id_variable, timestamp) de los `sensores`, sin joins."""
     query = (
         select(
             SensorDatos.timestamp.label('time'),
             SensorDatos.valor.label('value'),
-            Equipo.descripcion.label('equipo')
+            SensorDatos.id_equipo,
+            SensorDatos.id_variable
         )
-        .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-        .join(Variable, Sensor.id_variable == Variable.id)
-        .join(Equipo, Sensor.id_equipo == Equipo.id)
-        .where(Variable.simbolo == variable)
+        .where(tuple_(SensorDatos.id_equipo, SensorDatos.id_variable).in_(sensores))
         .order_by(SensorDatos.timestamp.asc())
     )
 
@@ -37,116 +36,212 @@ def read_datos_sensor_by_variable(db, variable, start_date=None, end_date=None):
         query = query.where(SensorDatos.timestamp >= start_date)
     if end_date:
         query = query.where(SensorDatos.timestamp <= end_date)
+    return query
 
-    resultados = db.execute(query).fetchall()
-    datos = [{"time": r.time, "value": r.value, "equipo": r.equipo} for r in resultados]
 
-    set_cached_response(cache_key, datos)
-    return datos
+def query_sensor_by_variables(variables, start_date=None, end_date=None):
+    return query_sensor_datos(catalogo.sensores_de_variables(variables), start_date, end_date)
 
 
-def read_datos_sensor_by_equipo(db, equipo, start_date=None, end_date=None):
-    cache_key = f"datos_sensor_{equipo}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
+def query_sensor_by_equipos(equipos, start_date=None, end_date=None):
+    return query_sensor_datos(catalogo.sensores_de_equipos(equipos), start_date, end_date)
 
-    query = (
-        select(
-            SensorDatos.timestamp.label('time'),
-            SensorDatos.valor.label('value'),
-            Variable.simbolo.label('variable'),
-            Equipo.descripcion.label('equipo')
-        )
-        .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-        .join(Variable, Sensor.id_variable == Variable.id)
-        .join(Equipo, Sensor.id_equipo == Equipo.id)
-        .where(Equipo.nombre == equipo)
-        .order_by(SensorDatos.timestamp.asc())
-    )
 
+def query_sensor_variable_by_equipo(variable, equipo, start_date=None, end_date=None):
+    sensor = catalogo.sensor(variable, equipo)
+    return query_sensor_datos([(sensor.id_equipo, sensor.id_variable)] if sensor else [], start_date, end_date)
+
+
+def query_sensor_max_min(start_date=None, end_date=None):
+    """Cada lectura con el mínimo y el máximo de todos los sensores en su mismo instante.
+
+    La subconsulta agrupa por `timestamp` con el índice (timestamp, valor) y, con rango de fechas, solo lee las
+    particiones de esos meses.
+    """
+    min_max_subquery = select(
+        SensorDatos.timestamp,
+        func.min(SensorDatos.valor).label('min_valor'),
+        func.max(SensorDatos.valor).label('max_valor')
+    )
+    query = select(SensorDatos.timestamp, SensorDatos.valor)
     if start_date:
+        min_max_subquery = min_max_subquery.where(SensorDatos.timestamp >= start_date)
         query = query.where(SensorDatos.timestamp >= start_date)
     if end_date:
+        min_max_subquery = min_max_subquery.where(SensorDatos.timestamp <= end_date)
         query = query.where(SensorDatos.timestamp <= end_date)
+    min_max_subquery = min_max_subquery.group_by(SensorDatos.timestamp).subquery()
 
-    resultados = db.execute(query).fetchall()
-    datos = [{"time": r.time, "value": r.value, "variable": r.variable, "equipo": r.equipo} for r in resultados]
-
-    set_cached_response(cache_key, datos)
-    return datos
-
-
-def read_datos_sensor_multiple_by_variable(db, variables, start_date=None, end_date=None):
-    variable_list = variables.split(',')
-    all_data = {}
-    for variable in variable_list:
-        data = read_datos_sensor_by_variable(db, variable, start_date, end_date)
-        all_data[variable] = data
-    return all_data
-
+    return (
+        query.add_columns(min_max_subquery.c.min_valor, min_max_subquery.c.max_valor)
+        .join(min_max_subquery, min_max_subquery.c.timestamp == SensorDatos.timestamp)
+    )
 
-def read_datos_sensor_multiple_by_equipos(db, equipos, start_date=None, end_date=None):
-    equipo_list = equipos.split(',')
-    all_data = {}
-    for equipo in equipo_list:
-        data = read_datos_sensor_by_equipo(db, equipo, start_date, end_date)
-        all_data[equipo] = data
-    return all_data
 
+def series_de_descripciones(descripciones):
+    return [(id_equipo, id_variable) for id_equipo, id_variable in catalogo.sensores
+            if catalogo.variables[id_variable].descripcion in descripciones]
 
-def read_datos_sensor_variable_by_equipo(db, variable, equipo, start_date=None, end_date=None):
-    cache_key = f"datos_sensor_{variable}_{equipo}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
 
-    query = (
+def query_promedio_mensual(series, cobertura):
+    # Medias mensuales desde el rollup diario y, donde aún no lo cubre (ver db.rollups.query_buckets), desde
+    # sensor_datos. Sin funciones propias de MySQL: la concatenación de textos se compila según el motor de
+    # db.analitica
+    buckets = query_buckets("sensor", 86400, series, cobertura).subquery()
+    return (
         select(
-            SensorDatos.timestamp.label('time'),
-            SensorDatos.valor.label('value'),
-            Variable.simbolo.label('variable'),
-            Equipo.descripcion.label('equipo')
+            Variable.descripcion.label('metric'),
+            (func.sum(buckets.c.suma) / func.sum(buckets.c.cuenta)).label('average_value'),
+            (Equipo.nombre + literal(', (') + Variable.u_medida + literal(')')).label('equipo'),
+            extract('year', buckets.c.bucket).label('year'),
+            extract('month', buckets.c.bucket).label('month')
         )
-        .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
+        .join(Sensor, (buckets.c.id_equipo == Sensor.id_equipo) & (buckets.c.id_variable == Sensor.id_variable))
         .join(Variable, Sensor.id_variable == Variable.id)
         .join(Equipo, Sensor.id_equipo == Equipo.id)
-        .where((Variable.simbolo == variable) & (Equipo.nombre == equipo))
-        .order_by(SensorDatos.timestamp.asc())
+        .group_by(Equipo.nombre, Variable.u_medida, Variable.descripcion, 'year', 'month')
     )
 
-    if start_date:
-        query = query.where(SensorDatos.timestamp >= start_date)
-    if end_date:
-        query = query.where(SensorDatos.timestamp <= end_date)
 
-    resultados = db.execute(query).fetchall()
-    datos = [{"time": r.time, "value": r.value, "variable": r.variable, "equipo": r.equipo} for r in resultados]
+async def consultar_promedio_mensual(db, descripciones):
+    series = series_de_descripciones(descripciones)
+    cobertura = cobertura_de(await analitica.ejecutar(db, query_cobertura("sensor", 86400, series)), "sensor")
+    return await analitica.ejecutar(db, query_promedio_mensual(series, cobertura))
 
-    set_cached_response(cache_key, datos)
-    return datos
+
+# Los mismos campos que daban los joins con variable y equipo, puestos una vez por serie desde el catálogo
+ROTULOS_SENSOR_BY_VARIABLES = Rotulos(
+    ("equipo", "clave"),
+    lambda id_equipo, id_variable: (catalogo.equipos[id_equipo].descripcion, catalogo.variables[id_variable].simbolo)
+)
+ROTULOS_SENSOR_BY_EQUIPOS = Rotulos(
+    ("variable", "equipo", "clave"),
+    lambda id_equipo, id_variable: (catalogo.variables[id_variable].simbolo, catalogo.equipos[id_equipo].descripcion,
+                                    catalogo.equipos[id_equipo].nombre)
+)
+ROTULOS_SENSOR_VARIABLE_BY_EQUIPO = Rotulos(
+    ("variable", "equipo"),
+    lambda id_equipo, id_variable: (catalogo.variables[id_variable].simbolo, catalogo.equipos[id_equipo].descripcion)
+)
+
+
+async def read_series_sensor_by_variables(db, variable_list, start_date=None, end_date=None, max_points=None,
+                                          interval=None):
+    return await leer_series(
+        db, variable_list, "sensor_variable", query_sensor_by_variables, start_date, end_date,
+        lambda datos: reducir_serie(datos, ("equipo",), max_points, interval), ROTULOS_SENSOR_BY_VARIABLES
+    )
+
+
+async def read_series_sensor_by_equipos(db, equipo_list, start_date=None, end_date=None, max_points=None,
+                                        interval=None):
+    return await leer_series(
+        db, equipo_list, "sensor_equipo", query_sensor_by_equipos, start_date, end_date,
+        lambda datos: reducir_serie(datos, ("variable", "equipo"), max_points, interval), ROTULOS_SENSOR_BY_EQUIPOS
+    )
+
+
+async def read_datos_sensor_by_variable(db, variable, start_date=None, end_date=None, max_points=None, interval=None):
+    datos = await read_series_sensor_by_variables(db, [variable], start_date, end_date, max_points, interval)
+    return datos[variable]
+
+
+async def read_datos_sensor_by_equipo(db, equipo, start_date=None, end_date=None, max_points=None, interval=None):
+    datos = await read_series_sensor_by_equipos(db, [equipo], start_date, end_date, max_points, interval)
+    return datos[equipo]
+
+
+async def read_datos_sensor_multiple_by_variable(db, variables, start_date=None, end_date=None, max_points=None,
+                                                 interval=None):
+    return await read_series_sensor_by_variables(db, variables.split(','), start_date, end_date, max_points, interval)
+
+
+async def read_datos_sensor_multiple_by_equipos(db, equipos, start_date=None, end_date=None, max_points=None,
+                                                interval=None):
+    return await read_series_sensor_by_equipos(db, equipos.split(','), start_date, end_date, max_points, interval)
+
+
+async def consultar_sensor_variable_by_equipo(db, variable, equipo, start_date=None, end_date=None, max_points=None,
+                                              interval=None):
+    query = query_sensor_variable_by_equipo(variable, equipo, start_date, end_date)
+    datos = columnas_desde_filas(await db.execute(query), rotulos=ROTULOS_SENSOR_VARIABLE_BY_EQUIPO)
+    return await asyncio.to_thread(reducir_serie, datos, ("variable", "equipo"), max_points, interval)
+
+
+async def read_datos_sensor_variable_by_equipo(variable, equipo, start_date=None, end_date=None, max_points=None,
+                                               interval=None):
+    cache_key = f"datos_sensor_{variable}_{equipo}_{start_date}_{end_date}_{max_points}_{interval}"
+    return await cacheado(
+        cache_key,
+        lambda sesion: consultar_sensor_variable_by_equipo(sesion, variable, equipo, start_date, end_date, max_points,
+                                                           interval),
+        hasta=end_date, etiquetas=etiquetas_de("sensor_variable", [variable]) + etiquetas_de("sensor_equipo", [equipo])
+    )
 
 
 @router.get("/")
-def datos_condicionales_sensor(
+async def datos_condicionales_sensor(
+        request: Request,
         variable: Optional[str] = None,
         variables: Optional[str] = None,
         equipo: Optional[str] = None,
         equipos: Optional[str] = None,
-        start_date: Optional[datetime] = None,
-        end_date: Optional[datetime] = None,
-        db: Session = Depends(get_db)
+        start_date: Optional[FechaLocal] = None,
+        end_date: Optional[FechaLocal] = None,
+        max_points: Optional[int] = Query(None, ge=1),
+        interval: Optional[int] = Query(None, ge=1),
+        formato: Optional[str] = None
 ):
+    formato = negociar_formato(request, formato)
+    # Sin reducción la respuesta es la consulta en bruto, que en NDJSON/CSV se emite en streaming
+    reducir = max_points or interval
     if variable and not equipo and not variables and not equipos:
-        return read_datos_sensor_by_variable(db, variable, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_datos_sensor_by_variable(sesion, variable, start_date, end_date, max_points,
+                                                         interval),
+            hasta=end_date, etiquetas=etiquetas_de("sensor_variable", [variable]),
+            consulta=None if reducir else query_sensor_by_variables([variable], start_date, end_date),
+            rotulos=ROTULOS_SENSOR_BY_VARIABLES
+        )
     elif equipo and not variable and not variables and not equipos:
-        return read_datos_sensor_by_equipo(db, equipo, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_datos_sensor_by_equipo(sesion, equipo, start_date, end_date, max_points, interval),
+            hasta=end_date, etiquetas=etiquetas_de("sensor_equipo", [equipo]),
+            consulta=None if reducir else query_sensor_by_equipos([equipo], start_date, end_date),
+            rotulos=ROTULOS_SENSOR_BY_EQUIPOS
+        )
     elif variables and not variable and not equipo and not equipos:
-        return read_datos_sensor_multiple_by_variable(db, variables, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_datos_sensor_multiple_by_variable(sesion, variables, start_date, end_date,
+                                                                  max_points, interval),
+            multiple=True,
+            hasta=end_date, etiquetas=etiquetas_de("sensor_variable", variables.split(',')),
+            consulta=None if reducir else query_sensor_by_variables(variables.split(','), start_date, end_date),
+            rotulos=ROTULOS_SENSOR_BY_VARIABLES
+        )
     elif equipos and not variable and not variables and not equipo:
-        return read_datos_sensor_multiple_by_equipos(db, equipos, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_datos_sensor_multiple_by_equipos(sesion, equipos, start_date, end_date,
+                                                                 max_points, interval),
+            multiple=True,
+            hasta=end_date, etiquetas=etiquetas_de("sensor_equipo", equipos.split(',')),
+            consulta=None if reducir else query_sensor_by_equipos(equipos.split(','), start_date, end_date),
+            rotulos=ROTULOS_SENSOR_BY_EQUIPOS
+        )
     elif variable and equipo and not variables and not equipos:
-        return read_datos_sensor_variable_by_equipo(db, variable, equipo, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_datos_sensor_variable_by_equipo(variable, equipo, start_date, end_date, max_points,
+                                                                interval),
+            hasta=end_date,
+            etiquetas=etiquetas_de("sensor_variable", [variable]) + etiquetas_de("sensor_equipo", [equipo]),
+            consulta=None if reducir else query_sensor_variable_by_equipo(variable, equipo, start_date, end_date),
+            rotulos=ROTULOS_SENSOR_VARIABLE_BY_EQUIPO
+        )
     elif not variable and not variables and not equipo and not equipos:
         raise HTTPException(status_code=400, detail="Debe proporcionar al menos un parámetro.")
     else:
@@ -1,95 +1,155 @@
+import asyncio
 from collections import defaultdict
 from typing import Optional
-from fastapi import Depends, HTTPException, APIRouter, status
-from sqlalchemy.orm import Session
-from sqlalchemy import select, extract, func
-from db.connector import get_db
+from fastapi import Depends, HTTPException, APIRouter, status, Request
+from sqlalchemy import select, tuple_
+from db.analitica import analitica
+from db.catalogo import catalogo, catalogo_al_dia
 from db.models import *
-from db.redis_client import set_cached_response, get_cached_response
+from db.redis_client import cacheado, etiquetas_de
+from db.rollups import elegir_resolucion, cobertura_de, query_buckets, query_cobertura
 from utils.agregacion import *
-from datetime import datetime
+from datetime import date, datetime
 from utils.date_checker import date_validator
+from utils.formatos import negociar_formato, responder_cacheado
 from utils.gap_generator import generar_huecos
+from utils.series import FechaLocal
 
 router = APIRouter(
     prefix="/datos/sensorvacio",
     tags=["sensorvacio"],
     responses={status.HTTP_404_NOT_FOUND: {"message": "No encontrado"}},
+    dependencies=[Depends(catalogo_al_dia)],
 )
 
 
-def read_datos_sensor_by_variable(db, variable, equipo, start_date=None, end_date=None, tipo=None):
-    cache_key = f"datos_sensor_{variable}_{equipo}_{start_date}_{end_date}_{tipo}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
-
-    query = (
+async def consultar_datos_sensor_by_variable(db, variable, equipo, start_date=None, end_date=None, tipo=None,
+                                             mode="avg"):
+    sensor = catalogo.sensor(variable, equipo)
+    query = filtrar_sensor(
         select(
             SensorDatos.timestamp.label('time'),
-            SensorDatos.valor.label('value'),
-            Equipo.descripcion.label('equipo'),
-            Sensor.deltat.label('deltat')
+            SensorDatos.valor.label('value')
         )
-        .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-        .join(Variable, Sensor.id_variable == Variable.id)
-        .join(Equipo, Sensor.id_equipo == Equipo.id)
-        .where(Variable.simbolo == variable)
-        .where(Equipo.nombre == equipo)
-        .order_by(SensorDatos.timestamp.asc())
+        .order_by(SensorDatos.timestamp.asc()),
+        SensorDatos, variable, equipo
     )
 
     # Gestión de fechas de la consulta
     query = date_validator(query, end_date, start_date)
 
+    # Si el ancho de agregación lo permite, se responde desde un rollup en lugar de sensor_datos
+    if mode == "avg":
+        datos_finales = await agregacion_rollup(db, variable, equipo, start_date, end_date, tipo)
+        if datos_finales:
+            return datos_finales
+
     # Ejecutar la consulta y obtener los resultados
-    resultados = db.execute(query).fetchall()
-    datos = [{"time": r.time, "value": r.value, "equipo": r.equipo} for r in resultados]
+    resultados = (await db.execute(query)).fetchall()
+    if not resultados:
+        # Sin datos, o sin ese sensor: la ruta lo devuelve como 404
+        raise IndexError("No hay datos suficientes.")
+    nombre_equipo = catalogo.equipos[sensor.id_equipo].descripcion
+    # Cálculo en Python puro: en un hilo, para no bloquear el resto de peticiones del worker
+    return await asyncio.to_thread(agregar_filas, resultados, sensor.deltat, nombre_equipo, tipo, mode)
 
-    nombre_equipo = datos[0]['equipo']
-    deltat = resultados[0].deltat
 
+def agregar_filas(resultados, deltat, nombre_equipo, tipo, mode):
+    datos = [{"time": r.time, "value": r.value, "equipo": nombre_equipo} for r in resultados]
     datos_with_gaps, huecos_info = generar_huecos(datos)
+    return agregacion(datos, datos_with_gaps, deltat, huecos_info, nombre_equipo, tipo, mode)
 
-    datos_finales = agregacion(datos, datos_with_gaps, deltat, huecos_info, nombre_equipo, tipo)
 
-    set_cached_response(cache_key, datos_finales)
-
-    return datos_finales
+async def read_datos_sensor_by_variable(variable, equipo, start_date=None, end_date=None, tipo=None, mode="avg"):
+    cache_key = f"datos_sensor_{variable}_{equipo}_{start_date}_{end_date}_{tipo}_{mode}"
+    return await cacheado(
+        cache_key,
+        lambda sesion: consultar_datos_sensor_by_variable(sesion, variable, equipo, start_date, end_date, tipo, mode),
+        hasta=end_date, etiquetas=etiquetas_de("sensor_variable", [variable]) + etiquetas_de("sensor_equipo", [equipo])
+    )
 
 
-def agregacion(datos, datos_with_gaps, deltat, huecos_info, nombre_equipo, tipo):
+async def agregacion_rollup(db, variable, equipo, start_date, end_date, tipo):
+    sensor = catalogo.sensor(variable, equipo)
+    if sensor is None or start_date is None or end_date is None:
+        return None
+
+    end_date = min(end_date, datetime.now())
+    z = calcular_delta_prima(tipo, sensor.deltat, [start_date, end_date])
+    resolucion = elegir_resolucion(z, start_date, sensor.deltat)
+    if resolucion is None:
+        return None
+
+    serie = (sensor.id_equipo, sensor.id_variable)
+    cobertura = cobertura_de(await db.execute(query_cobertura("sensor", resolucion, [serie])), "sensor")
+    if not cobertura:
+        # Rollup todavía sin calcular para este sensor: se agrega desde los datos en bruto
+        return None
+    # Lo que el rollup aún no cubre se agrega desde sensor_datos, para no dejar buckets vacíos en la caché
+    buckets = query_buckets("sensor", resolucion, [serie], cobertura, start_date, end_date).subquery()
+    query = select(buckets.c.bucket, buckets.c.cuenta, buckets.c.suma).order_by(buckets.c.bucket.asc())
+    resultados = (await db.execute(query)).fetchall()
+    if not resultados:
+        return None
+
+    s_time = [int(r.bucket.timestamp() * 1000) for r in resultados]
+    datos_agregados = get_datos_rollup([start_date, end_date], [r.suma for r in resultados],
+                                       [r.cuenta for r in resultados], s_time, z)
+    return columnas_agregadas(datos_agregados, catalogo.equipos[sensor.id_equipo].descripcion)
+
+
+def columnas_agregadas(datos_agregados, nombre_equipo):
+    return {
+        "time": [item[0].isoformat() for item in datos_agregados],  # Convertir a string ISO 8601
+        "value": [item[1] for item in datos_agregados],
+        "equipo": [nombre_equipo] * len(datos_agregados)
+    }
+
+
+def agregacion(datos, datos_with_gaps, deltat, huecos_info, nombre_equipo, tipo, mode="avg"):
     s_data = [dato['value'] for dato in datos_with_gaps]
     s_time = [int(dato['time'].timestamp() * 1000) for dato in datos_with_gaps]
+    if mode in ("lttb", "m4"):
+        # Submuestreo que conserva picos: como mucho max_points puntos reales de la serie
+        _, max_points = get_diccionario1(tipo)
+        seleccion = lttb(s_time, s_data, max_points) if mode == "lttb" else m4(s_time, s_data, max_points)
+        return {
+            "time": [datos_with_gaps[i]['time'].isoformat() for i in seleccion.tolist()],
+            "value": [s_data[i] for i in seleccion.tolist()],
+            "equipo": [nombre_equipo] * len(seleccion)
+        }
+    elif mode != "avg":
+        raise ValueError("Modo de agregación no válido")
     z = calcular_delta_prima(tipo, deltat, [datos_with_gaps[0]['time'], datos_with_gaps[-1]['time']])
     if z == deltat:
         for pos, length, time in huecos_info:
             for i in range(pos, pos + length):
                 datos_with_gaps.insert(i, {"time": datos[i]['time'], "value": None, "equipo": datos[i]['equipo']})
-        return datos_with_gaps
+        return {campo: [dato[campo] for dato in datos_with_gaps] for campo in ("time", "value", "equipo")}
     datos_agregados = get_datos_sin_hueco([datos_with_gaps[0]['time'], datos_with_gaps[-1]['time']], s_data, s_time, z)
-    datos_finales = []
-    for item in datos_agregados:
-        datos_finales.append({
-            "time": item[0].isoformat(),  # Convertir a string ISO 8601
-            "value": item[1],
-            "equipo": nombre_equipo
-        })
-    return datos_finales
+    return columnas_agregadas(datos_agregados, nombre_equipo)
 
 
 @router.get("/")
-def datos_condicionales_sensor(
+async def datos_condicionales_sensor(
+        request: Request,
         variable: Optional[str] = None,
         equipo: Optional[str] = None,
-        start_date: Optional[datetime] = None,
-        end_date: Optional[datetime] = None,
+        start_date: Optional[FechaLocal] = None,
+        end_date: Optional[FechaLocal] = None,
         tipo: Optional[str] = None,
-        db: Session = Depends(get_db)
+        mode: Optional[str] = "avg",
+        formato: Optional[str] = None
 ):
+    formato = negociar_formato(request, formato)
     if variable and equipo:
         try:
-            return read_datos_sensor_by_variable(db, variable, equipo, start_date, end_date, tipo)
+            return await responder_cacheado(
+                request, formato,
+                lambda sesion: read_datos_sensor_by_variable(variable, equipo, start_date, end_date, tipo, mode),
+                hasta=end_date,
+                etiquetas=etiquetas_de("sensor_variable", [variable]) + etiquetas_de("sensor_equipo", [equipo])
+            )
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
         except IndexError:
@@ -100,59 +160,62 @@ def datos_condicionales_sensor(
         raise HTTPException(status_code=404, detail="No existe esa combinación.")
 
 
-@router.get("/heatmap")
-def datos_heatmap_sensor(db: Session = Depends(get_db), variable: Optional[str] = None, equipo: Optional[str] = None,
-                         year: Optional[int] = None):
-    cache_key = f"heatmap_sensor_{variable}_{equipo}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
+DIAS_SEMANA = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+SEMANAS = [f"week{i}" for i in range(1, 54)]  # Hasta 53 semanas en un año
 
-    if year is None:
-        year = datetime.now().year
 
-    query = (
-        select(
-            func.week(SensorDatos.timestamp, 1).label('week'),
-            func.dayname(SensorDatos.timestamp).label('day'),
-            func.avg(SensorDatos.valor).label('average_value')
-        )
-        .join(Sensor, (SensorDatos.id_equipo == Sensor.id_equipo) & (SensorDatos.id_variable == Sensor.id_variable))
-        .join(Variable, Sensor.id_variable == Variable.id)
-        .join(Equipo, Sensor.id_equipo == Equipo.id)
-        .where(Variable.simbolo == variable)
-        .where(Equipo.nombre == equipo)
-        .where(extract('year', SensorDatos.timestamp) == year)
-        .group_by(
-            func.week(SensorDatos.timestamp, 1),
-            func.dayname(SensorDatos.timestamp),
-            func.dayofweek(SensorDatos.timestamp)
-        )
-        .order_by(
-            func.week(SensorDatos.timestamp, 1),
-            func.dayofweek(SensorDatos.timestamp)
-        )
-    )
+def semana_mysql(dia):
+    """Número de semana de `dia` igual que WEEK(dia, 1) de MySQL, que es lo que devolvía la consulta original.
 
-    resultados = db.execute(query).fetchall()
+    Las semanas empiezan en lunes y la 1 es la primera con 4 días en el año. Los días anteriores son la
+    semana 0 y los últimos días del año siguen en la 53 en lugar de pasar a la 1 del siguiente.
+    """
+    inicio_semana_1 = date.fromisocalendar(dia.year, 1, 1)
+    return max((dia - inicio_semana_1).days // 7 + 1, 0)
 
-    days_data = {}
-    weeks_of_year = [f"week{i}" for i in range(1, 54)]  # Suponiendo que podrías tener hasta 53 semanas en un año.
 
-    days_of_week = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-    for day in days_of_week:
-        days_data[day] = {week: None for week in weeks_of_year}
+def serie_sensor(variable, equipo):
+    # Clave primaria del sensor, resuelta con el catálogo en lugar de con joins
+    sensor = catalogo.sensor(variable, equipo)
+    return [(sensor.id_equipo, sensor.id_variable)] if sensor else []
 
-    # Iteramos sobre los resultados y llenamos los datos
-    for r in resultados:
-        week = f"week{r.week}"  # Ejemplo: "week1", "week2", etc.
-        day = r.day
-        avg_value = r.average_value
 
-        if day in days_data:
-            days_data[day][week] = avg_value
+def filtrar_sensor(query, tabla, variable, equipo):
+    return query.where(tuple_(tabla.id_equipo, tabla.id_variable).in_(serie_sensor(variable, equipo)))
+
+
+def query_heatmap(variable, equipo, year, cobertura):
+    # Un año son como mucho 366 buckets diarios: del rollup, y desde sensor_datos lo que este aún no cubre
+    buckets = query_buckets("sensor", 86400, serie_sensor(variable, equipo), cobertura,
+                            datetime(year, 1, 1), datetime(year, 12, 31)).subquery()
+    return select(buckets.c.bucket, buckets.c.cuenta, buckets.c.suma)
+
+
+async def calcular_heatmap(db, variable, equipo, year):
+    filas = await analitica.ejecutar(db, query_cobertura("sensor", 86400, serie_sensor(variable, equipo)))
+    resultados = await analitica.ejecutar(db, query_heatmap(variable, equipo, year, cobertura_de(filas, "sensor")))
+
+    days_data = {day: {week: None for week in SEMANAS} for day in DIAS_SEMANA}
+    # Cada día es una celda (semana, día de la semana): la media del día es suma / cuenta de su bucket
+    for r in resultados:
+        if r.cuenta:
+            days_data[DIAS_SEMANA[r.bucket.weekday()]][f"week{semana_mysql(r.bucket.date())}"] = r.suma / r.cuenta
 
     # Formateamos el resultado final como lista de diccionarios
-    formatted_result = [{"Day": day, **data} for day, data in days_data.items()]
+    return [{"Day": day, **data} for day, data in days_data.items()]
 
-    return formatted_result
+
+@router.get("/heatmap")
+async def datos_heatmap_sensor(variable: Optional[str] = None, equipo: Optional[str] = None,
+                               year: Optional[int] = None):
+    if not variable or not equipo:
+        raise HTTPException(status_code=400, detail="Debe proporcionar la variable y el equipo.")
+    if year is None:
+        year = datetime.now().year
+
+    cache_key = f"heatmap_sensor_{variable}_{equipo}_{year}"
+    return await cacheado(
+        cache_key, lambda sesion: calcular_heatmap(sesion, variable, equipo, year),
+        hasta=datetime(year + 1, 1, 1),
+        etiquetas=etiquetas_de("sensor_variable", [variable]) + etiquetas_de("sensor_equipo", [equipo])
+    )
@@ -1,33 +1,30 @@
-from datetime import datetime
 from typing import Optional
-from fastapi import Depends, HTTPException, APIRouter, status
-from sqlalchemy.orm import Session
+from fastapi import Depends, HTTPException, APIRouter, status, Query, Request
 from sqlalchemy import select
-from db.connector import get_db
+from db.catalogo import catalogo, catalogo_al_dia
 from db.models import *
-from db.redis_client import set_cached_response, get_cached_response
+from utils.agregacion import reducir_serie
+from db.redis_client import etiquetas_de
+from utils.formatos import negociar_formato, responder_cacheado
+from utils.series import leer_series, Rotulos, FechaLocal
 
 router = APIRouter(
     prefix="/datos/senal",
     tags=["señal"],
     responses={status.HTTP_404_NOT_FOUND: {"message": "No encontrado"}},
+    dependencies=[Depends(catalogo_al_dia)],
 )
 
 
-def read_senal_datos_by_nombre(db, senal, start_date=None, end_date=None):
-    cache_key = f"datos_senal_{senal}_{start_date}_{end_date}"
-    cached_data = get_cached_response(cache_key)
-    if cached_data:
-        return cached_data
-
+def query_senal_by_nombres(nombres, start_date=None, end_date=None):
+    # Lectura directa por clave primaria (id_señal, timestamp), sin join con la tabla de señales
     query = (
         select(
             SenalDatos.timestamp.label('time'),
             SenalDatos.valor.label('value'),
-            Senal.nombre.label('senal')
+            SenalDatos.id_señal
         )
-        .join(Senal, SenalDatos.id_señal == Senal.id)
-        .where(Senal.nombre == senal)
+        .where(SenalDatos.id_señal.in_(catalogo.senales_por_nombre(nombres)))
         .order_by(SenalDatos.timestamp.asc())
     )
 
@@ -35,35 +32,63 @@ def read_senal_datos_by_nombre(db, senal, start_date=None, end_date=None):
         query = query.where(SenalDatos.timestamp >= start_date)
     if end_date:
         query = query.where(SenalDatos.timestamp <= end_date)
+    return query
+
 
-    resultados = db.execute(query).fetchall()
-    datos = [{"time": r.time, "value": r.value, "senal": r.senal} for r in resultados]
+ROTULOS_SENAL = Rotulos(
+    ("senal", "clave"),
+    lambda id_senal: (catalogo.senales[id_senal].nombre, catalogo.senales[id_senal].nombre)
+)
 
-    set_cached_response(cache_key, datos)
-    return datos
+
+async def read_series_senal_by_nombres(db, senal_list, start_date=None, end_date=None, max_points=None,
+                                       interval=None):
+    return await leer_series(
+        db, senal_list, "senal", query_senal_by_nombres, start_date, end_date,
+        lambda datos: reducir_serie(datos, ("senal",), max_points, interval), ROTULOS_SENAL
+    )
 
 
-def read_senal_multiple_by_nombre(db, nombres, start_date=None, end_date=None):
-    senal_list = nombres.split(',')
-    all_data = {}
-    for senal in senal_list:
-        data = read_senal_datos_by_nombre(db, senal, start_date, end_date)
-        all_data[senal] = data
-    return all_data
+async def read_senal_datos_by_nombre(db, senal, start_date=None, end_date=None, max_points=None, interval=None):
+    datos = await read_series_senal_by_nombres(db, [senal], start_date, end_date, max_points, interval)
+    return datos[senal]
+
+
+async def read_senal_multiple_by_nombre(db, nombres, start_date=None, end_date=None, max_points=None, interval=None):
+    return await read_series_senal_by_nombres(db, nombres.split(','), start_date, end_date, max_points, interval)
 
 
 @router.get("/")
-def datos_condicionales_consigna(
+async def datos_condicionales_consigna(
+        request: Request,
         nombre: Optional[str] = None,
         nombres: Optional[str] = None,
-        start_date: Optional[datetime] = None,
-        end_date: Optional[datetime] = None,
-        db: Session = Depends(get_db)
+        start_date: Optional[FechaLocal] = None,
+        end_date: Optional[FechaLocal] = None,
+        max_points: Optional[int] = Query(None, ge=1),
+        interval: Optional[int] = Query(None, ge=1),
+        formato: Optional[str] = None
 ):
+    formato = negociar_formato(request, formato)
+    # Sin reducción la respuesta es la consulta en bruto, que en NDJSON/CSV se emite en streaming
+    reducir = max_points or interval
     if nombre and not nombres:
-        return read_senal_datos_by_nombre(db, nombre, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_senal_datos_by_nombre(sesion, nombre, start_date, end_date, max_points, interval),
+            hasta=end_date, etiquetas=etiquetas_de("senal", [nombre]),
+            consulta=None if reducir else query_senal_by_nombres([nombre], start_date, end_date),
+            rotulos=ROTULOS_SENAL
+        )
     elif nombres and not nombre:
-        return read_senal_multiple_by_nombre(db, nombres, start_date, end_date)
+        return await responder_cacheado(
+            request, formato,
+            lambda sesion: read_senal_multiple_by_nombre(sesion, nombres, start_date, end_date, max_points, interval),
+            multiple=True,
+            hasta=end_date, etiquetas=etiquetas_de("senal", nombres.split(',')),
+            consulta=None if reducir else query_senal_by_nombres(nombres.split(','), start_date, end_date),
+            rotulos=ROTULOS_SENAL
+        )
     else:
         # Lógica para manejar la solicitud cuando no se proporciona ninguno de los parámetros esperados
         raise HTTPException(status_code=400, detail="Debe proporcionar los datos de forma correcta.")
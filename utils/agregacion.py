@@ -1,5 +1,7 @@
 import datetime
 
+import numpy as np
+
 
 def get_diccionario1(tipo):
     if tipo == "timeseries":
@@ -23,9 +25,11 @@ def get_diccionario1(tipo):
         raise ValueError("Tipo de gráfico no válido")
 
 
-def calcular_delta_prima(tipo, delta_dts, time_limits):
+def calcular_delta_prima(tipo, delta_dts, time_limits, max_points=None):
 
     diccionario1, max_data_points_visible_def = get_diccionario1(tipo)
+    if max_points:
+        max_data_points_visible_def = max_points
 
     diccionario2 = {
         's': 1,
@@ -64,6 +68,11 @@ def calcular_delta_prima(tipo, delta_dts, time_limits):
         else:
             k += 1
 
+    # Barchart no tiene pasos de segundos ni de minutos: por debajo de su unidad más pequeña se usa su paso mínimo
+    if claves_d1[k] not in diccionario1:
+        unidad = next(clave for clave in claves_d1 if clave in diccionario1)
+        return diccionario1[unidad][0] * diccionario2[unidad]
+
     values = {
         "unidad": claves_d1[k],
         "valor": diccionario2[claves_d1[k]],
@@ -83,40 +92,199 @@ def calcular_delta_prima(tipo, delta_dts, time_limits):
     return z
 
 
-def get_datos_sin_hueco(time_limits, raw_data, raw_time, z):
-    grouped_data = []
-    current_group = []
+def agregar_buckets(raw_time, raw_data, t0, tiempo_final, intervalo):
+    """Agrupa la serie en buckets de ancho `intervalo` (ms) empezando en `t0`, en una sola pasada.
+
+    `raw_time` debe estar ordenado. Devuelve arrays por bucket con su inicio (ms) y
+    mean/min/max/count/first/last; los buckets vacíos tienen count 0 y NaN en el resto.
+    """
+    tiempos = np.asarray(raw_time, dtype=np.int64)
+    valores = np.asarray(raw_data, dtype=np.float64)
+
+    # Los valores nulos de la base de datos no cuentan para ningún bucket
+    validos = ~np.isnan(valores)
+    if not validos.all():
+        tiempos = tiempos[validos]
+        valores = valores[validos]
+
+    n_buckets = max(int((tiempo_final - t0) // intervalo) + 1, 0)
+    bordes = t0 + intervalo * np.arange(n_buckets + 1, dtype=np.int64)
+
+    # Intervalos semiabiertos [t0, t1): cada dato pertenece a un único bucket
+    limites = np.searchsorted(tiempos, bordes, side='left')
+    valores = valores[limites[0]:limites[-1]]
+    limites = limites - limites[0]
+    inicio, fin = limites[:-1], limites[1:]
+    count = fin - inicio
+
+    mean = np.full(n_buckets, np.nan)
+    minimo = np.full(n_buckets, np.nan)
+    maximo = np.full(n_buckets, np.nan)
+    first = np.full(n_buckets, np.nan)
+    last = np.full(n_buckets, np.nan)
+
+    no_vacios = count > 0
+    if no_vacios.any():
+        # reduceat sobre los inicios de los buckets con datos: los vacíos no ocupan posiciones
+        idx = inicio[no_vacios]
+        mean[no_vacios] = np.add.reduceat(valores, idx) / count[no_vacios]
+        minimo[no_vacios] = np.minimum.reduceat(valores, idx)
+        maximo[no_vacios] = np.maximum.reduceat(valores, idx)
+        first[no_vacios] = valores[idx]
+        last[no_vacios] = valores[fin[no_vacios] - 1]
+
+    return {
+        'time': bordes[:-1],
+        'mean': mean,
+        'min': minimo,
+        'max': maximo,
+        'count': count,
+        'first': first,
+        'last': last,
+    }
 
+
+def get_datos_sin_hueco(time_limits, raw_data, raw_time, z):
     t0 = int(time_limits[0].timestamp() * 1000)
     tiempo_final = int(time_limits[1].timestamp() * 1000)
     intervalo = z * 1000  # milisegundos
 
-    offset_ = 0
+    buckets = agregar_buckets(raw_time, raw_data, t0, tiempo_final, intervalo)
 
-    t1 = t0 + intervalo
+    return _formatear_buckets(buckets['time'], buckets['mean'], buckets['count'])
 
-    for i in range(len(raw_data)):
-        valor_offset = valor_offset_func(raw_data, raw_time, t0, t1, offset_)
-        if valor_offset is not None:
-            current_group.append(valor_offset['datos'])
-            sum_ = sum(current_group[0])
-            avg = sum_ / len(current_group[0])
-            #formateamos fecha
-            grouped_data.append([datetime.datetime.fromtimestamp(t0 / 1000.0), round(avg, 2)])
-            offset_ = valor_offset['offset'][1]
-        else:
-            grouped_data.append([datetime.datetime.fromtimestamp(t0 / 1000.0), None])
 
-        t0 = t1
-        t1 = t0 + intervalo
-        current_group = []
+def get_datos_rollup(time_limits, sumas, cuentas, raw_time, z):
+    """Igual que get_datos_sin_hueco, pero a partir de buckets de rollup (suma y cuenta por bucket)."""
+    t0 = int(time_limits[0].timestamp() * 1000)
+    tiempo_final = int(time_limits[1].timestamp() * 1000)
+    intervalo = z * 1000  # milisegundos
+
+    # Media ponderada: sum(suma) / sum(cuenta), y el número de buckets de rollup se cancela
+    b_suma = agregar_buckets(raw_time, sumas, t0, tiempo_final, intervalo)
+    b_cuenta = agregar_buckets(raw_time, cuentas, t0, tiempo_final, intervalo)
+
+    return _formatear_buckets(b_suma['time'], b_suma['mean'] / b_cuenta['mean'], b_suma['count'])
 
-        if t0 > tiempo_final:
-            break
+
+def _formatear_buckets(tiempos, medias, counts):
+    grouped_data = []
+    for t, avg, count in zip(tiempos.tolist(), np.round(medias, 2).tolist(), counts.tolist()):
+        # formateamos fecha
+        grouped_data.append([datetime.datetime.fromtimestamp(t / 1000.0), avg if count else None])
 
     return grouped_data
 
 
+def reducir_serie(columnas, claves, max_points=None, interval=None, ultimos=()):
+    """Reduce una serie en columnas {"time": [...], "value": [...], ...} a medias por bucket.
+
+    Las filas se separan por los campos de `claves` (p. ej. el equipo) y cada serie se agrupa con
+    `interval` segundos o con el ancho que da calcular_delta_prima para `max_points`. De los campos de
+    `ultimos` se conserva el último valor de cada bucket. Solo se devuelven los buckets con datos.
+    """
+    if not columnas['time'] or (not max_points and not interval):
+        return columnas
+
+    grupos = {}
+    for i, etiquetas in enumerate(zip(*(columnas[c] for c in claves))):
+        grupos.setdefault(etiquetas, []).append(i)
+
+    tiempos = np.array([int(t.timestamp() * 1000) for t in columnas['time']], dtype=np.int64)
+    valores = np.asarray(columnas['value'], dtype=np.float64)
+    reducidas = {campo: [] for campo in columnas}
+
+    for etiquetas, indices in grupos.items():
+        s_time, s_data = tiempos[indices], valores[indices]
+
+        # El deltat de la serie se estima con la mediana entre muestras consecutivas
+        deltat = max(int(np.median(np.diff(s_time))) // 1000, 1) if len(indices) > 1 else 1
+        time_limits = [columnas['time'][indices[0]], columnas['time'][indices[-1]]]
+        z = interval or calcular_delta_prima("timeseries", deltat, time_limits, max_points)
+        if z <= deltat:
+            for campo, valores_campo in columnas.items():
+                reducidas[campo].extend(valores_campo[i] for i in indices)
+            continue
+
+        t0, tiempo_final, intervalo = int(s_time[0]), int(s_time[-1]), z * 1000
+        buckets = agregar_buckets(s_time, s_data, t0, tiempo_final, intervalo)
+        con_datos = buckets['count'] > 0
+
+        reducidas['time'].extend(datetime.datetime.fromtimestamp(t / 1000.0)
+                                 for t in buckets['time'][con_datos].tolist())
+        reducidas['value'].extend(buckets['mean'][con_datos].tolist())
+        for campo in ultimos:
+            ultimo = agregar_buckets(s_time, [columnas[campo][i] for i in indices], t0, tiempo_final,
+                                     intervalo)['last'][con_datos]
+            reducidas[campo].extend(None if np.isnan(v) else int(v) for v in ultimo.tolist())
+        for campo, etiqueta in zip(claves, etiquetas):
+            reducidas[campo].extend([etiqueta] * int(con_datos.sum()))
+
+    orden = sorted(range(len(reducidas['time'])), key=reducidas['time'].__getitem__)
+    return {campo: [valores_campo[i] for i in orden] for campo, valores_campo in reducidas.items()}
+
+
+def _puntos_validos(raw_time, raw_data):
+    tiempos = np.asarray(raw_time, dtype=np.float64)
+    valores = np.asarray(raw_data, dtype=np.float64)
+    posiciones = np.flatnonzero(~np.isnan(valores))
+    return tiempos[posiciones], valores[posiciones], posiciones
+
+
+def lttb(raw_time, raw_data, max_points):
+    """Largest-Triangle-Three-Buckets: índices (ordenados) de como mucho `max_points` puntos que conservan la forma."""
+    tiempos, valores, posiciones = _puntos_validos(raw_time, raw_data)
+    n = len(valores)
+    if max_points >= n or max_points < 3:
+        return posiciones
+
+    # El primer y el último punto se conservan siempre; el resto se reparte en max_points - 2 buckets
+    bordes = (np.arange(max_points - 1) * ((n - 2) / (max_points - 2))).astype(np.int64) + 1
+    bordes[-1] = n - 1
+
+    seleccion = np.empty(max_points, dtype=np.int64)
+    seleccion[0] = 0
+    seleccion[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        inicio, fin = bordes[i], bordes[i + 1]
+        # Vértice C: media del bucket siguiente (o el último punto)
+        sig_inicio, sig_fin = fin, bordes[i + 2] if i + 2 < len(bordes) else n
+        c_t = tiempos[sig_inicio:sig_fin].mean()
+        c_v = valores[sig_inicio:sig_fin].mean()
+        # Área (x2) del triángulo A-B-C para todos los candidatos B del bucket a la vez
+        areas = np.abs(
+            (tiempos[a] - c_t) * (valores[inicio:fin] - valores[a])
+            - (tiempos[a] - tiempos[inicio:fin]) * (c_v - valores[a])
+        )
+        a = inicio + int(np.argmax(areas))
+        seleccion[i + 1] = a
+
+    return posiciones[seleccion]
+
+
+def m4(raw_time, raw_data, max_points):
+    """M4: primer, último, mínimo y máximo de cada uno de los max_points // 4 buckets temporales."""
+    tiempos, valores, posiciones = _puntos_validos(raw_time, raw_data)
+    n_buckets = max_points // 4
+    if len(valores) <= max_points or n_buckets < 1:
+        return posiciones
+
+    ancho = (tiempos[-1] - tiempos[0]) / n_buckets
+    buckets = np.minimum(((tiempos - tiempos[0]) // ancho).astype(np.int64), n_buckets - 1)
+
+    # Como los tiempos están ordenados, los buckets son tramos contiguos
+    cambios = np.flatnonzero(np.diff(buckets)) + 1
+    inicios = np.concatenate(([0], cambios))
+    fines = np.concatenate((cambios, [len(buckets)])) - 1
+
+    # Ordenando por (bucket, valor) el mínimo y el máximo quedan en los extremos de cada tramo
+    orden = np.lexsort((valores, buckets))
+    seleccion = np.unique(np.concatenate((inicios, fines, orden[inicios], orden[fines])))
+
+    return posiciones[seleccion]
+
+
 def valor_offset_func(row_data, row_time, t0, t1, pos_in):
     indices = []
     datos = []
@@ -0,0 +1,119 @@
+import numpy as np
+
+DIRECCIONES = ("backward", "forward", "nearest")
+RELLENOS = ("anterior", "lineal")
+
+
+def a_ms(tiempos):
+    # datetime64 sin zona: el orden es el de los DATETIME de la base de datos, también en los cambios de hora
+    return np.asarray(tiempos, dtype="datetime64[ms]").astype(np.int64)
+
+
+def indices_asof(base, tiempos, tolerancia, direccion="nearest"):
+    """Para cada instante de `base`, índice de la muestra de `tiempos` (ordenados) que le corresponde, o -1.
+
+    `backward` toma la última muestra anterior o igual, `forward` la primera posterior o igual y `nearest` la
+    más cercana. Las muestras a más de `tolerancia` (en las mismas unidades) no cuentan.
+    """
+    if direccion not in DIRECCIONES:
+        raise ValueError(f"Dirección no válida, debe ser una de {', '.join(DIRECCIONES)}")
+    n = len(tiempos)
+    if n == 0:
+        return np.full(len(base), -1, dtype=np.int64)
+
+    if direccion == "backward":
+        indices = np.searchsorted(tiempos, base, side="right") - 1
+    elif direccion == "forward":
+        indices = np.searchsorted(tiempos, base, side="left")
+    else:
+        derecha = np.minimum(np.searchsorted(tiempos, base, side="left"), n - 1)
+        izquierda = np.maximum(derecha - 1, 0)
+        indices = np.where(np.abs(base - tiempos[izquierda]) <= np.abs(tiempos[derecha] - base), izquierda, derecha)
+
+    dentro = (indices >= 0) & (indices < n)
+    indices = np.clip(indices, 0, n - 1)
+    dentro &= np.abs(tiempos[indices] - base) <= tolerancia
+    return np.where(dentro, indices, -1)
+
+
+def rellenar(valores, relleno, tiempos):
+    """Rellena los NaN con el último valor conocido (`anterior`) o interpolando entre los vecinos (`lineal`).
+
+    La interpolación es en el tiempo (`tiempos`, uno por valor): las filas no tienen por qué estar equiespaciadas.
+    """
+    if relleno is None:
+        return valores
+    if relleno not in RELLENOS:
+        raise ValueError(f"Relleno no válido, debe ser uno de {', '.join(RELLENOS)}")
+    validos = ~np.isnan(valores)
+    if validos.all() or not validos.any():
+        return valores
+
+    if relleno == "anterior":
+        ultimo = np.where(validos, np.arange(len(valores)), -1)
+        np.maximum.accumulate(ultimo, out=ultimo)
+        return np.where(ultimo >= 0, valores[np.maximum(ultimo, 0)], np.nan)
+
+    # Solo entre dos valores conocidos: los extremos no se extrapolan
+    posiciones = np.flatnonzero(validos)
+    interpolados = valores.copy()
+    huecos = np.flatnonzero(~validos)
+    huecos = huecos[(huecos > posiciones[0]) & (huecos < posiciones[-1])]
+    interpolados[huecos] = np.interp(tiempos[huecos], tiempos[posiciones], valores[posiciones])
+    return interpolados
+
+
+def rejilla(inicio, fin, paso):
+    return np.arange(inicio, fin + 1, paso, dtype=np.int64)
+
+
+def combinar(series, base=None, paso=None, tolerancia=0, direccion="nearest", relleno=None, requeridas=()):
+    """Une varias series {"time": [...], "value": [...]} (ordenadas por tiempo) en una tabla ancha en columnas.
+
+    Las filas son los instantes de la serie `base` o, con `paso` (segundos), una rejilla regular que cubre todas
+    las series. A cada fila le corresponde en cada serie la muestra que da `indices_asof` con `tolerancia`
+    (segundos) y `direccion`; si no hay ninguna queda vacía. Las filas en las que falta alguna de las `requeridas`
+    se descartan y `relleno` (una política o un dict por serie) rellena después los huecos de las demás series.
+    """
+    if (base is None) == (paso is None):
+        raise ValueError("Hay que indicar la serie base o el paso de la rejilla, y solo uno de los dos")
+    tiempos = {nombre: a_ms(columnas["time"]) for nombre, columnas in series.items()}
+
+    if base is not None:
+        filas = tiempos[base]
+    else:
+        con_datos = [t for t in tiempos.values() if len(t)]
+        if not con_datos:
+            filas = np.empty(0, dtype=np.int64)
+        else:
+            paso_ms = paso * 1000
+            inicio = min(t[0] for t in con_datos)
+            filas = rejilla(inicio - inicio % paso_ms, max(t[-1] for t in con_datos), paso_ms)
+
+    alineadas, casadas = {}, {}
+    for nombre, columnas in series.items():
+        valores = np.asarray(columnas["value"], dtype=np.float64)
+        if nombre == base:
+            alineados, casadas[nombre] = valores, np.ones(len(filas), dtype=bool)
+        else:
+            indices = indices_asof(filas, tiempos[nombre], tolerancia * 1000, direccion)
+            alineados = np.where(indices >= 0, valores[np.maximum(indices, 0)] if len(valores) else np.nan, np.nan)
+            casadas[nombre] = indices >= 0
+        alineadas[nombre] = alineados
+
+    # Las requeridas tienen que tener una muestra de verdad en la fila, no un valor rellenado; una muestra
+    # con valor NULL cuenta (sale como celda nula), como con el INNER JOIN
+    completas = np.ones(len(filas), dtype=bool)
+    for nombre in requeridas:
+        completas &= casadas[nombre]
+
+    tabla = {}
+    for nombre, alineados in alineadas.items():
+        politica = relleno.get(nombre) if isinstance(relleno, dict) else relleno
+        tabla[nombre] = rellenar(alineados, politica, filas)
+
+    resultado = {"time": filas[completas].astype("datetime64[ms]").astype(object).tolist()}
+    for nombre, valores in tabla.items():
+        valores = valores[completas]
+        resultado[nombre] = np.where(np.isnan(valores), None, valores.astype(object)).tolist()
+    return resultado
@@ -0,0 +1,214 @@
+import csv
+import io
+import os
+from datetime import datetime
+from decimal import Decimal
+from itertools import repeat
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+
+from db import connector
+from db.redis_client import cacheado_bytes
+from utils.series import campos_rotulados, rotular_filas
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+COLUMNAR_MEDIA_TYPE = "application/vnd.columnar+json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+FORMATOS = ("json", "columnar", "arrow", "ndjson", "csv")
+MEDIA_TYPES = {"json": "application/json", "columnar": COLUMNAR_MEDIA_TYPE, "arrow": ARROW_MEDIA_TYPE,
+               "ndjson": NDJSON_MEDIA_TYPE, "csv": CSV_MEDIA_TYPE}
+
+# Formatos fila a fila: una lectura en bruto se emite en streaming a medida que llega del cursor
+FORMATOS_STREAMING = ("ndjson", "csv")
+STREAM_FILAS = int(os.getenv("STREAM_FILAS", 5000))  # filas por lote leído del cursor de servidor
+
+
+def negociar_formato(request, formato=None):
+    # El parámetro `formato` manda sobre la cabecera Accept
+    if formato:
+        if formato not in FORMATOS:
+            raise HTTPException(status_code=400, detail=f"Formato no válido, debe ser uno de {', '.join(FORMATOS)}")
+        return formato
+    accept = request.headers.get("accept", "")
+    if ARROW_MEDIA_TYPE in accept:
+        return "arrow"
+    if COLUMNAR_MEDIA_TYPE in accept:
+        return "columnar"
+    if NDJSON_MEDIA_TYPE in accept:
+        return "ndjson"
+    if CSV_MEDIA_TYPE in accept:
+        return "csv"
+    return "json"
+
+
+def a_filas(columnas):
+    # Formato clásico: una lista de dicts {"time", "value", ...}
+    return [dict(zip(columnas, fila)) for fila in zip(*columnas.values())]
+
+
+def compactar(columnas):
+    # Las etiquetas de texto que no cambian en toda la serie se envían una sola vez
+    compactas = {}
+    for campo, valores in columnas.items():
+        if campo not in ("time", "value") and valores and isinstance(valores[0], str) \
+                and valores.count(valores[0]) == len(valores):
+            compactas[campo] = valores[0]
+        else:
+            compactas[campo] = valores
+    return compactas
+
+
+def _tabla_arrow(pa, columnas):
+    arrays = {}
+    for campo, valores in columnas.items():
+        if campo == "time":
+            tiempos = [datetime.fromisoformat(t) if isinstance(t, str) else t for t in valores]
+            arrays[campo] = pa.array(tiempos, type=pa.timestamp("ms"))
+        elif campo == "value":
+            arrays[campo] = pa.array(valores, type=pa.float64())
+        elif valores and isinstance(valores[0], str):
+            arrays[campo] = pa.array(valores, type=pa.string()).dictionary_encode()
+        else:
+            arrays[campo] = pa.array(valores)
+    return pa.table(arrays)
+
+
+def a_arrow(columnas=None, series=None):
+    """Arrow IPC (stream) de una serie en columnas o de varias series, identificadas por la columna `serie`."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise HTTPException(status_code=406, detail="El formato Arrow no está disponible en este servidor")
+
+    if series is None:
+        tabla = _tabla_arrow(pa, columnas)
+    else:
+        tablas = []
+        for clave, cols in series.items():
+            tabla = _tabla_arrow(pa, cols)
+            serie = pa.array([clave] * tabla.num_rows, type=pa.string()).dictionary_encode()
+            tablas.append(tabla.append_column("serie", serie))
+        tabla = pa.concat_tables(tablas, promote_options="permissive")
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, tabla.schema) as writer:
+        writer.write_table(tabla)
+    return sink.getvalue().to_pybytes()
+
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def _valor_csv(valor):
+    return valor.isoformat() if isinstance(valor, datetime) else valor
+
+
+def serializar_filas(formato, campos, filas, cabecera=False):
+    """Un lote de filas en NDJSON (un objeto por línea) o CSV (con la fila de nombres si `cabecera`)."""
+    if formato == "ndjson":
+        return b"".join(orjson.dumps(dict(zip(campos, fila)), default=_json_default) + b"\n" for fila in filas)
+    salida = io.StringIO()
+    escritor = csv.writer(salida, lineterminator="\n")
+    if cabecera:
+        escritor.writerow(campos)
+    escritor.writerows([_valor_csv(valor) for valor in fila] for fila in filas)
+    return salida.getvalue().encode()
+
+
+def _codificar_filas(datos, formato, multiple):
+    if not multiple:
+        return serializar_filas(formato, list(datos), zip(*datos.values()), cabecera=True)
+    # Varias series en una sola tabla, identificadas por la columna `serie`
+    partes = []
+    for clave, columnas in datos.items():
+        partes.append(serializar_filas(formato, [*columnas, "serie"], zip(*columnas.values(), repeat(clave)),
+                                       cabecera=not partes))
+    return b"".join(partes)
+
+
+def codificar(datos, formato, multiple=False):
+    """Serializa una serie en columnas (o un dict de series si `multiple`) al formato pedido, en bytes."""
+    if formato == "arrow":
+        return a_arrow(series=datos) if multiple else a_arrow(datos)
+    if formato in FORMATOS_STREAMING:
+        return _codificar_filas(datos, formato, multiple)
+    convertir = compactar if formato == "columnar" else a_filas
+    contenido = {clave: convertir(columnas) for clave, columnas in datos.items()} if multiple else convertir(datos)
+    # orjson serializa los datetime directamente en ISO 8601, sin pasar por jsonable_encoder
+    return orjson.dumps(contenido, default=_json_default)
+
+
+def responder_json(contenido):
+    return Response(content=orjson.dumps(contenido, default=_json_default), media_type=MEDIA_TYPES["json"])
+
+
+def responder_serie(columnas, formato):
+    return Response(content=codificar(columnas, formato), media_type=MEDIA_TYPES[formato])
+
+
+def responder_series(series, formato):
+    return Response(content=codificar(series, formato, multiple=True), media_type=MEDIA_TYPES[formato])
+
+
+def clave_respuesta(request, formato):
+    # Misma respuesta para los mismos parámetros, sin importar su orden en la URL
+    parametros = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()) if k != "formato")
+    return f"respuesta_{formato}_{request.url.path}?{parametros}"
+
+
+async def _stream_consulta(consulta, formato, multiple, rotulos=None):
+    # La sesión de la petición ya está cerrada cuando se emite el cuerpo: el stream abre la suya
+    async with connector.AsyncSessionLocal() as db:
+        resultado = await db.stream(consulta.execution_options(yield_per=STREAM_FILAS))
+        campos_consulta = list(resultado.keys())
+        campos = campos_rotulados(campos_consulta, rotulos) if rotulos else list(campos_consulta)
+        pos_clave = campos.index("clave") if "clave" in campos else None
+        if pos_clave is not None and multiple:
+            campos[pos_clave] = "serie"
+        elif pos_clave is not None:
+            del campos[pos_clave]
+
+        cabecera = True
+        async for lote in resultado.partitions():
+            if rotulos:
+                lote = rotular_filas(campos_consulta, lote, rotulos)
+            if pos_clave is not None and not multiple:
+                lote = [fila[:pos_clave] + fila[pos_clave + 1:] for fila in lote]
+            yield serializar_filas(formato, campos, lote, cabecera)
+            cabecera = False
+        if cabecera and formato == "csv":
+            yield serializar_filas(formato, campos, [], cabecera)
+
+
+def responder_stream(consulta, formato, multiple=False, rotulos=None):
+    """Emite la consulta en NDJSON o CSV por lotes desde un cursor de servidor: la memoria no depende del rango.
+
+    La columna `clave` de las consultas de varias series pasa a llamarse `serie` (o se quita si no es `multiple`).
+    Con `rotulos`, los ids del final de cada fila se cambian por los rótulos de su serie.
+    """
+    return StreamingResponse(_stream_consulta(consulta, formato, multiple, rotulos), media_type=MEDIA_TYPES[formato])
+
+
+async def responder_cacheado(request, formato, calcular, multiple=False, hasta=None, etiquetas=(), consulta=None,
+                             rotulos=None):
+    """Devuelve la respuesta ya serializada desde la caché; si no está, la calcula con `calcular(sesion)` y la guarda.
+
+    Los fallos de caché concurrentes de la misma respuesta se resuelven con un único cálculo. `hasta` y
+    `etiquetas` (fin del rango y series de la respuesta) deciden su caducidad, ver `clave_y_ttl`. Si se da
+    `consulta` (la lectura en bruto que hace `calcular`, con sus `rotulos`) y el formato es NDJSON o CSV, se
+    emite en streaming.
+    """
+    if consulta is not None and formato in FORMATOS_STREAMING:
+        return responder_stream(consulta, formato, multiple, rotulos)
+
+    async def serializar(sesion):
+        return codificar(await calcular(sesion), formato, multiple)
+
+    cuerpo = await cacheado_bytes(clave_respuesta(request, formato), serializar, hasta=hasta, etiquetas=etiquetas)
+    return Response(content=cuerpo, media_type=MEDIA_TYPES[formato])
@@ -3,60 +3,156 @@ from fastapi.security import OAuth2PasswordBearer
 from typing import Optional
 from jose import jwt, JWTError
 from pydantic import BaseModel
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from redis.exceptions import RedisError
 from datetime import datetime, timedelta, timezone
-from collections import defaultdict
-
-# Dictionary to store request counts and timestamps by IP
-ip_request_counts = defaultdict(lambda: {"count": 0, "timestamps": []})
-
-# Dictionary to store request counts and timestamps by path
-path_request_counts = defaultdict(lambda: {"count": 0, "timestamps": []})
-
-
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, max_requests_per_minute: int, max_requests_total: int, path_limit: int):
-        super().__init__(app)
+from collections import OrderedDict
+import logging
+import math
+import os
+import time
+
+from db import redis_client as cache
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_WINDOW = 60  # seconds
+# "redis" shares the counters between all workers; "memory" keeps them in each process
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "redis")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+# Requests per minute; load tests against a local server raise them (see loadtest)
+RATE_LIMIT_PER_IP = int(os.getenv("RATE_LIMIT_PER_IP", 100))
+RATE_LIMIT_PER_PATH = int(os.getenv("RATE_LIMIT_PER_PATH", 100))
+
+# Checks every limit and, only if none is exceeded, counts the request in all of them, atomically.
+# KEYS: current and previous window counters of each limit. ARGV: window, elapsed fraction of the current
+# window, limits. Returns 0 if allowed or the (1-based) position of the exceeded limit.
+_SLIDING_WINDOW = """
+local window = tonumber(ARGV[1])
+local weight = 1 - tonumber(ARGV[2])
+for i = 1, #KEYS / 2 do
+    local current = tonumber(redis.call('GET', KEYS[2 * i - 1]) or '0')
+    local previous = tonumber(redis.call('GET', KEYS[2 * i]) or '0')
+    if previous * weight + current >= tonumber(ARGV[i + 2]) then
+        return i
+    end
+end
+for i = 1, #KEYS / 2 do
+    redis.call('INCR', KEYS[2 * i - 1])
+    redis.call('EXPIRE', KEYS[2 * i - 1], window * 2)
+end
+return 0
+"""
+
+
+class MemoryRateLimiter:
+    """Sliding window counters kept in this process.
+
+    Each key stores only the counts of the current and previous fixed windows; the previous one is weighted by
+    the part of it still inside the sliding window. Keys are kept in least recently used order, so idle keys
+    (and the oldest ones beyond max_keys) are evicted from the front in O(1).
+    """
+
+    def __init__(self, window=RATE_LIMIT_WINDOW, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.window = window
+        self.max_keys = max_keys
+        self.counters = OrderedDict()  # key -> [window index, previous count, current count]
+
+    def _counter(self, key, index):
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = [index, 0, 0]
+            return counter
+        self.counters.move_to_end(key)
+        if counter[0] != index:
+            counter[1] = counter[2] if counter[0] == index - 1 else 0
+            counter[2] = 0
+            counter[0] = index
+        return counter
+
+    def _evict(self, index):
+        # Counters untouched for two windows estimate 0 requests and can go
+        while self.counters:
+            counter = next(iter(self.counters.values()))
+            if len(self.counters) <= self.max_keys and counter[0] >= index - 1:
+                break
+            self.counters.popitem(last=False)
+
+    async def hit(self, limits, now):
+        """Counts a request against every (key, limit) unless one is exceeded; returns its position or None."""
+        index, elapsed = int(now // self.window), now % self.window
+        weight = 1 - elapsed / self.window
+        counters = [self._counter(key, index) for key, _ in limits]
+        for position, ((_, limit), counter) in enumerate(zip(limits, counters)):
+            if counter[1] * weight + counter[2] >= limit:
+                return position
+        for counter in counters:
+            counter[2] += 1
+        self._evict(index)
+        return None
+
+
+class RedisRateLimiter:
+    """Same sliding window counters, in Redis and updated by a Lua script, so all the workers share them.
+
+    Idle keys expire after two windows.
+    """
+
+    def __init__(self, window=RATE_LIMIT_WINDOW, prefix="ratelimit"):
+        self.window = window
+        self.prefix = prefix
+        # Called through EVALSHA; the script is loaded again by itself if Redis no longer has it
+        self.script = cache.redis_client.register_script(_SLIDING_WINDOW)
+
+    async def hit(self, limits, now):
+        index = int(now // self.window)
+        keys = []
+        for key, _ in limits:
+            keys += [f"{self.prefix}:{key}:{index}", f"{self.prefix}:{key}:{index - 1}"]
+        exceeded = await self.script(keys=keys, args=[self.window, (now % self.window) / self.window,
+                                                     *(limit for _, limit in limits)])
+        return exceeded - 1 if exceeded else None
+
+
+class RateLimitMiddleware:
+    """Per IP and per path request limits over a sliding window of one minute, as plain ASGI middleware.
+
+    Rejected requests get a 429 with Retry-After. If Redis is unavailable the limits fall back to the
+    counters of this process. max_requests_total is accepted for compatibility but, as before, not enforced.
+    """
+
+    def __init__(self, app, max_requests_per_minute: int, max_requests_total: int, path_limit: int,
+                 backend: Optional[str] = None):
+        self.app = app
         self.max_requests_per_minute = max_requests_per_minute
         self.max_requests_total = max_requests_total
         self.path_limit = path_limit  # The limit for total requests to a path
-
-    async def dispatch(self, request: Request, call_next):
-        client_ip = request.client.host
-        current_time = datetime.now()
-        path = request.url.path
-
-        # Handle IP-based rate limiting
-        ip_data = ip_request_counts[client_ip]
-        ip_data["timestamps"] = [
-            timestamp for timestamp in ip_data["timestamps"]
-            if current_time - timestamp < timedelta(minutes=1)
-        ]
-
-        if len(ip_data["timestamps"]) >= self.max_requests_per_minute:
-            raise HTTPException(status_code=429, detail="Too many requests from this IP")
-
-        # Handle path-based rate limiting
-        path_data = path_request_counts[path]
-        path_data["timestamps"] = [
-            timestamp for timestamp in path_data["timestamps"]
-            if current_time - timestamp < timedelta(minutes=1)
-        ]
-
-        if len(path_data["timestamps"]) >= self.path_limit:
-            raise HTTPException(status_code=429, detail="This path has received too many requests")
-
-        # Update IP-based request counts
-        ip_data["timestamps"].append(current_time)
-        ip_data["count"] += 1
-
-        # Update path-based request counts
-        path_data["timestamps"].append(current_time)
-        path_data["count"] += 1
-
-        response = await call_next(request)
-        return response
+        self.memory = MemoryRateLimiter()
+        self.limiter = RedisRateLimiter() if (backend or RATE_LIMIT_BACKEND) == "redis" else self.memory
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        limits = [(f"ip:{client[0] if client else 'unknown'}", self.max_requests_per_minute),
+                  (f"path:{scope['path']}", self.path_limit)]
+        now = time.time()
+        try:
+            exceeded = await self.limiter.hit(limits, now)
+        except (RedisError, OSError):
+            logger.warning("Rate limiter backend unavailable, using in-process counters", exc_info=True)
+            exceeded = await self.memory.hit(limits, now)
+
+        if exceeded is not None:
+            detail = "Too many requests from this IP" if exceeded == 0 else "This path has received too many requests"
+            retry_after = str(math.ceil(RATE_LIMIT_WINDOW - now % RATE_LIMIT_WINDOW))
+            response = JSONResponse({"detail": detail}, status_code=429, headers={"Retry-After": retry_after})
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
 
 
 # Secret key to encode and decode JWT tokens
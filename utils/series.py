@@ -0,0 +1,193 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from typing import Annotated, Callable, NamedTuple
+
+from pydantic import AfterValidator
+
+from db import connector
+from db.redis_client import (get_cached_responses, set_cached_responses, una_vez, es_historico, versiones,
+                             etiquetas_de, indexar_historicos, CACHE_TTL_HISTORICO, CACHE_TTL_VIVO)
+from db.rollups import inicio_bucket
+
+
+class Rotulos(NamedTuple):
+    """Rótulos de una serie (equipo, variable, clave...) a partir de su clave primaria.
+
+    Las consultas de series leen sin joins y terminan en las columnas id_* de la serie; `de(*ids)` devuelve los
+    valores de `campos` para esa serie, y se llama una vez por serie, no por fila.
+    """
+    campos: tuple
+    de: Callable
+
+
+def _inicio_ids(campos):
+    return next(i for i, campo in enumerate(campos) if campo.startswith("id_"))
+
+
+def campos_rotulados(campos, rotulos):
+    return [*campos[:_inicio_ids(campos)], *rotulos.campos]
+
+
+def rotular_filas(campos, filas, rotulos):
+    """Cambia las columnas id_* del final de cada fila por los rótulos de su serie."""
+    inicio = _inicio_ids(campos)
+    por_serie = {}
+    rotuladas = []
+    for fila in filas:
+        ids = tuple(fila[inicio:])
+        valores = por_serie.get(ids)
+        if valores is None:
+            valores = por_serie[ids] = tuple(rotulos.de(*ids))
+        rotuladas.append((*fila[:inicio], *valores))
+    return rotuladas
+
+
+def a_columnas(campos, filas):
+    """Pasa filas a columnas {campo: [valores]} sin construir un dict por fila."""
+    columnas = list(zip(*filas)) if filas else [()] * len(campos)
+    return {campo: list(valores) for campo, valores in zip(campos, columnas) if campo != 'clave'}
+
+
+def columnas_desde_filas(resultado, filas=None, rotulos=None):
+    campos = list(resultado.keys())
+    filas = resultado.fetchall() if filas is None else filas
+    if rotulos:
+        campos, filas = campos_rotulados(campos, rotulos), rotular_filas(campos, filas, rotulos)
+    return a_columnas(campos, filas)
+
+
+async def consultar_columnas(consultas):
+    """Ejecuta a la vez varias consultas {nombre: consulta}, cada una con su sesión, y devuelve sus columnas."""
+    async def consultar(query):
+        async with connector.AsyncSessionLocal() as db:
+            return columnas_desde_filas(await db.execute(query))
+
+    resultados = await asyncio.gather(*(consultar(query) for query in consultas.values()))
+    return dict(zip(consultas, resultados))
+
+
+def hora_local(ts):
+    # La base de datos guarda la hora local sin zona: las fechas con zona (p. ej. en UTC) se convierten
+    return ts.astimezone().replace(tzinfo=None) if ts.tzinfo else ts
+
+
+# Fecha de los parámetros de las rutas (start_date, end_date...): llega ya en hora local sin zona, así que se
+# puede comparar con datetime.now(), con los datos y con los buckets de los rollups
+FechaLocal = Annotated[datetime, AfterValidator(hora_local)]
+
+
+def recortar(columnas, desde, hasta):
+    # Las series vienen ordenadas por tiempo: el recorte es una búsqueda binaria
+    inicio = bisect_left(columnas['time'], desde) if desde else 0
+    fin = bisect_right(columnas['time'], hasta) if hasta else len(columnas['time'])
+    return {campo: valores[inicio:fin] for campo, valores in columnas.items()}
+
+
+def tamano_segmento(start_date, end_date):
+    # Bloques de una hora para rangos cortos y de un día para el resto
+    return 3600 if end_date - start_date <= timedelta(days=2) else 86400
+
+
+async def consultar_series(db, claves, query, rotulos=None):
+    """Ejecuta una única consulta para varias claves y separa las filas por la columna (o el rótulo) `clave`."""
+    resultado = await db.execute(query)
+    campos, filas = list(resultado.keys()), resultado.fetchall()
+    if rotulos:
+        campos, filas = campos_rotulados(campos, rotulos), rotular_filas(campos, filas, rotulos)
+    pos_clave = campos.index('clave')
+
+    # MySQL compara sin distinguir mayúsculas: se agrupa por la clave normalizada
+    grupos = {}
+    for r in filas:
+        grupos.setdefault(r[pos_clave].lower(), []).append(r)
+    return {c: a_columnas(campos, grupos.get(c.lower(), [])) for c in claves}
+
+
+async def _leer_faltan(query, faltan, prefijo, paso, key, rotulos=None):
+    # Una sola consulta para todas las series y todo el tramo que falta, en una sesión propia: la lectura se
+    # comparte con las peticiones concurrentes a los mismos bloques
+    claves_faltan = list(dict.fromkeys(c for c, _ in faltan))
+    desde = min(b for _, b in faltan)
+    hasta = max(b for _, b in faltan) + paso - timedelta(microseconds=1)
+    async with connector.AsyncSessionLocal() as db:
+        consultadas = await consultar_series(db, claves_faltan, query(claves_faltan, desde, hasta), rotulos)
+
+    leidos, historicos, vivos, indice = {}, {}, {}, {}
+    for c, b in faltan:
+        leidos[(c, b)] = recortar(consultadas[c], b, b + paso - timedelta(microseconds=1))
+        if es_historico(b + paso):
+            historicos[key(c, b)] = leidos[(c, b)]
+            indice[key(c, b)] = (b + paso, etiquetas_de(prefijo, [c]))
+        else:
+            vivos[key(c, b)] = leidos[(c, b)]
+    await set_cached_responses(historicos, CACHE_TTL_HISTORICO)
+    if indice:
+        await indexar_historicos(indice)
+    await set_cached_responses(vivos, CACHE_TTL_VIVO)
+    return leidos
+
+
+async def leer_segmentos(db, claves, prefijo, query, start_date, end_date, rotulos=None):
+    """Lee las series de bloques alineados en caché y consulta solo los bloques que faltan.
+
+    Así, dos rangos que se solapan (un panel que se desplaza unos segundos) reutilizan los mismos bloques.
+    """
+    # Los bloques se alinean en hora local sin zona, como los datos
+    start_date, end_date = hora_local(start_date), hora_local(end_date)
+    if start_date > end_date:
+        # Rango vacío: no hay bloques, y la consulta devuelve las series vacías con sus campos
+        return await consultar_series(db, claves, query(claves, start_date, end_date), rotulos)
+    tamano = tamano_segmento(start_date, end_date)
+    paso = timedelta(seconds=tamano)
+    bloques = []
+    bloque = inicio_bucket(start_date, tamano)
+    while bloque <= end_date:
+        bloques.append(bloque)
+        bloque += paso
+
+    # Los bloques que todavía pueden recibir datos llevan la versión de su serie en la clave
+    version = {}
+    if not es_historico(bloques[-1] + paso):
+        version = dict(zip(claves, await versiones(etiquetas_de(prefijo, claves))))
+
+    def key(clave, bloque):
+        key = f"segmento_{prefijo}_{clave}_{tamano}_{bloque:%Y%m%dT%H%M%S}"
+        return key if es_historico(bloque + paso) else f"{key}_v{version[clave]}"
+
+    pares = [(c, b) for c in claves for b in bloques]
+    segmentos = dict(zip(pares, await get_cached_responses([key(c, b) for c, b in pares])))
+
+    faltan = [(c, b) for (c, b), columnas in segmentos.items() if columnas is None]
+    if faltan:
+        # Peticiones concurrentes a los mismos bloques comparten la consulta
+        consulta = "faltan_" + ",".join(key(c, b) for c, b in faltan)
+        segmentos.update(await una_vez(consulta, lambda: _leer_faltan(query, faltan, prefijo, paso, key, rotulos)))
+
+    series = {}
+    for c in claves:
+        columnas = {campo: [] for campo in segmentos[(c, bloques[0])]}
+        for b in bloques:
+            for campo, valores in segmentos[(c, b)].items():
+                columnas[campo].extend(valores)
+        series[c] = recortar(columnas, start_date, end_date)
+    return series
+
+
+async def leer_series(db, claves, prefijo, query, start_date=None, end_date=None, reducir=None, rotulos=None):
+    """Lee varias series (una por clave) en columnas, con una única consulta para lo que no esté en caché.
+
+    `query(claves, desde, hasta)` construye la consulta y debe etiquetar con `clave` la columna por la que se
+    separan las filas, o bien terminar en los ids de la serie y dar la `clave` en sus `rotulos`.
+    `reducir(columnas)` se aplica a cada serie ya recortada al rango pedido.
+    """
+    claves = list(dict.fromkeys(claves))
+    if start_date and end_date:
+        series = await leer_segmentos(db, claves, prefijo, query, start_date, end_date, rotulos)
+    else:
+        # Sin un rango acotado no hay bloques que alinear
+        series = await consultar_series(db, claves, query(claves, start_date, end_date), rotulos)
+    if reducir is None:
+        return series
+    # La reducción es cálculo en Python/numpy: en un hilo, para no bloquear el bucle de eventos
+    return await asyncio.to_thread(lambda: {c: reducir(columnas) for c, columnas in series.items()})